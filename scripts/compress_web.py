@@ -1,4 +1,6 @@
 import gzip
+import hashlib
+import json
 import shutil
 import glob
 import os
@@ -10,12 +12,35 @@ parser.add_argument("--path", type=str, default="./src/",
                     help="path to files", required=False)
 
 
+# Length of the content hash served as ETag, see src/lib/asset_cache.py
+ETAG_LENGTH = 16
+
+
 def gzip_file(input_file_path, output_file_path):
     with open(input_file_path, 'rb') as f_in:
-        with gzip.open(output_file_path, 'wb', compresslevel=9) as f_out:
+        # Fixed mtime, unchanged assets keep their hash between builds
+        with gzip.GzipFile(output_file_path, 'wb', compresslevel=9, mtime=0) as f_out:
             shutil.copyfileobj(f_in, f_out)
 
 
+def file_hash(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:ETAG_LENGTH]
+
+
+def write_etags(static_path, patterns):
+    # Content hash of every served file, keyed by the path relative to the static directory
+    etags = {}
+    for pattern in patterns:
+        for file in glob.glob(os.path.join(static_path, pattern), recursive=True):
+            key = os.path.relpath(file, static_path).replace(os.sep, '/')
+            etags[key] = file_hash(file)
+    etags_file = os.path.join(static_path, "etags.json")
+    with open(etags_file, 'w', encoding='utf-8') as f:
+        json.dump(etags, f, sort_keys=True)
+    print(f"Asset hashes: {len(etags)} files -> {etags_file}")
+
+
 def compress(directory_path, pattern):
     full_pattern = os.path.join(directory_path, pattern)
     files = glob.glob(full_pattern)
@@ -69,3 +94,6 @@ compress(f"{args.path}/static/styles/united", "*.css")
 compress(f"{args.path}/static/styles/vapor", "*.css")
 
 compress(f"{args.path}/static/", "*.html")
+
+write_etags(f"{args.path}/static", ["*.html", "*.html.gz", "javascript/*.js", "javascript/*.js.gz",
+                                     "styles/*/*.css", "styles/*/*.css.gz", "favicon/*"])
@@ -40,7 +40,7 @@ cd ..
 pip3 install numpy
 cd src
 # Precalculate RPM table for Stepper motor
-#rm -rf *.npy; rm -rf *.npy.crc; rm -rf constants.crc
+#rm -rf rpm_table.bin
 #python3 -c 'from lib.stepper_doser_math import *;make_rpm_table()'
 
 # Copy APP as frozen module
@@ -0,0 +1,78 @@
+from lib.checksum import file_sha256, load_json
+from lib.microdot.microdot import Response, send_file
+
+# Content hashes of the web assets, written by scripts/compress_web.py at build time
+ETAGS_FILE = "static/etags.json"
+ETAG_LENGTH = 16
+# Assets are revalidated with If-None-Match, pages on every load, styles and scripts once a day
+ASSET_MAX_AGE = 86400
+
+
+def asset_key(filename):
+    """
+    Manifest key of the served file, path relative to the static directory.
+    """
+    if filename.startswith("./"):
+        filename = filename[2:]
+    if filename.startswith("static/"):
+        filename = filename[7:]
+    return filename
+
+
+def cache_control(max_age):
+    if max_age is None:
+        return 'no-cache'
+    return f'max-age={max_age}'
+
+
+def not_modified(request, etag, max_age=None):
+    """
+    304 response if the client has the current version of the resource, otherwise None.
+    """
+    if_none_match = request.headers.get('If-None-Match', '')
+    if if_none_match == '*' or etag in if_none_match:
+        return Response(status_code=304, headers={'ETag': etag, 'Cache-Control': cache_control(max_age)})
+    return None
+
+
+# Serves static files with strong ETags and answers If-None-Match with 304 Not Modified,
+# so unchanged assets are not read from flash and sent over Wi-Fi again.
+class AssetCache:
+    def __init__(self, filename=ETAGS_FILE):
+        try:
+            self.etags = load_json(filename)
+        except (OSError, ValueError) as e:
+            print(f"No asset hashes in {filename}: {e}")
+            self.etags = {}
+        self.not_modified = 0
+
+    def etag(self, filename):
+        key = asset_key(filename)
+        etag = self.etags.get(key)
+        if etag is None:
+            # Not in the build manifest, hash the file once
+            try:
+                etag = file_sha256(filename)[1][:ETAG_LENGTH]
+            except OSError:
+                return None
+            self.etags[key] = etag
+        return f'"{etag}"'
+
+    def send_file(self, request, filename, max_age=None, compressed=False, file_extension='', stream=None):
+        """
+        send_file with an ETag. filename is the file on disk without file_extension,
+        stream is the file content already loaded to RAM.
+        """
+        etag = self.etag(filename + file_extension)
+        if etag is not None:
+            response = not_modified(request, etag, max_age)
+            if response is not None:
+                self.not_modified += 1
+                return response
+
+        response = send_file(filename, max_age=max_age, compressed=compressed, file_extension=file_extension,
+                             stream=stream)
+        if etag is not None:
+            response.headers['ETag'] = etag
+            response.headers['Cache-Control'] = cache_control(max_age)
+        return response
@@ -5,6 +5,30 @@ except ImportError:
     import numpy as np
     np.float = np.float32
     import asyncio as asyncio
+import array
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    import time
+
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(new, old):
+        return new - old
+
+# Command priorities, lower value is processed first
+PRIORITY_STOP = 0
+PRIORITY_DOSE = 1
+PRIORITY_READ = 2
+PRIORITIES = (PRIORITY_STOP, PRIORITY_DOSE, PRIORITY_READ)
+
+
+# Event that can be set from a timer callback, CPython asyncio doesn't have ThreadSafeFlag
+try:
+    ThreadSafeFlag = asyncio.ThreadSafeFlag
+except AttributeError:
+    ThreadSafeFlag = asyncio.Event
 
 
 # Implementation of missed asyncio.Future
@@ -22,32 +46,276 @@ class CustomFuture:
         return self._result
 
 
+# Commands are queued per pump and per priority. Every pump has its own address on the shared UART bus,
+# so a stop for one pump doesn't wait behind the dose queue of another: the highest priority is served first
+# and pumps of the same priority take turns.
 class CommandBuffer:
     def __init__(self):
-        self.buffer = []
+        # {<priority>: {<pump>: [(func, callback, args, kwargs, enqueue ticks), ...]}}
+        self.queues = {priority: {} for priority in PRIORITIES}
+        # Round-robin order of pumps with pending commands for every priority
+        self.turns = {priority: [] for priority in PRIORITIES}
         self.lock = asyncio.Lock()
+        self.task = None
+        self.processed = 0
+        self.wait_total = 0
+        self.wait_max = 0
+
+    def __len__(self):
+        return sum(len(commands) for queue in self.queues.values() for commands in queue.values())
 
-    async def add_command(self, func, callback, *args, **kwargs):
+    async def add_command(self, func, callback, *args, priority=PRIORITY_DOSE, **kwargs):
+        # First argument is the Servo42c of the pump
+        pump = getattr(args[0], "addr", None) if args else None
         async with self.lock:
             print("Adding command to buffer")
-            self.buffer.append((func, callback, args, kwargs))
-            print(f"Buffer length after adding: {len(self.buffer)}")
-            if len(self.buffer) == 1:
-                asyncio.create_task(self.process_commands())
+            queue = self.queues[priority]
+            if pump not in queue:
+                queue[pump] = []
+                self.turns[priority].append(pump)
+            queue[pump].append((func, callback, args, kwargs, ticks_ms()))
+            print(f"Buffer length after adding: {len(self)}")
+            if self.task is None or self.task.done():
+                self.task = asyncio.create_task(self.process_commands())
+
+    def next_command(self):
+        for priority in PRIORITIES:
+            turns = self.turns[priority]
+            if turns:
+                pump = turns.pop(0)
+                commands = self.queues[priority][pump]
+                command = commands.pop(0)
+                if commands:
+                    turns.append(pump)
+                else:
+                    del self.queues[priority][pump]
+                return command
+        return None
 
     async def process_commands(self):
-        while self.buffer:
+        while True:
             print("Attempting to process commands")
             async with self.lock:
-                if not self.buffer:
-                    print("Buffer was empty when trying to process")
+                command = self.next_command()
+                if command is None:
+                    print("Buffer is empty, stop processing")
                     return
-                func, callback, args, kwargs = self.buffer.pop(0)
+            func, callback, args, kwargs, enqueued = command
+            wait = ticks_diff(ticks_ms(), enqueued)
+            self.processed += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
             try:
-                print("Processing a command")
+                print(f"Processing a command, waited {wait}ms")
                 result = await func(*args, **kwargs)
                 if callback:
                     callback(result)
             except Exception as e:
                 print("Process command exception: ", e)
-            print("Command processed, current buffer length: ", len(self.buffer))
+            print("Command processed, current buffer length: ", len(self))
+
+    def metrics(self):
+        depth = {}
+        for priority in PRIORITIES:
+            for pump, commands in self.queues[priority].items():
+                depth[str(pump)] = depth.get(str(pump), 0) + len(commands)
+        return {"depth": len(self),
+                "pumps": depth,
+                "processed": self.processed,
+                "wait_avg_ms": self.wait_total // self.processed if self.processed else 0,
+                "wait_max_ms": self.wait_max}
+
+
+# Ring buffer of fired mcron jobs. The timer callback only stores the job id and fire time into preallocated slots
+# and sets a flag, dispatch() drains the buffer on the main loop. Single producer (timer) and single consumer
+# (dispatcher task), so head is written by push() only and tail by dispatch() only.
+class JobQueue:
+    def __init__(self, handler, size=32):
+        # async handler(callback_id, current_time)
+        self.handler = handler
+        self.size = size
+        self.ids = [None] * size
+        self.times = array.array("L", [0] * size)
+        self.ticks = [0] * size
+        self.head = 0
+        self.tail = 0
+        self.flag = ThreadSafeFlag()
+        self.dispatched = 0
+        self.dropped = 0
+        self.late_total = 0
+        self.late_max = 0
+
+    def __len__(self):
+        return (self.head - self.tail) % self.size
+
+    # mcron callback(callback_id, current_time, callback_memory)
+    def push(self, callback_id, current_time, callback_memory=None):
+        head = (self.head + 1) % self.size
+        if head == self.tail:
+            self.dropped += 1
+            return
+        self.ids[self.head] = callback_id
+        self.times[self.head] = current_time
+        self.ticks[self.head] = ticks_ms()
+        self.head = head
+        self.flag.set()
+
+    async def dispatch(self):
+        while True:
+            await self.flag.wait()
+            if hasattr(self.flag, "clear"):
+                self.flag.clear()
+            while self.tail != self.head:
+                tail = self.tail
+                callback_id, current_time = self.ids[tail], self.times[tail]
+                late = ticks_diff(ticks_ms(), self.ticks[tail])
+                self.ids[tail] = None
+                self.tail = (tail + 1) % self.size
+                self.dispatched += 1
+                self.late_total += late
+                self.late_max = max(self.late_max, late)
+                try:
+                    await self.handler(callback_id, current_time)
+                except Exception as e:
+                    print("Job dispatch exception: ", e)
+
+    def metrics(self):
+        return {"depth": len(self),
+                "dispatched": self.dispatched,
+                "dropped": self.dropped,
+                "late_avg_ms": self.late_total // self.dispatched if self.dispatched else 0,
+                "late_max_ms": self.late_max}
+
+
+# Commands received from the MQTT callback, one ring buffer per priority. push() wakes the consumer, which
+# drains every queued command in one wakeup, highest priority first and in arrival order within a priority.
+class CommandQueue:
+    def __init__(self, handler, size=16):
+        # async handler(kind, command)
+        self.handler = handler
+        self.size = size
+        self.kinds = {priority: [None] * size for priority in PRIORITIES}
+        self.commands = {priority: [None] * size for priority in PRIORITIES}
+        self.heads = {priority: 0 for priority in PRIORITIES}
+        self.tails = {priority: 0 for priority in PRIORITIES}
+        # Callback may run in the MQTT reconnect thread
+        self.flag = ThreadSafeFlag()
+        self.processed = 0
+        self.dropped = 0
+        self.wakeups = 0
+
+    def __len__(self):
+        return sum((self.heads[priority] - self.tails[priority]) % self.size for priority in PRIORITIES)
+
+    def push(self, kind, command, priority=PRIORITY_DOSE):
+        head = (self.heads[priority] + 1) % self.size
+        if head == self.tails[priority]:
+            print(f"Warning! Command queue is full, drop {kind} command")
+            self.dropped += 1
+            return False
+        self.kinds[priority][self.heads[priority]] = kind
+        self.commands[priority][self.heads[priority]] = command
+        self.heads[priority] = head
+        self.flag.set()
+        return True
+
+    def pop(self):
+        for priority in PRIORITIES:
+            tail = self.tails[priority]
+            if tail != self.heads[priority]:
+                kind, command = self.kinds[priority][tail], self.commands[priority][tail]
+                self.kinds[priority][tail] = None
+                self.commands[priority][tail] = None
+                self.tails[priority] = (tail + 1) % self.size
+                return kind, command
+        return None
+
+    async def dispatch(self):
+        while True:
+            await self.flag.wait()
+            if hasattr(self.flag, "clear"):
+                self.flag.clear()
+            self.wakeups += 1
+            while True:
+                item = self.pop()
+                if item is None:
+                    break
+                self.processed += 1
+                try:
+                    await self.handler(*item)
+                except Exception as e:
+                    print("Command dispatch exception: ", e)
+
+    def metrics(self):
+        return {"depth": len(self),
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "wakeups": self.wakeups}
+
+
+# Messages published per MQTT cycle
+PUBLISH_BATCH = 8
+
+
+# Fixed-size ring buffer of outgoing MQTT messages. A message for a topic that is still waiting in the buffer
+# is replaced in place, so a backlog keeps only the latest state of every pump. When the buffer is full the
+# oldest message is dropped.
+class PublishBuffer:
+    def __init__(self, size=32):
+        self.size = size
+        self.topics = [None] * size
+        self.messages = [None] * size
+        self.head = 0
+        self.tail = 0
+        # {<topic>: slot} of the messages that can be replaced
+        self.slots = {}
+        self.published = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return (self.head - self.tail) % self.size
+
+    def push(self, topic, message, coalesce=True):
+        if coalesce:
+            slot = self.slots.get(topic)
+            if slot is not None:
+                self.messages[slot] = message
+                self.coalesced += 1
+                return
+        head = (self.head + 1) % self.size
+        if head == self.tail:
+            self.pop()
+            self.dropped += 1
+        self.topics[self.head] = topic
+        self.messages[self.head] = message
+        if coalesce:
+            self.slots[topic] = self.head
+        self.head = head
+
+    def pop(self):
+        tail = self.tail
+        topic = self.topics[tail]
+        if self.slots.get(topic) == tail:
+            del self.slots[topic]
+        self.topics[tail] = None
+        self.messages[tail] = None
+        self.tail = (tail + 1) % self.size
+
+    def flush(self, publish, limit=PUBLISH_BATCH):
+        """
+        publish(topic, message) the oldest messages, a message stays in the buffer if publish raises.
+        """
+        count = 0
+        while self.tail != self.head and count < limit:
+            publish(self.topics[self.tail], self.messages[self.tail])
+            self.pop()
+            self.published += 1
+            count += 1
+        return count
+
+    def metrics(self):
+        return {"depth": len(self),
+                "published": self.published,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced}
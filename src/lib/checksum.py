@@ -0,0 +1,78 @@
+import json
+import binascii
+import hashlib
+try:
+    import micropython
+    MICROPYTHON = True
+except ImportError:
+    MICROPYTHON = False
+
+# CRC-8/ATM: polynomial 0x07, init 0xFF, no reflection, no final xor
+CRC8_POLY = 0x07
+CRC8_INIT = 0xFF
+CHUNK_SIZE = 1024
+
+
+def make_crc8_table(poly=CRC8_POLY):
+    table = bytearray(256)
+    for index in range(256):
+        crc = index
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table[index] = crc
+    return bytes(table)
+
+
+# One table lookup per byte instead of eight shift/xor rounds
+CRC8_TABLE = make_crc8_table()
+
+
+if MICROPYTHON:
+    @micropython.viper
+    def _crc8(data: ptr8, length: int, crc: int, table: ptr8) -> int:
+        for index in range(length):
+            crc = table[(crc ^ data[index]) & 0xFF]
+        return crc
+
+    def crc8(data, crc=CRC8_INIT):
+        return _crc8(data, len(data), crc, CRC8_TABLE)
+else:
+    def crc8(data, crc=CRC8_INIT):
+        table = CRC8_TABLE
+        for byte in data:
+            crc = table[crc ^ byte]
+        return crc
+
+
+def crc32(data, crc=0):
+    return binascii.crc32(data, crc)
+
+
+# Checksum of a file read in chunks, so big files (OTA image) don't have to fit in RAM
+def file_sha256(filename, chunk_size=CHUNK_SIZE):
+    digest = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    size = 0
+    with open(filename, "rb") as read_file:
+        while True:
+            chunk = read_file.readinto(buffer)
+            if not chunk:
+                break
+            digest.update(view[:chunk])
+            size += chunk
+    return size, binascii.hexlify(digest.digest()).decode()
+
+
+def verify_image(filename, length, sha=None):
+    size, file_sha = file_sha256(filename)
+    if size != length:
+        raise ValueError(f"Image size {size} doesn't match expected {length}")
+    if sha and file_sha != sha.lower():
+        raise ValueError(f"Image sha256 {file_sha} doesn't match expected {sha}")
+    return file_sha
+
+
+def load_json(filename):
+    with open(filename, "r") as read_file:
+        return json.load(read_file)
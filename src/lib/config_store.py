@@ -0,0 +1,145 @@
+import json
+import os
+from lib.checksum import crc8, load_json
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+CONFIG_FILE = "config/config.json"
+TMP_SUFFIX = ".tmp"
+# Legacy file is renamed once its sections are saved in CONFIG_FILE
+MIGRATED_SUFFIX = ".migrated"
+# Per-section files of older firmware, read once and migrated into CONFIG_FILE
+LEGACY_FILES = {"settings": "config/settings.json",
+                "storage": "config/storage.json",
+                "schedule": "config/schedule.json",
+                "limits": "config/limits.json",
+                "analog_settings": "config/analog_settings.json",
+                "calibration_points": "config/calibration_points.json",
+                "mqtt": "config/mqtt.json",
+                "wifi": "config/wifi.json"}
+# Seconds to wait after a change, following changes are saved in the same write
+SAVE_DELAY = 5
+
+
+def encode_config(sections):
+    # crc8 header line, then the json payload
+    payload = json.dumps(sections).encode()
+    return str(crc8(payload)).encode() + b"\n" + payload
+
+
+def decode_config(data):
+    header, payload = data.split(b"\n", 1)
+    if int(header) != crc8(payload):
+        raise ValueError("Checksum validation failed")
+    return json.loads(payload.decode())
+
+
+# All config sections in one file. Sections are loaded once at boot, mutations mark the section dirty and
+# a debounced saver writes the whole file to a temporary file and renames it over the old one,
+# a power loss leaves either the old or the new config, never a torn one.
+class ConfigStore:
+    def __init__(self, filename=CONFIG_FILE, legacy_files=LEGACY_FILES, delay=SAVE_DELAY):
+        self.filename = filename
+        self.legacy_files = legacy_files
+        self.delay = delay
+        # {<section name>: <json object>}
+        self.sections = {}
+        self.dirty = set()
+        # Legacy files read by load(), renamed after the next commit
+        self.migrated = []
+        self.event = asyncio.Event()
+        self.commits = 0
+
+    def load(self):
+        self.sections = self.read()
+        for name, filename in self.legacy_files.items():
+            if name not in self.sections:
+                try:
+                    self.sections[name] = load_json(filename)
+                except Exception as e:
+                    continue
+                print(f"Migrate {filename} to {self.filename}")
+                self.migrated.append(filename)
+                self.mark_dirty(name)
+        return self
+
+    def read(self):
+        # Temporary file is complete only if its checksum is valid, the power was lost before the rename
+        for filename in (self.filename, self.filename + TMP_SUFFIX):
+            try:
+                with open(filename, "rb") as read_file:
+                    return decode_config(read_file.read())
+            except Exception as e:
+                print(f"Can't load {filename}: ", e)
+        return {}
+
+    def section(self, name, default=None):
+        """
+        Section object, mutate it in place and call mark_dirty(name).
+        """
+        if name not in self.sections:
+            self.sections[name] = {} if default is None else default
+        return self.sections[name]
+
+    def get(self, name, key, default=None, type=None):
+        value = self.sections.get(name, {}).get(key, default)
+        if type is not None and value is not default:
+            try:
+                value = type(value)
+            except (TypeError, ValueError):
+                print(f"Invalid {name}.{key} value {value}, use default {default}")
+                value = default
+        return value
+
+    def set(self, name, key, value):
+        self.section(name)[key] = value
+        self.mark_dirty(name)
+
+    def replace(self, name, value):
+        self.sections[name] = value
+        self.mark_dirty(name)
+
+    def mark_dirty(self, *names):
+        for name in names:
+            self.dirty.add(name)
+        self.event.set()
+
+    def commit(self, *names):
+        """
+        Write the config now if any section is dirty, names are marked dirty first.
+        """
+        for name in names:
+            self.dirty.add(name)
+        if not self.dirty:
+            return False
+        tmp_filename = self.filename + TMP_SUFFIX
+        with open(tmp_filename, "wb") as write_file:
+            write_file.write(encode_config(self.sections))
+        try:
+            os.rename(tmp_filename, self.filename)
+        except OSError:
+            # File system without rename over an existing file
+            os.remove(self.filename)
+            os.rename(tmp_filename, self.filename)
+        print("Config saved: ", sorted(self.dirty))
+        self.dirty = set()
+        self.commits += 1
+        for filename in self.migrated:
+            try:
+                os.rename(filename, filename + MIGRATED_SUFFIX)
+            except OSError as e:
+                print(f"Can't rename migrated {filename}: ", e)
+        self.migrated = []
+        return True
+
+    async def saver(self):
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            await asyncio.sleep(self.delay)
+            try:
+                self.commit()
+            except OSError as e:
+                print("Failed to save config: ", e)
@@ -0,0 +1,194 @@
+import time
+from array import array
+
+HISTORY_FILE = "config/history{}.bin"
+# Doses kept per pump, the oldest are overwritten
+HISTORY_SIZE = 512
+# Records written to flash at once
+BLOCK_SIZE = 32
+# Records per chunk of the streamed history
+HISTORY_CHUNK = 32
+DAY = 86400
+WEEK_DAYS = 7
+
+# Record status flags
+FLAG_SCHEDULED = 1  # dose from the schedule, otherwise manual
+FLAG_LIMITED = 2  # dose was checked by the limits expression
+FLAG_SKIPPED = 4  # limits check not passed, nothing was dosed
+
+
+# Fixed-size ring buffer of the doses of one pump, 9 bytes per record. Columns are arrays so the file is
+# read straight into them at boot, and only the block with new records is written to flash.
+# File layout: timestamps uint32[size], volumes float32[size], flags uint8[size],
+# days uint32[WEEK_DAYS], totals float32[WEEK_DAYS], head and count uint32[2]
+class PumpHistory:
+    def __init__(self, filename, size=HISTORY_SIZE, block_size=BLOCK_SIZE):
+        self.filename = filename
+        self.size = size
+        self.block_size = block_size
+        self.timestamps = array('I', bytes(4 * size))
+        self.volumes = array('f', bytes(4 * size))
+        self.flags = bytearray(size)
+        # next slot to write and number of records in the buffer
+        self.head = 0
+        self.count = 0
+        # daily totals of the last week, indexed by day % WEEK_DAYS
+        self.days = array('I', bytes(4 * WEEK_DAYS))
+        self.totals = array('f', bytes(4 * WEEK_DAYS))
+        # head and count as saved with the last block
+        self.position = array('I', bytes(8))
+        self.unsaved = 0
+        self.writes = 0
+
+    def load(self):
+        try:
+            with open(self.filename, "rb") as read_file:
+                read_file.readinto(self.timestamps)
+                read_file.readinto(self.volumes)
+                read_file.readinto(self.flags)
+                # Totals keep the doses of overwritten records
+                saved_totals = read_file.readinto(self.days) == 4 * WEEK_DAYS and \
+                    read_file.readinto(self.totals) == 4 * WEEK_DAYS
+                saved_position = saved_totals and read_file.readinto(self.position) == 8
+        except OSError as e:
+            print(f"No dose history in {self.filename}: {e}")
+            return self
+        head, count = self.position
+        if saved_position and head < self.size and count <= self.size:
+            self.head = head
+            self.count = count
+        else:
+            # File of older firmware, the newest record is the one before head
+            newest = -1
+            for i in range(self.size):
+                if self.timestamps[i]:
+                    self.count += 1
+                    if newest < 0 or self.timestamps[i] >= self.timestamps[newest]:
+                        newest = i
+            self.head = (newest + 1) % self.size
+        if not saved_totals:
+            self.days = array('I', bytes(4 * WEEK_DAYS))
+            self.totals = array('f', bytes(4 * WEEK_DAYS))
+            for timestamp, volume, flags in self.records():
+                self.add_total(timestamp, volume, flags)
+        return self
+
+    def append(self, timestamp, volume, flags=0):
+        i = self.head
+        self.timestamps[i] = timestamp
+        self.volumes[i] = volume
+        self.flags[i] = flags
+        self.head = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.add_total(timestamp, volume, flags)
+        self.unsaved += 1
+        if self.head % self.block_size == 0:
+            self.save_block(i // self.block_size)
+
+    def add_total(self, timestamp, volume, flags):
+        if flags & FLAG_SKIPPED:
+            return
+        day = timestamp // DAY
+        slot = day % WEEK_DAYS
+        if self.days[slot] != day:
+            self.days[slot] = day
+            self.totals[slot] = 0
+        self.totals[slot] += volume
+
+    def daily_total(self, day):
+        slot = day % WEEK_DAYS
+        return self.totals[slot] if self.days[slot] == day else 0
+
+    def weekly_totals(self, day):
+        """
+        Totals of the week ending with day, oldest first.
+        """
+        return [self.daily_total(_) for _ in range(day - WEEK_DAYS + 1, day + 1)]
+
+    def records(self, start=0, end=None):
+        """
+        Records in chronological order, start <= timestamp <= end.
+        """
+        first = self.head - self.count
+        for k in range(self.count):
+            i = (first + k) % self.size
+            timestamp = self.timestamps[i]
+            if timestamp < start or (end is not None and timestamp > end):
+                continue
+            yield timestamp, self.volumes[i], self.flags[i]
+
+    def save_block(self, block):
+        a = block * self.block_size
+        b = a + self.block_size
+        try:
+            write_file = open(self.filename, "r+b")
+        except OSError:
+            # First save, allocate the whole file so blocks are written in place
+            with open(self.filename, "wb") as write_file:
+                write_file.write(bytes(9 * self.size + 8 * WEEK_DAYS + 8))
+            write_file = open(self.filename, "r+b")
+        with write_file:
+            for offset, item_size, column in ((0, 4, self.timestamps), (4 * self.size, 4, self.volumes),
+                                              (8 * self.size, 1, self.flags)):
+                write_file.seek(offset + a * item_size)
+                write_file.write(memoryview(column)[a:b])
+            write_file.seek(9 * self.size)
+            write_file.write(self.days)
+            write_file.write(self.totals)
+            self.position[0] = self.head
+            self.position[1] = self.count
+            write_file.write(self.position)
+        self.unsaved = 0
+        self.writes += 1
+
+    def flush(self):
+        """
+        Save the block with the not yet saved records.
+        """
+        if self.unsaved:
+            self.save_block(((self.head - 1) % self.size) // self.block_size)
+
+
+class DoseHistory:
+    def __init__(self, pumps, filename=HISTORY_FILE, size=HISTORY_SIZE, block_size=BLOCK_SIZE):
+        self.pumps = [PumpHistory(filename.format(_ + 1), size, block_size) for _ in range(pumps)]
+
+    def load(self):
+        for pump in self.pumps:
+            pump.load()
+        return self
+
+    def pump(self, pump_id):
+        return self.pumps[pump_id - 1]
+
+    def append(self, pump_id, volume, flags=0, timestamp=None):
+        if timestamp is None:
+            timestamp = int(time.time())
+        self.pump(pump_id).append(timestamp, volume, flags)
+
+    def flush(self):
+        for pump in self.pumps:
+            pump.flush()
+
+    def json_chunks(self, pump_id, start=0, end=None, day=None, chunk=HISTORY_CHUNK):
+        """
+        History of a pump as json, generated in chunks of records so the result is never built in RAM:
+        {"pump": 1, "daily": [<last 7 days totals>], "weekly": <mL>, "doses": [[<timestamp>, <mL>, <flags>], ...]}
+        """
+        history = self.pump(pump_id)
+        if day is None:
+            day = int(time.time()) // DAY
+        totals = history.weekly_totals(day)
+        daily = ", ".join(f"{round(_, 2)}" for _ in totals)
+        yield f'{{"pump": {pump_id}, "daily": [{daily}], "weekly": {round(sum(totals), 2)}, "doses": ['
+        records = []
+        separator = ""
+        for timestamp, volume, flags in history.records(start, end):
+            records.append(f"[{timestamp}, {round(volume, 2)}, {flags}]")
+            if len(records) == chunk:
+                yield separator + ", ".join(records)
+                separator = ", "
+                records = []
+        if records:
+            yield separator + ", ".join(records)
+        yield "]}"
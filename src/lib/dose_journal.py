@@ -0,0 +1,98 @@
+import os
+import struct
+import time
+from lib.checksum import crc8
+
+JOURNAL_FILE = "config/dose_journal.bin"
+# pump id, timestamp, dose mL, remaining mL after the dose, crc8 of the record
+RECORD_FORMAT = "<BIffB"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+# Journal is folded into the storage snapshot when it grows to this number of records
+MAX_RECORDS = 256
+
+
+def encode_record(pump_id, timestamp, dose, remaining):
+    record = struct.pack(RECORD_FORMAT, pump_id, timestamp, dose, remaining, 0)
+    return record[:-1] + bytes((crc8(record[:-1]),))
+
+
+def decode_record(record):
+    pump_id, timestamp, dose, remaining, crc = struct.unpack(RECORD_FORMAT, record)
+    if crc != crc8(record[:-1]):
+        raise ValueError("Checksum validation failed")
+    return pump_id, timestamp, dose, remaining
+
+
+# Append-only log of container level changes. Each dose appends one small record instead of rewriting the
+# whole storage config, at boot the records are replayed over the last storage snapshot. Records hold the
+# remaining volume, not the delta, so a replay over a snapshot that already has them changes nothing.
+class DoseJournal:
+    def __init__(self, snapshot, filename=JOURNAL_FILE, max_records=MAX_RECORDS):
+        """
+        snapshot: callable that persists the storage config
+        """
+        self.snapshot = snapshot
+        self.filename = filename
+        self.max_records = max_records
+        self.records = 0
+        self.compactions = 0
+        # Bytes after the last valid record, appends behind them would never be replayed
+        self.torn = False
+
+    def read(self):
+        """
+        Valid records of the journal, a record torn by power loss ends the journal.
+        """
+        try:
+            read_file = open(self.filename, "rb")
+        except OSError:
+            return
+        with read_file:
+            while True:
+                record = read_file.read(RECORD_SIZE)
+                if len(record) < RECORD_SIZE:
+                    return
+                try:
+                    yield decode_record(record)
+                except ValueError as e:
+                    print(f"Dose journal {self.filename}: {e}")
+                    return
+
+    def replay(self, storage):
+        """
+        Apply the journal to the storage snapshot, returns the number of applied records.
+        The journal has to be compacted if it has records or torn bytes.
+        """
+        self.records = 0
+        for pump_id, timestamp, dose, remaining in self.read():
+            key = f"remaining{pump_id}"
+            if key in storage:
+                storage[key] = round(remaining, 2)
+            self.records += 1
+        try:
+            self.torn = os.stat(self.filename)[6] != self.records * RECORD_SIZE
+        except OSError:
+            self.torn = False
+        return self.records
+
+    def append(self, pump_id, dose, remaining, timestamp=None):
+        if timestamp is None:
+            timestamp = int(time.time())
+        with open(self.filename, "ab") as write_file:
+            write_file.write(encode_record(pump_id, timestamp, dose, remaining))
+        self.records += 1
+        if self.records >= self.max_records:
+            self.compact()
+
+    def compact(self):
+        """
+        Save the storage snapshot and start an empty journal.
+        """
+        self.snapshot()
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+        self.records = 0
+        self.torn = False
+        self.compactions += 1
@@ -0,0 +1,45 @@
+try:
+    # Micropython Ulab
+    from ulab import numpy as np
+except ImportError:
+    import numpy as np
+from lib.stepper_doser_math import calc_move, calc_move_time, to_float, CombinationCache
+
+
+# Precomputed dose plans per pump, so a scheduled dose is a dict lookup instead of interp + table search.
+# Plan tuple: (desired_rpm, mstep, speed, steps, runtime, direction), pump inversion already applied.
+# Cached plan is dropped when the pump calibration chart or inversion has changed since it was made.
+# Least recently used plan is evicted when the cache is full.
+class DosePlanner:
+    def __init__(self, mks_dict, chart_points, inversion, rpm_table, cache=None, size=64):
+        self.mks_dict = mks_dict
+        self.chart_points = chart_points
+        self.inversion = inversion
+        self.rpm_table = rpm_table
+        self.cache = cache
+        self.size = size
+        self.plans = CombinationCache(size)
+
+    def make(self, pump_id, flow, duration, direction):
+        mks = self.mks_dict[f"mks{pump_id}"]
+        chart = self.chart_points[f"pump{pump_id}"]
+        desired_rpm = to_float(np.interp(flow, chart[1], chart[0]))
+        mstep, speed, steps = calc_move(mks, desired_rpm, duration, self.rpm_table, self.cache)
+        if self.inversion[pump_id - 1]:
+            direction = 0 if direction == 1 else 1
+        return desired_rpm, mstep, speed, steps, calc_move_time(mks, mstep, speed, steps), direction
+
+    def plan(self, pump_id, amount, duration, direction):
+        key = (pump_id, amount, duration, direction)
+        chart = self.chart_points[f"pump{pump_id}"]
+        inverted = self.inversion[pump_id - 1]
+        entry = self.plans.get(key)
+        if entry is not None and entry[0] is chart and entry[1] == inverted:
+            return entry[2]
+
+        plan = self.make(pump_id, amount * (60 / duration), duration, direction)
+        self.plans.put(key, (chart, inverted, plan))
+        return plan
+
+    def clear(self):
+        self.plans.clear()
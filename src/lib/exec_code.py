@@ -1,35 +1,61 @@
-sensetive_keys = ['time', 'os', 'sys', 'Microdot', 'redirect', 'send_file', 'with_sse', 're', 'requests', 'mcron',
-                  'json', 'calc_steps', 'np', 'file_or_dir_exists', 'calc_real_rpm', 'make_rpm_table',
-                  'find_combination', 'extrapolate_flow_rate', 'linear_interpolation', 'move_with_rpm', 'stepper_run',
-                  'struct', 'calc_crc', 'Servo42c', 'asyncio', 'CustomFuture', 'CommandBuffer', 'TaskManager',
-                  'analog_pins', 'gc', 'Mock', 'MagicMock', 'mac_address', 'network', 'wifi', 'ADC', 'Pin', 'ntptime',
-                  'unique_id', 'mock_adc', 'ubinascii', 'utime', 'random_adc_read', 'uart', 'ota', 'machine',
-                  'web_compress', 'web_file_extension', 'get_points', 'get_analog_settings', 'get_time',
-                  'calibration_points', 'read_file', 'analog_settings', 'settings', 'schedule', 'mks_dict',
-                  'mqtt_login', 'mqtt_password', 'chart_points', 'cal_points', 'new_rpm_values', 'new_flow_rate_values',
-                  'analog_chart_points', 'analog_en', 'analog_pin', 'analog_points', 'command_buffer',
-                  'load_files_to_ram', 'evaluate_expression', 'get_filtered_vars', 'addon', 'binascii',
-                  'mqtt_client', 'RELEASE_TAG', 'USE_RAM', 'html_files', 'filenames', 'js_files', 'file', 'css_files',
-                  'app', 'ota_lock', 'ota_progress', 'firmware_size', 'should_continue', 'c', 'mcron_keys',
-                  'time_synced', 'byte_string', 'hex_string', 'download_file_async', 'to_float',
-                  'analog_control_worker', 'start_timer', 'end_timer', 'get_rpm_points', 'get_flow_points',
-                  'get_analog_chart_points', 'get_free_mem', 'favicon', 'manifest', 'styles', 'javascript', 'static',
-                  'run_with_rpm', 'dose', 'index', 'dose_ssetime', 'dose_sse', 'ota_events', 'ota_upgrade',
-                  'calibration', 'setting_responce', 'setting_process_post', 'update_schedule', 'sync_time',
-                  'update_sched_onstart', 'maintain_memory', 'mqtt_worker', 'mqtt_dose_buffer', 'mqtt_run_buffer',
-                  'process_mqtt_cmd', 'main', 'start_web_server', 'wifi_config', 'wifi_settings', 'password',
-                  'rpm_table', 'time', 'UART', 'adc_worker', 'MQTTClient', 'array', '__file__', '__name__', '_']
-
-
-def evaluate_expression(expression, allowed_vars={}):
-    # Remove unwanted modules from allowed_vars
-    allowed_vars = {key: val for key, val in allowed_vars.items() if key not in sensetive_keys}  # Explicitly blocking some modules
-    #print("Allowed keys:", allowed_vars.keys())
+EVAL_GLOBALS = {"__builtins__": None}
+EXPRESSION_CACHE_SIZE = 32
+# Compiled limit expressions {<source>: (code, values, getters)}
+expression_cache = {}
 
+
+# Identifiers used in the expression
+def expression_names(expression):
+    names = set()
+    start = None
+    for index, char in enumerate(expression + " "):
+        if char.isalpha() or char == "_" or start is not None and char.isdigit():
+            if start is None:
+                start = index
+        elif start is not None:
+            names.add(expression[start:index])
+            start = None
+    return names
+
+
+def compile_expression(expression, values):
+    """
+    values: whitelist of the live values the expression can read {<name>: <function returning the value>}
+    """
+    entry = expression_cache.get(expression)
+    if entry is None or entry[1] is not values:
+        if len(expression_cache) >= EXPRESSION_CACHE_SIZE:
+            print("Expression cache full, clean it")
+            expression_cache.clear()
+        try:
+            code = compile(expression, "<limits>", "eval")
+        except NameError:
+            # Firmware without compile(), eval the source
+            code = expression
+        # Only the whitelisted names the expression uses are looked up on evaluation
+        getters = tuple((name, values[name]) for name in expression_names(expression) if name in values)
+        entry = (code, values, getters)
+        expression_cache[expression] = entry
+    return entry
+
+
+def compile_limits(limits, values):
+    for expression in limits.values():
+        if isinstance(expression, str):
+            try:
+                compile_expression(expression, values)
+            except Exception as e:
+                print(f"Error compiling expression {expression}: {e}")
+
+
+def evaluate_expression(expression, values):
     result = None
     try:
+        code, _, getters = compile_expression(expression, values)
+        # Fresh namespace of the current values, nothing outside of the whitelist is reachable
+        namespace = {name: getter() for name, getter in getters}
         # Evaluate the expression safely with limited scope
-        result = eval(expression, {"__builtins__": None}, allowed_vars)
+        result = eval(code, EVAL_GLOBALS, namespace)
     except Exception as e:
         print(f"Error evaluating expression: {e}")
     finally:
@@ -71,7 +97,7 @@ print("Global var x = ",x)
 x= 123
 """
 
-    result, logs = evaluate_expression("1>2")
+    result, logs = evaluate_expression("1>2", {})
     print("Execution result:", result)
     print("Logs:\n", logs)
 
@@ -1,8 +1,10 @@
 try:
     import utime
+    import machine
 except ImportError:
     from unittest.mock import Mock
     utime = Mock()
+    machine = Mock()
     import time
     # Utime is CPython epoch 2000-01-01 00:00:00 UTC, when time.time() is 1970-01-01 00:00:00 UTC epoch
     utime.time = Mock(return_value=(time.time() - 946684800))
@@ -10,8 +12,10 @@ except ImportError:
     # Mock CPython const implementation
     def const(value):
         return value
-
-import machine
+try:
+    import heapq
+except ImportError:
+    import uheapq as heapq
 
 PERIOD_CENTURY = const(100 * 365 * 24 * 60 * 60)  # Warning: average value
 PERIOD_YEAR = const(365 * 24 * 60 * 60)  # Warning: average value
@@ -33,6 +37,28 @@ timer_table = {}
 # }
 memory_table = {}
 
+# Reverse index, so remove() doesn't scan the timer table
+# {
+#   <callback_id>: (<period_info>, <period_steps>)
+# }
+callback_index = {}
+
+# Next-fire index, so a tick doesn't scan the whole timer table.
+# {
+#   (<period_info>, <period_steps>): <next fire time>
+# }
+fire_index = {}
+# Min-heap of (<next fire time>, (<period_info>, <period_steps>)). Entries not matching fire_index are stale.
+fire_heap = []
+# {
+#   (<period_info>, <period_steps>): <sorted steps of the set> or <normalized (start, stop, step) of the range>
+# }
+index_steps = {}
+# Last time processed by the index
+_index_time = None
+# Fire times behind current time up to this value are still dispatched, bigger clock jumps rebuild the index
+MAX_LATENESS = const(2)
+
 # {
 #   <callback_id>: <callback>
 # }
@@ -122,53 +148,157 @@ def insert(period, period_steps, callback_id, callback, period_offset=0, from_no
     else:
         callback_ids = set()
         period_data[period_steps] = callback_ids
+        index_bucket((period_info, period_steps))
     callback_ids.add(callback_id)
+    callback_index[callback_id] = (period_info, period_steps)
 
 
 def remove(callback_id):
     global timer_table, memory_table, callback_table
-    to_del_pi = []
-    for period_info, period_data in timer_table.items():
-        to_del_ps = []
-        for period_steps, callback_ids in period_data.items():
-            if callback_id in callback_ids:
-                callback_ids.remove(callback_id)
-            if callback_id in memory_table:
-                memory_table.pop(callback_id)
-            if len(callback_ids) <= 0:
-                to_del_ps.append(period_steps)
-        for period_steps in to_del_ps:
-            period_data.pop(period_steps)
-        del to_del_ps
+    memory_table.pop(callback_id, None)
+    callback_table.pop(callback_id, None)
+    bucket = callback_index.pop(callback_id, None)
+    if bucket is None:
+        return
+    period_info, period_steps = bucket
+    period_data = timer_table[period_info]
+    callback_ids = period_data[period_steps]
+    callback_ids.discard(callback_id)
+    if not callback_ids:
+        period_data.pop(period_steps)
+        unindex_bucket(bucket)
         if not period_data:
-            to_del_pi.append(period_info)
-    for period_info in to_del_pi:
-        timer_table.pop(period_info)
-    del to_del_pi
-    if callback_id in callback_table:
-        callback_table.pop(callback_id)
+            timer_table.pop(period_info)
 
 
 def remove_all():
     global callback_table
-    for cid in callback_table.keys():
+    for cid in list(callback_table.keys()):
         remove(cid)
 
 
-def get_actions(current_time):
-    global timer_table, memory_table, callback_table, callback_exception_processors
+def normalize_steps(period, period_steps):
+    """
+    Steps of the bucket in a form suitable for the next fire search: a sorted tuple for a set,
+    (start, stop, step) with a positive step within [0, period) for a range. None if the bucket never fires.
+    """
+    if STEP_TYPE_SET == period_steps[0]:
+        return tuple(sorted(s for s in period_steps[1:] if 0 <= s < period))
+    start, stop, step = period_steps[1:]
+    if step < 0:
+        steps = range(start, stop, step)
+        if not len(steps):
+            return None
+        start, stop, step = steps[-1], steps[0] + 1, -step
+    if start < 0:
+        start += (-start + step - 1) // step * step
+    stop = min(stop, period)
+    if start >= stop:
+        return None
+    return start, stop, step
+
+
+def next_fire(key, from_time):
+    """
+    The first time >= from_time when the bucket fires, None if it never fires.
+    """
+    (period, period_offset), period_steps = key
+    steps = index_steps[key]
+    if not steps:
+        return None
+    period_pointer = (from_time + period_offset) % period
+    period_start = from_time - period_pointer
+    if STEP_TYPE_SET == period_steps[0]:
+        low, high = 0, len(steps)
+        while low < high:
+            middle = (low + high) // 2
+            if steps[middle] < period_pointer:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(steps):
+            return period_start + steps[low]
+        return period_start + period + steps[0]
+    start, stop, step = steps
+    if period_pointer <= start:
+        return period_start + start
+    pointer = start + (period_pointer - start + step - 1) // step * step
+    if pointer < stop:
+        return period_start + pointer
+    return period_start + period + start
+
+
+def schedule_bucket(key, from_time):
+    fire_time = next_fire(key, from_time)
+    if fire_time is None:
+        fire_index.pop(key, None)
+    else:
+        fire_index[key] = fire_time
+        heapq.heappush(fire_heap, (fire_time, key))
+
+
+def index_bucket(key):
+    index_steps[key] = normalize_steps(key[0][0], key[1])
+    from_time = utime.time()
+    # Seconds already processed by the timer never fire again, e.g. a job removed and inserted back
+    if _index_time is not None and from_time <= _index_time:
+        from_time = _index_time + 1
+    schedule_bucket(key, from_time)
+
+
+def unindex_bucket(key):
+    index_steps.pop(key, None)
+    # Heap entry becomes stale, compact the heap when stale entries dominate
+    fire_index.pop(key, None)
+    if len(fire_heap) > 2 * len(fire_index) + 32:
+        compact_index()
+
+
+def compact_index():
+    fire_heap.clear()
+    for key, fire_time in fire_index.items():
+        fire_heap.append((fire_time, key))
+    heapq.heapify(fire_heap)
+
+
+def rebuild_index(from_time):
+    fire_index.clear()
     for period_info, period_data in timer_table.items():
-        period, period_offset = period_info
-        period_pointer = (current_time + period_offset) % period
-        for period_steps, callback_ids in period_data.items():
-            if STEP_TYPE_SET == period_steps[0] and period_pointer in period_steps[1:] or \
-                                STEP_TYPE_RANGE == period_steps[0] and period_pointer in range(*period_steps[1:]):
-                yield from callback_ids
+        for period_steps in period_data:
+            key = (period_info, period_steps)
+            fire_time = next_fire(key, from_time)
+            if fire_time is not None:
+                fire_index[key] = fire_time
+    compact_index()
+
+
+def pop_actions(current_time):
+    """
+    Callback ids due at current_time from the next-fire index. O(1) when nothing is due.
+    """
+    global _index_time
+    if _index_time is None or current_time < _index_time or current_time - _index_time > MAX_LATENESS:
+        # First run or the clock jumped (NTP sync), don't catch up on the missed steps
+        rebuild_index(current_time)
+    actions = []
+    while fire_heap and fire_heap[0][0] <= current_time:
+        fire_time, key = heapq.heappop(fire_heap)
+        if fire_index.get(key) != fire_time:
+            continue
+        period_info, period_steps = key
+        actions.extend(timer_table[period_info][period_steps])
+        schedule_bucket(key, fire_time + 1)
+    _index_time = current_time
+    return actions
 
 
 def run_actions(current_time):
     global timer_table, memory_table, callback_table, callback_exception_processors
-    for callback_id in get_actions(current_time):
+    actions = pop_actions(current_time)
+    for callback_id in actions:
+        # Callback could be removed by the previous one
+        if callback_id not in callback_table:
+            continue
         callback_memory = memory_table.setdefault(callback_id, {})
         action_callback = callback_table[callback_id]
 
@@ -177,6 +307,7 @@ def run_actions(current_time):
         except Exception as e:
             for processor in callback_exception_processors:
                 processor(e)
+    return actions
 
 
 def run_actions_callback(*args, **kwargs):
@@ -188,12 +319,12 @@ def run_actions_callback(*args, **kwargs):
     _last_run_time = current_time
     start = utime.ticks_ms()
 
-    run_actions(current_time)
+    actions = run_actions(current_time)
 
     stop = utime.ticks_ms()
     processing_time = utime.ticks_diff(stop, start)
     if processing_time > _max_time_task_calls:
-        e = TLPTimeException(current_time, processing_time, ' '.join(get_actions(current_time)))
+        e = TLPTimeException(current_time, processing_time, ' '.join(actions))
         for processor in callback_exception_processors:
             processor(e)
 
@@ -0,0 +1,195 @@
+import json
+from lib.microdot.microdot import invoke_handler
+
+#: Size of the body chunks read from the socket and fed to the decoder.
+CHUNK_SIZE = 256
+
+# byte values, tuples as MicroPython can't look up an int in bytes
+WHITESPACE = (0x20, 0x09, 0x0d, 0x0a)
+DELIMITERS = WHITESPACE + (0x2c, 0x3a, 0x5d, 0x7d)
+LITERALS = {b'true': True, b'false': False, b'null': None}
+
+# next token expected in an open container
+EXPECT_VALUE_OR_END = 0  # after [
+EXPECT_VALUE = 1  # after , in a list or : in an object
+EXPECT_SEPARATOR = 2  # after a value, , or the closing bracket
+EXPECT_KEY_OR_END = 3  # after {
+EXPECT_KEY = 4  # after , in an object
+EXPECT_COLON = 5  # after a key
+
+
+class JSONStreamDecoder:
+    """Incremental JSON decoder.
+
+    The document is fed in chunks with :meth:`feed`, only the unparsed tail
+    of the last chunk is kept, so the body is never held in memory as one
+    buffer next to the decoded object. :meth:`close` returns the decoded
+    value.
+    """
+    def __init__(self):
+        self.buffer = b''
+        # open containers, [container, pending key, expected token]
+        self.stack = []
+        self.root = None
+        self.done = False
+
+    def feed(self, data):
+        buffer = self.buffer + data if self.buffer else data
+        self.buffer = b''
+        length = len(buffer)
+        i = 0
+        while i < length:
+            c = buffer[i]
+            if c in WHITESPACE:
+                i += 1
+                continue
+            if self.done:
+                raise ValueError('extra data after JSON document')
+            top = self.stack[-1] if self.stack else None
+            if c == 0x7b or c == 0x5b:  # { [
+                self.expect_value(c)
+                if c == 0x7b:
+                    self.stack.append([{}, None, EXPECT_KEY_OR_END])
+                else:
+                    self.stack.append([[], None, EXPECT_VALUE_OR_END])
+                i += 1
+            elif c == 0x7d or c == 0x5d:  # } ]
+                if top is None or \
+                        isinstance(top[0], dict) != (c == 0x7d) or \
+                        top[2] not in (EXPECT_SEPARATOR, EXPECT_KEY_OR_END,
+                                       EXPECT_VALUE_OR_END):
+                    raise ValueError('unexpected ' + chr(c))
+                self.stack.pop()
+                self.value(top[0])
+                i += 1
+            elif c == 0x2c:  # ,
+                if top is None or top[2] != EXPECT_SEPARATOR:
+                    raise ValueError('unexpected ,')
+                top[2] = EXPECT_KEY if isinstance(top[0], dict) \
+                    else EXPECT_VALUE
+                i += 1
+            elif c == 0x3a:  # :
+                if top is None or top[2] != EXPECT_COLON:
+                    raise ValueError('unexpected :')
+                top[2] = EXPECT_VALUE
+                i += 1
+            elif c == 0x22:  # "
+                end = i + 1
+                while True:
+                    end = buffer.find(b'"', end)
+                    if end < 0:
+                        # string continues in the next chunk
+                        self.buffer = buffer[i:]
+                        return
+                    escapes = 0
+                    while buffer[end - 1 - escapes] == 0x5c:
+                        escapes += 1
+                    if not escapes % 2:
+                        break
+                    end += 1
+                raw = buffer[i + 1:end]
+                if b'\\' in raw:
+                    string = json.loads(buffer[i:end + 1])
+                else:
+                    string = raw.decode()
+                if top is not None and top[2] in (EXPECT_KEY_OR_END,
+                                                  EXPECT_KEY):
+                    top[1] = string
+                    top[2] = EXPECT_COLON
+                else:
+                    self.expect_value(c)
+                    self.value(string)
+                i = end + 1
+            else:
+                end = i + 1
+                while end < length and buffer[end] not in DELIMITERS:
+                    end += 1
+                if end == length:
+                    # number or literal may continue in the next chunk
+                    self.buffer = buffer[i:]
+                    return
+                self.expect_value(c)
+                self.value(self.scalar(buffer[i:end]))
+                i = end
+
+    def scalar(self, token):
+        if token in LITERALS:
+            return LITERALS[token]
+        token = token.decode()
+        if '.' in token or 'e' in token or 'E' in token:
+            return float(token)
+        return int(token)
+
+    def expect_value(self, c):
+        if self.stack and self.stack[-1][2] not in (EXPECT_VALUE,
+                                                    EXPECT_VALUE_OR_END):
+            raise ValueError('unexpected ' + chr(c))
+
+    def value(self, value):
+        if not self.stack:
+            self.root = value
+            self.done = True
+            return
+        top = self.stack[-1]
+        if isinstance(top[0], list):
+            top[0].append(value)
+        else:
+            top[0][top[1]] = value
+            top[1] = None
+        top[2] = EXPECT_SEPARATOR
+
+    def close(self):
+        if self.buffer.strip():
+            if self.done:
+                raise ValueError('extra data after JSON document')
+            self.value(self.scalar(self.buffer.strip()))
+            self.buffer = b''
+        if not self.done or self.stack:
+            raise ValueError('incomplete JSON document')
+        return self.root
+
+
+async def read_json(request, chunk_size=CHUNK_SIZE):
+    """Decode the JSON body of a request that was not read into memory,
+    chunk by chunk straight from the socket."""
+    decoder = JSONStreamDecoder()
+    remaining = request.content_length
+    while remaining:
+        chunk = await request.stream.read(min(chunk_size, remaining))
+        if not chunk:
+            raise ValueError('incomplete request body')
+        remaining -= len(chunk)
+        decoder.feed(chunk)
+    return decoder.close()
+
+
+def with_json_body(max_length):
+    """Decorator that limits the JSON body of a route to ``max_length``
+    bytes.
+
+    Bodies larger than ``Request.max_body_length`` are not read into memory
+    by the server, for these the decorator decodes the body incrementally
+    before the handler runs, and ``request.json`` returns the decoded
+    object as usual::
+
+        @app.route('/calibration', methods=['POST'])
+        @with_json_body(16 * 1024)
+        async def calibration(request):
+            data = request.json
+    """
+    def decorator(f):
+        async def json_body_handler(request, *args, **kwargs):
+            if request.content_length > max_length:
+                return 'Payload too large', 413
+            if request.content_length and not request.body and \
+                    request.content_type and \
+                    request.content_type.split(';')[0] == 'application/json':
+                try:
+                    request._json = await read_json(request)
+                except ValueError as exc:
+                    print('Invalid JSON body:', exc)
+                    return 'Bad request', 400
+            return await invoke_handler(f, request, *args, **kwargs)
+
+        return json_body_handler
+    return decorator
@@ -294,6 +294,36 @@ class AsyncBytesIO:
         pass
 
 
+class WriteBuffer:
+    """Coalesces small writes to a stream into one preallocated buffer, so
+    they are sent in one ``awrite`` call. One buffer is allocated per
+    connection and reused by all its responses."""
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+
+    async def write(self, data):
+        end = self.length + len(data)
+        if end > len(self.buffer):
+            await self.flush()
+            end = len(data)
+            if end > len(self.buffer):
+                await self.stream.awrite(data)
+                return
+        self.view[self.length:end] = data
+        self.length = end
+
+    async def flush(self):
+        if self.length:
+            # no copy, the stream copies the bytes the socket didn't take
+            # before awrite returns
+            data = self.view[:self.length]
+            self.length = 0
+            await self.stream.awrite(data)
+
+
 class Request:
     """An HTTP request."""
     #: Specify the maximum payload size that is accepted. Requests with larger
@@ -542,6 +572,12 @@ class Response:
 
     send_file_buffer_size = 1024
 
+    #: Size of the buffer the status line, the headers and the first body
+    #: chunk are written to, so small responses are sent in one write. The
+    #: default fits the headers and a ``send_file_buffer_size`` chunk in one
+    #: TCP segment.
+    write_buffer_size = 1460
+
     #: The content type to use for responses that do not explicitly define a
     #: ``Content-Type`` header.
     default_content_type = 'text/plain'
@@ -570,6 +606,12 @@ class Response:
             # this applies to bytes, file-like objects or generators
             self.body = body
         self.is_head = False
+        #: The HTTP version of the request, used in the status line.
+        self.http_version = '1.0'
+        #: Whether the connection is kept open after this response. Set by
+        #: the server before the response is written, cleared when the body
+        #: can't be framed for a persistent connection or writing fails.
+        self.keep_alive = False
 
     def set_cookie(self, cookie, value, path=None, domain=None, expires=None,
                    max_age=None, secure=False, http_only=False,
@@ -622,6 +664,10 @@ class Response:
                         **kwargs)
 
     def complete(self):
+        if self.status_code == 304:
+            # not modified, the client keeps the representation headers of
+            # its cached copy
+            return
         if isinstance(self.body, bytes) and \
                 'Content-Length' not in self.headers:
             self.headers['Content-Length'] = str(len(self.body))
@@ -630,23 +676,49 @@ class Response:
             if 'charset=' not in self.headers['Content-Type']:
                 self.headers['Content-Type'] += '; charset=UTF-8'
 
-    async def write(self, stream):
+    async def write(self, stream, buffer=None):
         self.complete()
 
+        # streamed body without Content-Length needs chunked framing to keep
+        # the connection open, which is only available in HTTP/1.1
+        chunked = False
+        if self.keep_alive and not self.is_head and \
+                not isinstance(self.body, bytes) and \
+                'Content-Length' not in self.headers:
+            if self.http_version == '1.1':
+                chunked = True
+                self.headers['Transfer-Encoding'] = 'chunked'
+            else:
+                self.keep_alive = False
+        if self.keep_alive:
+            self.headers['Connection'] = 'keep-alive'
+        elif self.http_version == '1.1':
+            self.headers['Connection'] = 'close'
+
         try:
+            if buffer is None or buffer.stream is not stream or \
+                    len(buffer.buffer) != self.write_buffer_size:
+                buffer = WriteBuffer(stream, self.write_buffer_size)
+            buffer.length = 0
+
             # status code
             reason = self.reason if self.reason is not None else \
                 ('OK' if self.status_code == 200 else 'N/A')
-            await stream.awrite('HTTP/1.0 {status_code} {reason}\r\n'.format(
-                status_code=self.status_code, reason=reason).encode())
+            await buffer.write('HTTP/{version} {status_code} {reason}\r\n'.format(
+                version=self.http_version, status_code=self.status_code,
+                reason=reason).encode())
 
             # headers
             for header, value in self.headers.items():
                 values = value if isinstance(value, list) else [value]
                 for value in values:
-                    await stream.awrite('{header}: {value}\r\n'.format(
+                    await buffer.write('{header}: {value}\r\n'.format(
                         header=header, value=value).encode())
-            await stream.awrite(b'\r\n')
+            await buffer.write(b'\r\n')
+            if self.is_head or hasattr(self.body, '__anext__'):
+                # don't hold the headers back until an async generator
+                # produces its first chunk
+                await buffer.flush()
 
             # body
             if not self.is_head:
@@ -654,8 +726,18 @@ class Response:
                 async for body in iter:
                     if isinstance(body, str):  # pragma: no cover
                         body = body.encode()
+                    if chunked:
+                        if not body:
+                            continue
+                        body = '{:x}\r\n'.format(len(body)).encode() + \
+                            body + b'\r\n'
                     try:
-                        await stream.awrite(body)
+                        if buffer.length:
+                            # first chunk goes out with the headers
+                            await buffer.write(body)
+                            await buffer.flush()
+                        else:
+                            await stream.awrite(body)
                     except OSError as exc:  # pragma: no cover
                         if exc.errno in MUTED_SOCKET_ERRORS or \
                                 exc.args[0] == 'Connection lost':
@@ -664,8 +746,12 @@ class Response:
                         raise
                 if hasattr(iter, 'aclose'):  # pragma: no branch
                     await iter.aclose()
+                if chunked:
+                    await buffer.write(b'0\r\n\r\n')
+                await buffer.flush()
 
         except OSError as exc:  # pragma: no cover
+            self.keep_alive = False
             if exc.errno in MUTED_SOCKET_ERRORS or \
                     exc.args[0] == 'Connection lost':
                 pass
@@ -912,8 +998,25 @@ class Microdot:
         app = Microdot()
     """
 
+    #: Seconds an idle persistent connection waits for the next request
+    #: before it is closed.
+    keep_alive_timeout = 5
+
+    #: Maximum number of requests served on one persistent connection.
+    max_keep_alive_requests = 20
+
+    #: Maximum number of concurrently open connections, further connections
+    #: get a ``503`` response. Each open socket holds lwIP and heap buffers.
+    max_connections = 10
+
+    #: Maximum number of concurrently open event streams. Event streams stay
+    #: open for as long as a page is shown, so they don't count towards
+    #: ``max_connections`` and can't lock the other pages out.
+    max_streams = 4
+
     def __init__(self):
         self.url_map = []
+        self.route_index = None
         self.before_request_handlers = []
         self.after_request_handlers = []
         self.after_error_request_handlers = []
@@ -922,6 +1025,8 @@ class Microdot:
         self.options_handler = self.default_options_handler
         self.debug = False
         self.server = None
+        self.connections = 0
+        self.streams = 0
 
     def route(self, url_pattern, methods=None):
         """Decorator that is used to register a function as a request handler
@@ -1296,6 +1401,53 @@ class Microdot:
         """
         self.server.close()
 
+    def build_route_index(self):
+        """Index the URL map, so a request is only matched against the
+        routes that can handle its path.
+
+        Static routes are indexed by their path. Dynamic routes are grouped
+        by their first segment when it is static, routes starting with a
+        dynamic segment are candidates for any path. Candidate lists keep
+        the registration order of the URL map.
+        """
+        static = {}
+        prefixes = {}
+        wildcard = []
+        for index, (_, route_pattern, _) in enumerate(self.url_map):
+            url_pattern = route_pattern.url_pattern
+            if '<' not in url_pattern:
+                static.setdefault(url_pattern, []).append(index)
+                continue
+            first = url_pattern.lstrip('/').split('/', 1)[0]
+            if first and first[0] != '<':
+                prefixes.setdefault(first, []).append(index)
+            else:
+                wildcard.append(index)
+
+        def routes(indexes):
+            return tuple(self.url_map[index] for index in sorted(indexes))
+
+        dynamic = {first: routes(indexes + wildcard)
+                   for first, indexes in prefixes.items()}
+        paths = {path: routes(indexes + prefixes.get(
+                     path.lstrip('/').split('/', 1)[0], []) + wildcard)
+                 for path, indexes in static.items()}
+        self.route_index = (len(self.url_map), paths, dynamic,
+                            routes(wildcard))
+
+    def find_routes(self, path):
+        """Return the routes of the URL map that can match the given path,
+        in registration order."""
+        if self.route_index is None or \
+                self.route_index[0] != len(self.url_map):
+            self.build_route_index()
+        _, paths, dynamic, wildcard = self.route_index
+        routes = paths.get(path)
+        if routes is not None:
+            return routes
+        first = path[1:].split('/', 1)[0] if path[:1] == '/' else None
+        return dynamic.get(first, wildcard)
+
     def find_route(self, req):
         method = req.method.upper()
         if method == 'OPTIONS' and self.options_handler:
@@ -1303,7 +1455,8 @@ class Microdot:
         if method == 'HEAD':
             method = 'GET'
         f = 404
-        for route_methods, route_pattern, route_handler in self.url_map:
+        for route_methods, route_pattern, route_handler in \
+                self.find_routes(req.path):
             req.url_args = route_pattern.match(req.path)
             if req.url_args is not None:
                 if method in route_methods:
@@ -1315,7 +1468,8 @@ class Microdot:
 
     def default_options_handler(self, req):
         allow = []
-        for route_methods, route_pattern, route_handler in self.url_map:
+        for route_methods, route_pattern, route_handler in \
+                self.find_routes(req.path):
             if route_pattern.match(req.path) is not None:
                 allow.extend(route_methods)
         if 'GET' in allow:
@@ -1323,28 +1477,104 @@ class Microdot:
         allow.append('OPTIONS')
         return {'Allow': ', '.join(allow)}
 
+    def keep_alive(self, req, requests):
+        """Decide if the connection is kept open after the response to
+        ``req``, which is the ``requests``-th request on the connection."""
+        if req is None or requests >= self.max_keep_alive_requests or \
+                self.connections >= self.max_connections:
+            return False
+        connection = req.headers.get('Connection', '').lower()
+        if req.http_version == '1.1':
+            if connection == 'close':
+                return False
+        elif connection != 'keep-alive':
+            return False
+        # an unread request body would be parsed as the next request
+        return req.content_length <= req.max_body_length and \
+            req.content_length <= req.max_content_length
+
     async def handle_request(self, reader, writer):
-        req = None
-        try:
-            req = await Request.create(self, reader, writer,
-                                       writer.get_extra_info('peername'))
-        except Exception as exc:  # pragma: no cover
-            print_exception(exc)
-
-        res = await self.dispatch_request(req)
-        if res != Response.already_handled:  # pragma: no branch
-            await res.write(writer)
+        if self.connections >= self.max_connections:
+            try:
+                await writer.awrite(b'HTTP/1.0 503 Service Unavailable\r\n'
+                                    b'Retry-After: 1\r\n'
+                                    b'Content-Length: 0\r\n\r\n')
+                await writer.aclose()
+            except OSError as exc:  # pragma: no cover
+                if exc.errno not in MUTED_SOCKET_ERRORS:
+                    raise
+            return
+
+        self.connections += 1
+        requests = 0
+        buffer = None
         try:
-            await writer.aclose()
-        except OSError as exc:  # pragma: no cover
-            if exc.errno in MUTED_SOCKET_ERRORS:
-                pass
-            else:
-                raise
-        if self.debug and req:  # pragma: no cover
-            print('{method} {path} {status_code}'.format(
-                method=req.method, path=req.path,
-                status_code=res.status_code))
+            while True:
+                req = None
+                try:
+                    if requests:
+                        req = await asyncio.wait_for(
+                            Request.create(self, reader, writer,
+                                           writer.get_extra_info('peername')),
+                            self.keep_alive_timeout)
+                    else:
+                        req = await Request.create(
+                            self, reader, writer,
+                            writer.get_extra_info('peername'))
+                except asyncio.TimeoutError:
+                    break
+                except Exception as exc:  # pragma: no cover
+                    print_exception(exc)
+                if req is None and requests:
+                    # client closed the idle connection
+                    break
+                requests += 1
+
+                res = await self.dispatch_request(req)
+                if res == Response.already_handled:  # pragma: no cover
+                    break
+                if req:
+                    res.http_version = '1.1' if req.http_version == '1.1' \
+                        else '1.0'
+                res.keep_alive = self.keep_alive(req, requests)
+                if buffer is None:
+                    buffer = WriteBuffer(writer, res.write_buffer_size)
+                streaming = res.headers.get('Content-Type') == \
+                    'text/event-stream'
+                if streaming and self.streams >= self.max_streams:
+                    if hasattr(res.body, 'aclose'):  # pragma: no branch
+                        await res.body.aclose()
+                    http_version = res.http_version
+                    res = Response(status_code=503,
+                                   headers={'Retry-After': '1'},
+                                   reason='Service Unavailable')
+                    res.http_version = http_version
+                    res.keep_alive = streaming = False
+                if streaming:
+                    # the stream moves from the connection pool to its own
+                    self.connections -= 1
+                    self.streams += 1
+                try:
+                    await res.write(writer, buffer)
+                finally:
+                    if streaming:
+                        self.streams -= 1
+                        self.connections += 1
+                if self.debug and req:  # pragma: no cover
+                    print('{method} {path} {status_code}'.format(
+                        method=req.method, path=req.path,
+                        status_code=res.status_code))
+                if not res.keep_alive:
+                    break
+        finally:
+            self.connections -= 1
+            try:
+                await writer.aclose()
+            except OSError as exc:  # pragma: no cover
+                if exc.errno in MUTED_SOCKET_ERRORS:
+                    pass
+                else:
+                    raise
 
     async def dispatch_request(self, req):
         after_request_handled = False
@@ -0,0 +1,89 @@
+ALL_WEEKDAYS = [0, 1, 2, 3, 4, 5, 6]
+
+
+def parse_time(value):
+    return int(value.split(":")[0]) * 60 * 60 + int(value.split(":")[1]) * 60
+
+
+# Keeps mcron in sync with the dose schedule by diffing: jobs are keyed by pump and job content,
+# a schedule update removes and inserts only the jobs that changed.
+class ScheduleManager:
+    def __init__(self, mcron, callback, prefix="mcron_"):
+        self.mcron = mcron
+        # mcron callback(callback_id, current_time, callback_memory)
+        self.callback = callback
+        self.prefix = prefix
+        # {<job key>: <mcron callback id>}
+        self.jobs = {}
+        # {<mcron callback id>: (pump id, duration, direction, amount, weekdays)}
+        self.params = {}
+        # Callback ids are never reused, a fired job of the old schedule can't run the new job's dose
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.jobs)
+
+    @staticmethod
+    def job_key(pump, job):
+        return (pump, job['amount'], job['duration'], job['start_time'], job['end_time'], job['frequency'],
+                job['dir'], tuple(job.get("weekdays", ALL_WEEKDAYS)))
+
+    def insert(self, pump, job):
+        id = pump[-1]
+        amount = job['amount']
+        duration = job['duration']
+        frequency = job['frequency']
+        direction = job['dir']
+        weekdays = job.get("weekdays", ALL_WEEKDAYS)
+
+        dir_string = "Clockwise" if direction else "Counterclockwise"
+        print(f"[pump{id}] {amount}ml/{duration}sec {job['start_time']}-{job['end_time']} for {frequency} times {dir_string}")
+        print(f"Desired flow: {round(amount * (60 / duration), 2)}")
+
+        start_time = parse_time(job['start_time'])
+        if job['end_time']:
+            end_time = parse_time(job['end_time'])
+            step = (end_time - start_time) // frequency
+        else:
+            end_time = self.mcron.PERIOD_DAY
+            step = end_time // frequency
+
+        callback_id = f'{self.prefix}{self.counter}'
+        self.counter += 1
+        self.mcron.insert(self.mcron.PERIOD_DAY, range(start_time, end_time, step), callback_id, self.callback)
+        self.params[callback_id] = (id, duration, direction, amount, weekdays)
+        return callback_id
+
+    def remove(self, key):
+        callback_id = self.jobs.pop(key)
+        self.mcron.remove(callback_id)
+        self.params.pop(callback_id, None)
+
+    def update(self, data):
+        """
+        Apply the new schedule {<pump>: [<job>, ...]}, returns the number of inserted and removed jobs.
+        """
+        desired = {}
+        for pump in data:
+            for job in data[pump]:
+                key = self.job_key(pump, job)
+                # Identical jobs of a pump are separate doses
+                while key in desired:
+                    key = key + ("duplicate",)
+                desired[key] = (pump, job)
+
+        removed = [key for key in self.jobs if key not in desired]
+        for key in removed:
+            self.remove(key)
+        inserted = 0
+        for key, (pump, job) in desired.items():
+            if key not in self.jobs:
+                print(f"Add job for {pump}")
+                self.jobs[key] = self.insert(pump, job)
+                inserted += 1
+        print(f"Schedule updated, {inserted} jobs added, {len(removed)} removed, {len(self.jobs)} total")
+        return inserted, len(removed)
+
+    def remove_all(self):
+        for key in list(self.jobs):
+            self.remove(key)
@@ -1,17 +1,82 @@
 import struct
+try:
+    import uasyncio as asyncio
+    MICROPYTHON = True
+except ImportError:
+    import asyncio
+    MICROPYTHON = False
+
+
+# Verbose UART framing logs, printing over USB console is slow on ESP32
+DEBUG = False
+
+# MKS-Servo42C UART commands
+CMD_READ_ENCODER = 48  # b'\x30'
+CMD_READ_PULSES = 51  # b'\x33'
+CMD_SET_CURRENT = 131  # b'\x83'
+CMD_SET_MSTEP = 132  # b'\x84'
+CMD_MOVE = 246  # b'\xf6'
+CMD_STOP = 247  # b'\xf7'
+CMD_MAKE_STEPS = 253  # b'\xfd'
+
+
+def set_debug(enabled):
+    global DEBUG
+    DEBUG = enabled
 
 
 def calc_crc(*args):
     summ = 0
-    #print(args)
     for register in args:
-        print(int(register).to_bytes(1, 'big'), end=' ')
         summ += register
     crc = summ & 0xFF
-    #print(f"{int(crc).to_bytes(1, 'big')}")
+    if DEBUG:
+        print(f"crc {args} = {crc}")
     return crc
 
 
+def frame_crc(frame, length):
+    # Checksum of the first length bytes, written in place right after them
+    crc = 0
+    for i in range(length):
+        crc += frame[i]
+    frame[length] = crc & 0xFF
+
+
+# Preallocated command frames per driver, hot-path framing does no heap allocation
+class FrameEncoder:
+    def __init__(self, addr):
+        self.short_frame = bytearray([addr, 0, 0])
+        self.byte_frame = bytearray([addr, 0, 0, 0])
+        self.steps_frame = bytearray([addr, CMD_MAKE_STEPS, 0, 0, 0, 0, 0, 0])
+        self.short_view = memoryview(self.short_frame)
+        self.byte_view = memoryview(self.byte_frame)
+        self.steps_view = memoryview(self.steps_frame)
+
+    def command(self, cmd):
+        frame = self.short_view
+        frame[1] = cmd
+        frame_crc(frame, 2)
+        return self.short_frame
+
+    def command_byte(self, cmd, value):
+        frame = self.byte_view
+        frame[1] = cmd
+        frame[2] = value
+        frame_crc(frame, 3)
+        return self.byte_frame
+
+    def make_steps(self, speed_reg, steps):
+        frame = self.steps_view
+        frame[2] = speed_reg
+        frame[3] = (steps >> 24) & 0xFF
+        frame[4] = (steps >> 16) & 0xFF
+        frame[5] = (steps >> 8) & 0xFF
+        frame[6] = steps & 0xFF
+        frame_crc(frame, 7)
+        return self.steps_frame
+
+
 def calc_steps(mks, rpm, mstep, timeout):
     steps_per_cycle = mks.step_per_rev*mstep
     steps_per_minute = steps_per_cycle * rpm
@@ -19,8 +84,69 @@ def calc_steps(mks, rpm, mstep, timeout):
     return int(steps_per_timeout)
 
 
+# Non-blocking UART transport, awaits exact reply length instead of waiting for the UART timeout.
+# All drivers on one UART share the stream, the lock keeps a command and its reply together.
+class UartStream:
+    def __init__(self, uart):
+        self.uart = uart
+        # PC debugging works with mocked UART without stream support
+        self.stream = asyncio.StreamReader(uart) if MICROPYTHON else None
+        self.lock = asyncio.Lock()
+
+    def flush(self):
+        if self.stream:
+            pending = self.uart.any()
+            if pending:
+                self.uart.read(pending)
+
+    async def write(self, data):
+        if self.stream:
+            self.stream.write(data)
+            await self.stream.drain()
+        else:
+            self.uart.write(data)
+
+    async def read(self, size, timeout):
+        if not self.stream:
+            return self.uart.read(size)
+        try:
+            return await asyncio.wait_for(self.stream.readexactly(size), timeout)
+        except asyncio.TimeoutError:
+            print(f"UART reply timeout, expected {size} bytes")
+            return None
+
+    async def transact(self, data, size, timeout):
+        async with self.lock:
+            self.flush()
+            await self.write(data)
+            return await self.read(size, timeout)
+
+
+# {id(uart): UartStream}
+uart_streams = {}
+
+
+def uart_stream(uart):
+    stream = uart_streams.get(id(uart))
+    if stream is None or stream.uart is not uart:
+        stream = UartStream(uart)
+        uart_streams[id(uart)] = stream
+    return stream
+
+
+# Blocking calls of the driver outside of the event loop: boot, REPL and on-device tests
+def run_sync(coro):
+    return asyncio.run(coro)
+
+
+# MKS-Servo42C driver. Commands are async, the event loop keeps running while the driver replies.
+# Blocking methods without the "a" prefix are thin wrappers for code that runs outside of the event loop.
+# The constructor doesn't talk to the driver, ainit()/init() writes the configured mstep.
 class Servo42c:
-    def __init__(self, uart, addr: int, speed=1, mstep=999, direction=0, step_per_rev=200):
+    REPLY_SIZE = 3
+    TIMEOUT = 0.1
+
+    def __init__(self, uart, addr: int, speed=1, mstep=999, direction=0, step_per_rev=200, timeout=TIMEOUT):
         self.sec_in_pulse = None
         self.rpm = None
         self.speed_reg = None
@@ -32,104 +158,19 @@ class Servo42c:
         self.step_per_rev = step_per_rev  # Steps per revolution. Angle 1.8 = 200, 0.9 = 400
         reply_crc = calc_crc(self.addr, 1)
         self.reply_pattern = bytes([self.addr, 1, reply_crc])
+        self.frames = FrameEncoder(self.addr)
+        self.timeout = timeout
+        self.stream = uart_stream(uart)
+        self.set_speed(speed, self.dir)
 
+    async def ainit(self):
         # Skip setting mstep on init if not set
         if self.mstep <= 256:
-            self.set_mstep(mstep, force=True, retry=1)
-
-        self.set_speed(speed, self.dir)
+            await self.aset_mstep(self.mstep, force=True, retry=1)
         self.flush()
 
-    def set_mstep(self, mstep, force=False, retry=5):
-        print(f"Old mstep: {self.mstep} New mstep: {mstep}")
-        if self.mstep != mstep or force:
-            for _ in range(5):
-                if self.stop():
-                    break
-
-            print(f"\nWrite new mstep: {mstep}")
-            crc = calc_crc(self.addr, 132, mstep)
-            cmd = bytes([self.addr, 132, mstep, crc])
-            self.flush()
-            self.uart.write(cmd)
-
-            for retry_count in range(1, retry+1):
-                reply = self.uart.read()
-                print(reply)
-
-                if reply == self.reply_pattern:
-                    print("Setting up Mstep success")
-                    self.mstep = mstep
-                    return True
-                else:
-                    print(f"Mstep reply invalid, retry No {retry_count}")
-
-            print("Setting up Mstep failed after multiple retries.")
-            return False
-
-        else:
-            print("Skip setting up mstep")
-            return True
-
-    def set_mstep_proxy(self, mstep):
-        self.set_mstep(mstep)
-
-    def write(self, register: int):
-        self.uart.write(register.to_bytes(1, 'big'))
-
     def flush(self):
-        self.uart.read()
-
-    def read(self, *uart_formats, check_crc=False, debug=False):
-        # https://docs.python.org/3/library/struct.html
-        data = []
-
-        for size, data_format in uart_formats:
-            raw_data = self.uart.read(size)
-            if debug:
-                print(f"Read {size} bytes: [{raw_data}]")
-            try:
-                value = struct.unpack('>' + data_format, raw_data)[0]
-            except TypeError:
-                print(f"Failed to unpack data [{raw_data}] with format {data_format}")
-                return False
-            print(f"raw_data: {raw_data} value: {value}")
-            data.append(value)
-
-        if check_crc and calc_crc(*data[:-1]) == data[-1]:
-            return data
-        elif check_crc:
-            return False
-        else:
-            return data
-
-    def read_raw(self):
-        return self.uart.read()
-
-    def read_encoder(self, debug=False):
-        self.flush()
-        crc = calc_crc(self.addr, 48)
-        cmd = bytes([self.addr, 48, crc]) # 48 = b'\x30' - read encoder
-        self.uart.write(cmd)
-        address, carry, value, crc = self.read((1, 'B'), (4, 'i'), (2, 'H'), (1, 'B'), debug=debug)
-        if address == self.addr:
-            return carry, value
-        else:
-            return False
-
-    def read_pulses(self):
-        crc = calc_crc(self.addr, 51)
-        self.flush()
-        cmd = bytes([self.addr, 51, crc])  # b'\x33' - read number of pulses
-        self.uart.write(cmd)
-        print("crc", crc)
-
-        address, pulses, crc = self.read((1, 'B'), (4, 'i'), (1, 'B'))
-        if address == self.addr:
-            return pulses
-        else:
-            print("crc missmatch")
-            return None
+        self.stream.flush()
 
     def set_speed(self, speed, direction):
         # Ensure speed is within the valid range (0 to 127)
@@ -138,15 +179,9 @@ class Servo42c:
         self.dir = 1 if direction else 0
 
         self.rpm = self.calc_rpm(speed)
-        self.sec_in_pulse = 60 / (self.mstep * 200 * self.rpm)
+        self.sec_in_pulse = 60 / (self.mstep * self.step_per_rev * self.rpm)
         self.speed_reg = self.calc_speed_reg()
 
-    def set_current(self, current: int):
-        current = max(200, min(current, 3000))
-        crc = calc_crc(self.addr, 131, current//200)
-        cmd = bytes([self.addr, 131, current//200, crc])  # b'\x83' -set current
-        self.uart.write(cmd)
-
     def calc_rpm(self, speed):
         return (speed * 30000) / (self.mstep * self.step_per_rev)
 
@@ -157,47 +192,113 @@ class Servo42c:
         # Combine direction and speed bits to form the 8-bit register value
         return (self.dir << 7) | self.speed
 
-    def stop(self,):
-        self.flush()
-        crc = calc_crc(self.addr, 247)
-        cmd = bytes([self.addr, 247, crc])
-        self.uart.write(cmd)
-        status = self.read_raw()
-        print("[STOP] got status :", status)
-        if status and self.reply_pattern in status:
+    async def acommand(self, cmd, reply_size=REPLY_SIZE, timeout=None):
+        return await self.stream.transact(cmd, reply_size, timeout or self.timeout)
+
+    async def astop(self):
+        status = await self.acommand(self.frames.command(CMD_STOP))
+        if DEBUG:
+            print("[STOP] got status :", status)
+        return status == self.reply_pattern
+
+    async def aset_mstep(self, mstep, force=False, retry=5):
+        if DEBUG:
+            print(f"Old mstep: {self.mstep} New mstep: {mstep}")
+        if self.mstep == mstep and not force:
+            if DEBUG:
+                print("Skip setting up mstep")
             return True
-        else:
-            return False
 
-    def move(self, speed, direction):
-        self.set_speed(speed, direction)
-        crc = calc_crc(self.addr, 246, self.speed_reg)
-        cmd = bytes([self.addr, 246, self.speed_reg, crc])  # b'\xf6' -move forward
-        self.uart.write(cmd)
+        for _ in range(5):
+            if await self.astop():
+                break
 
-    def make_steps(self, steps, speed, direction, stop=True):
-        self.set_speed(speed, direction)
-        print(f"Make {steps} steps on speed {speed}, rpm {self.rpm}")
+        if DEBUG:
+            print(f"\nWrite new mstep: {mstep}")
+        stream = self.stream
+        async with stream.lock:
+            stream.flush()
+            await stream.write(self.frames.command_byte(CMD_SET_MSTEP, mstep))
+            for retry_count in range(1, retry + 1):
+                reply = await stream.read(self.REPLY_SIZE, self.timeout)
+                if reply == self.reply_pattern:
+                    if DEBUG:
+                        print("Setting up Mstep success")
+                    self.mstep = mstep
+                    return True
+                if DEBUG:
+                    print(f"Mstep reply invalid, retry No {retry_count}")
 
-        pulses_reg = [x for x in steps.to_bytes(4, 'big')]
-        crc = calc_crc(self.addr, 253, self.speed_reg, *pulses_reg)
-        if stop:
-            self.stop()
+        print("Setting up Mstep failed after multiple retries.")
+        return False
 
-        # Create a list of bytes to be sent
-        bytes_to_send = [self.addr, 253, self.speed_reg] + pulses_reg + [crc]
+    async def aset_current(self, current: int):
+        current = max(200, min(current, 3000))
+        return await self.acommand(self.frames.command_byte(CMD_SET_CURRENT, current // 200)) == self.reply_pattern
 
-        # Convert the list to a bytes object
-        data = bytes(bytes_to_send)
+    async def amove(self, speed, direction):
+        self.set_speed(speed, direction)
+        return await self.acommand(self.frames.command_byte(CMD_MOVE, self.speed_reg)) == self.reply_pattern
 
-        # Write the entire bytes object in one command
-        self.uart.write(data)
+    async def amake_steps(self, steps, speed, direction, stop=True):
+        self.set_speed(speed, direction)
+        if DEBUG:
+            print(f"Make {steps} steps on speed {speed}, rpm {self.rpm}")
+        if stop:
+            await self.astop()
 
-        reply = self.read_raw()
-        if reply and self.reply_pattern in reply:
-            print("Command success")
+        if await self.acommand(self.frames.make_steps(self.speed_reg, steps)) == self.reply_pattern:
             worktime = steps * self.sec_in_pulse
-            print(f"Run for {worktime}sec")
+            if DEBUG:
+                print(f"Command success, run for {worktime}sec")
             return worktime
         else:
             return False
+
+    async def aread(self, cmd, *uart_formats, debug=False):
+        # https://docs.python.org/3/library/struct.html
+        size = sum(fmt_size for fmt_size, _ in uart_formats)
+        raw_data = await self.acommand(cmd, size)
+        if debug or DEBUG:
+            print(f"Read {size} bytes: [{raw_data}]")
+        if not raw_data or len(raw_data) != size:
+            return False
+        return struct.unpack('>' + ''.join(data_format for _, data_format in uart_formats), raw_data)
+
+    async def aread_encoder(self, debug=False):
+        data = await self.aread(self.frames.command(CMD_READ_ENCODER), (1, 'B'), (4, 'i'), (2, 'H'), (1, 'B'),
+                                debug=debug)
+        if data and data[0] == self.addr:
+            return data[1], data[2]
+        return False
+
+    async def aread_pulses(self):
+        data = await self.aread(self.frames.command(CMD_READ_PULSES), (1, 'B'), (4, 'i'), (1, 'B'))
+        if data and data[0] == self.addr:
+            return data[1]
+        print("crc missmatch")
+        return None
+
+    def init(self):
+        return run_sync(self.ainit())
+
+    def stop(self):
+        return run_sync(self.astop())
+
+    def set_mstep(self, mstep, force=False, retry=5):
+        return run_sync(self.aset_mstep(mstep, force, retry))
+
+    def set_current(self, current: int):
+        return run_sync(self.aset_current(current))
+
+    def move(self, speed, direction):
+        return run_sync(self.amove(speed, direction))
+
+    def make_steps(self, steps, speed, direction, stop=True):
+        return run_sync(self.amake_steps(steps, speed, direction, stop))
+
+    def read_encoder(self, debug=False):
+        return run_sync(self.aread_encoder(debug))
+
+    def read_pulses(self):
+        return run_sync(self.aread_pulses())
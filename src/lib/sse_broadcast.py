@@ -0,0 +1,78 @@
+import json
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio as asyncio
+
+KEEPALIVE = b": keep-alive\n\n"
+
+
+# Encode an event the same way lib/microdot/sse.SSE.send does
+def encode_event(data, event=None):
+    if isinstance(data, (dict, list)):
+        data = json.dumps(data).encode()
+    elif isinstance(data, str):
+        data = data.encode()
+    elif not isinstance(data, bytes):
+        data = str(data).encode()
+    data = b'data: ' + data + b'\n\n'
+    if event:
+        data = b'event: ' + event.encode() + b'\n' + data
+    return data
+
+
+# One producer encodes an event once and fans it out to the queues of all connected lib/microdot/sse.SSE clients.
+# Client queues are bounded, a slow client loses its oldest events instead of growing the heap.
+# Events that are deltas can't be dropped one by one, with resync the whole queue of a slow client is
+# replaced by a fresh full state.
+class Broadcaster:
+    def __init__(self, queue_size=8, keepalive=15, resync=None):
+        """
+        resync: function returning the full state, sent instead of the queued events on overflow
+        """
+        self.queue_size = queue_size
+        self.keepalive = keepalive
+        self.resync = resync
+        self.clients = []
+        self.sent = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.clients)
+
+    def push(self, sse, data):
+        queue = sse.queue
+        if len(queue) >= self.queue_size and self.resync is not None:
+            # The snapshot already has the changes of the dropped events and of this one
+            self.dropped += len(queue)
+            queue.clear()
+            data = encode_event(self.resync())
+        while len(queue) >= self.queue_size:
+            queue.pop(0)
+            self.dropped += 1
+        queue.append(data)
+        sse.event.set()
+
+    def publish(self, data, event=None):
+        data = encode_event(data, event)
+        for sse in self.clients:
+            self.push(sse, data)
+        self.sent += 1
+
+    # Keeps the connection open until the client goes away, the SSE task is cancelled on disconnect
+    async def serve(self, sse, initial=None):
+        self.clients.append(sse)
+        print(f"SSE client connected, clients: {len(self.clients)}")
+        try:
+            if initial is not None:
+                self.push(sse, encode_event(initial))
+            while True:
+                await asyncio.sleep(self.keepalive)
+                if not sse.queue:
+                    self.push(sse, KEEPALIVE)
+        finally:
+            self.clients.remove(sse)
+            print(f"SSE client disconnected, clients: {len(self.clients)}")
+
+    def metrics(self):
+        return {"clients": len(self.clients), "sent": self.sent, "dropped": self.dropped}
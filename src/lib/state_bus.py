@@ -0,0 +1,97 @@
+import json
+from lib.checksum import crc32
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio as asyncio
+
+
+# Change notification bus for the state shown on the web pages.
+# Every section (storage, schedule, ...) has a version, a mutation calls notify() which bumps it and wakes
+# all subscribers. Section JSON is encoded once per version and shared by all SSE clients.
+class StateBus:
+    def __init__(self, sections):
+        # {<section name>: <function returning the current section value>}
+        self.sections = sections
+        self.versions = {name: 0 for name in sections}
+        self.version = 0
+        self.event = asyncio.Event()
+        # {<section name>: (version, encoded json)}
+        self.encoded = {}
+        self.snapshot_cache = (-1, None)
+        self.etag_cache = (-1, None)
+        self.delta_cache = (None, None)
+
+    def notify(self, *names):
+        for name in names:
+            self.versions[name] += 1
+        self.version += 1
+        # Wake every subscriber waiting on the current event, new waiters get a fresh one
+        event = self.event
+        self.event = asyncio.Event()
+        event.set()
+
+    def encode(self, name):
+        version = self.versions[name]
+        cached = self.encoded.get(name)
+        if cached is None or cached[0] != version:
+            cached = (version, json.dumps(self.sections[name]()))
+            self.encoded[name] = cached
+        return cached[1]
+
+    def join(self, names):
+        return "{" + ", ".join(f'"{name}": {self.encode(name)}' for name in names) + "}"
+
+    def snapshot(self):
+        if self.snapshot_cache[0] != self.version:
+            self.snapshot_cache = (self.version, self.join(self.sections))
+        return self.snapshot_cache[1]
+
+    # Content hash of the snapshot, versions start from 0 again after a reboot with other settings
+    def etag(self):
+        if self.etag_cache[0] != self.version:
+            self.etag_cache = (self.version, '"%08x"' % crc32(self.snapshot().encode()))
+        return self.etag_cache[1]
+
+    # Sections changed since the versions seen by a subscriber
+    def changed(self, seen):
+        return [name for name in self.sections if seen.get(name) != self.versions[name]]
+
+    async def wait(self, version, debounce=0.2):
+        while self.version == version:
+            await self.event.wait()
+        # Coalesce a burst of mutations into one event
+        if debounce:
+            await asyncio.sleep(debounce)
+
+    def delta(self, names):
+        key = (self.version, tuple(names))
+        if self.delta_cache[0] != key:
+            self.delta_cache = (key, self.join(names))
+        return self.delta_cache[1]
+
+    def subscribe(self, debounce=0.2):
+        return Subscription(self, debounce)
+
+
+# Subscriber gets the full snapshot first, then a delta with the changed sections only after every notify()
+class Subscription:
+    def __init__(self, bus, debounce=0.2):
+        self.bus = bus
+        self.debounce = debounce
+        self.seen = None
+        self.version = -1
+
+    async def next(self):
+        bus = self.bus
+        if self.seen is None:
+            self.seen = dict(bus.versions)
+            self.version = bus.version
+            return bus.snapshot()
+        while True:
+            await bus.wait(self.version, self.debounce)
+            self.version = bus.version
+            names = bus.changed(self.seen)
+            self.seen = dict(bus.versions)
+            if names:
+                return bus.delta(names)
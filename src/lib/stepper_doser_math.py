@@ -1,12 +1,19 @@
 import os
+import struct
+from lib.checksum import crc32
 try:
     # Micropython Ulab
     from ulab import numpy as np
-    from lib.servo42c import calc_steps
+    from lib.servo42c import calc_steps, run_sync
 except:
-    from lib.servo42c import calc_steps
+    from lib.servo42c import calc_steps, run_sync
     import numpy as np
     np.float = np.float32
+try:
+    # Micropython dict doesn't keep the insertion order
+    from ucollections import OrderedDict
+except ImportError:
+    from collections import OrderedDict
 
 
 MIN_MSTEP = 1
@@ -23,6 +30,15 @@ RPM_TOLERANCE = 0.05
 # Define the scale factor
 SCALE_FACTOR = 2 ** 5
 
+# Variable-resolution RPM grid: (start, stop, step) for every segment
+RPM_GRID = (
+    (0, MAX_RPM // 250, RPM_STEP / 2),
+    (MAX_RPM // 250, MAX_RPM // 100, RPM_STEP),
+    (MAX_RPM // 100, MAX_RPM // 10, RPM_STEP * 2),
+    (MAX_RPM // 10, MAX_RPM // 4, RPM_STEP * 3),
+    (MAX_RPM // 4, MAX_RPM, RPM_STEP * 4),
+)
+
 
 def file_or_dir_exists(filename):
     try:
@@ -38,137 +54,269 @@ def calc_real_rpm(mstep, speed):
     return (speed * 30000) / (mstep * STEPS_PER_REVOLUTION)
 
 
-# Generate buffer with RPM at MSTEP & Speed combinations
-def make_rpm_table(regenerate=False, validate=False):
-    print("Start generating rpm table")
-
-    def crc8_8_atm(msg):
-        crc = 0xFF
-        for byte in msg:
-            crc ^= byte
-            for _ in range(8):
-                crc = (crc << 1) ^ 0x07 if crc & 0x80 else crc << 1
-            crc &= 0xff
-        return crc ^ 0x00
-
-    def validate_constants_checksum(filename="constants.crc"):
-        if not file_or_dir_exists(filename):
-            print(f"Missing files for {filename}")
-            raise FileNotFoundError()
-        with open(filename, "r") as read_file:
-            stored_checksum = int(read_file.read())
-        if stored_checksum != constants_checksum:
-            print(f"crc mismach {stored_checksum}!={constants_checksum}")
-            raise ValueError("Constants validation failed")
-
-    def save_with_checksum(filename, array):
-        np.save(filename, array)
-        data = array.tobytes()
-        checksum = crc8_8_atm(data)
-        with open(f"{filename}.crc", "w") as write_file:
-            write_file.write(str(checksum))
-
-    def load_with_checksum(filename):
-        # Check if the data file and its checksum file exist
-        if not file_or_dir_exists(filename) or not file_or_dir_exists(f"{filename}.crc"):
-            raise FileNotFoundError(f"Missing files for {filename}")
-
-        array = np.load(filename)
-
-        if validate:
-            print(f"Validate {filename}.crc")
-            # Load and validate checksum
-            with open(f"{filename}.crc", "r") as read_file:
-                stored_checksum = int(read_file.read())
-            data = array.tobytes()
-            checksum = crc8_8_atm(data)
-
-            if checksum != stored_checksum:
-                raise ValueError(f"Data validation failed for {filename}")
+# Custom RPM steps array with varying resolutions
+def make_rpm_steps():
+    return np.concatenate(tuple(np.arange(start, stop, step, dtype=np.float) for start, stop, step in RPM_GRID))
+
+
+# Index of the nearest grid step for every rpm in the array.
+# Segments are uniform, so the bucket is computed arithmetically instead of scanning the whole grid,
+# then the neighbours are compared to keep the first-minimum rule of np.argmin.
+def bucket_rpm(rpms, rpm_steps):
+    last = len(rpm_steps) - 2
+    index = np.zeros(len(rpms), dtype=np.float)
+    offset = 0
+    for start, stop, step in RPM_GRID:
+        index = np.where(rpms >= start, np.floor((rpms - start) / step) + offset, index)
+        offset += len(np.arange(start, stop, step, dtype=np.float))
+    index = np.array(np.minimum(np.maximum(index, 1), last), dtype=np.uint16)
+
+    nearest = index - 1
+    nearest_distance = abs(rpms - np.take(rpm_steps, nearest))
+    for shift in (0, 1):
+        distance = abs(rpms - np.take(rpm_steps, index + shift))
+        closer = distance < nearest_distance
+        nearest = np.where(closer, index + shift, nearest)
+        nearest_distance = np.where(closer, distance, nearest_distance)
+    return nearest, nearest_distance
+
+
+# Closest MSTEP & Speed combination for every RPM step
+def find_closest_combinations(rpm_steps):
+    # All Speed x MSTEP combinations at once, speed-major so ties resolve to the lowest speed
+    speeds = np.arange(SPEED_MIN, SPEED_NUM + 1).reshape((SPEED_NUM - SPEED_MIN + 1, 1))
+    msteps = np.arange(MIN_MSTEP, MSTEP_MAX + 1)
+    rpms = (speeds * 30000 / (msteps * STEPS_PER_REVOLUTION)).flatten()
+    speeds, msteps = (speeds + msteps * 0).flatten(), (msteps + speeds * 0).flatten()
+
+    in_range = rpms <= MAX_RPM
+    rpms = np.array(rpms[in_range], dtype=np.float)
+    speeds = speeds[in_range]
+    msteps = msteps[in_range]
+
+    nearest, distance = bucket_rpm(rpms, rpm_steps)
+
+    # Reduce candidates per bucket, the first closest combination wins
+    best_distance = [float("inf")] * len(rpm_steps)
+    best = [-1] * len(rpm_steps)
+    distance = distance.tolist()
+    for candidate, bucket in enumerate(nearest.tolist()):
+        if distance[candidate] < best_distance[bucket]:
+            best_distance[bucket] = distance[candidate]
+            best[bucket] = candidate
 
-        return array
+    # Filter out steps that didn't have any combinations
+    best = [candidate for candidate in best if candidate >= 0]
+    closest_rpms = np.array(np.take(rpms, best), dtype=np.float)
+    closest_msteps = np.array(np.take(msteps, best), dtype=np.uint8)
+    closest_speeds = np.array(np.take(speeds, best), dtype=np.uint8)
+    return closest_rpms, closest_msteps, closest_speeds
 
-    def calc_rpm(motor_mstep, motor_speed):
-        if motor_mstep == 0 and motor_speed == 0:
-            return 0
-        return (motor_speed * 30000) / (motor_mstep * STEPS_PER_REVOLUTION)
 
-    constants_checksum = crc8_8_atm(
-        "".join(map(str, [MIN_MSTEP, MSTEP_MAX, SPEED_MIN, SPEED_NUM, MAX_RPM, RPM_STEP])).encode())
+# Packed RPM table file: header, then interleaved (rpm float32, mstep uint8, speed uint8) records
+RPM_TABLE_FILE = "rpm_table.bin"
+RPM_TABLE_MAGIC = b"RPMT"
+# Magic, constants hash, records number, records crc32
+RPM_TABLE_HEADER = "<4sIHI"
+RPM_TABLE_HEADER_SIZE = struct.calcsize(RPM_TABLE_HEADER)
+RPM_TABLE_RECORD = "<fBB"
+RPM_TABLE_RECORD_SIZE = struct.calcsize(RPM_TABLE_RECORD)
+# Offset of the rpm, mstep and speed fields in the record, rpm is float32, mstep and speed are bytes
+RPM_TABLE_FIELD_OFFSETS = (0, 4, 5)
+# Table files of older firmware
+LEGACY_RPM_TABLE_FILES = ["closest_msteps.npy", "closest_msteps.npy.crc",
+                          "closest_speeds.npy", "closest_speeds.npy.crc",
+                          "closest_rpms.npy", "closest_rpms.npy.crc",
+                          "constants.crc"]
+
+
+def rpm_table_constants_hash():
+    return crc32("".join(map(str, [MIN_MSTEP, MSTEP_MAX, SPEED_MIN, SPEED_NUM, MAX_RPM, RPM_STEP])).encode())
+
+
+def save_rpm_table(table, filename=RPM_TABLE_FILE):
+    rpms, msteps, speeds = table
+    records = bytearray(len(rpms) * RPM_TABLE_RECORD_SIZE)
+    for index in range(len(rpms)):
+        struct.pack_into(RPM_TABLE_RECORD, records, index * RPM_TABLE_RECORD_SIZE,
+                         float(rpms[index]), int(msteps[index]), int(speeds[index]))
+    header = struct.pack(RPM_TABLE_HEADER, RPM_TABLE_MAGIC, rpm_table_constants_hash(), len(rpms),
+                         crc32(records))
+    with open(filename, "wb") as write_file:
+        write_file.write(header)
+        write_file.write(records)
+
+
+# Column view of RpmTable, indexed like the rpm/mstep/speed arrays
+class RpmTableColumn:
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, index):
+        return self.table.field(index, self.column)
+
+
+# RPM table backed by the packed file, without materialising rpm, mstep and speed arrays.
+# Records come from one bulk read, or with lazy=True are read from the file by offset on every access.
+class RpmTable:
+    def __init__(self, filename=RPM_TABLE_FILE, lazy=False, validate=False):
+        self.file = open(filename, "rb")
+        header = self.file.read(RPM_TABLE_HEADER_SIZE)
+        if len(header) != RPM_TABLE_HEADER_SIZE:
+            self.close()
+            raise ValueError(f"Truncated header in {filename}")
+        magic, constants_hash, self.length, checksum = struct.unpack(RPM_TABLE_HEADER, header)
+        if magic != RPM_TABLE_MAGIC or constants_hash != rpm_table_constants_hash():
+            self.close()
+            raise ValueError("Constants validation failed")
 
+        self.data = None
+        self.buffer = bytearray(RPM_TABLE_RECORD_SIZE)
+        # Buffers for a single rpm or mstep/speed field
+        self.field_buffers = (memoryview(self.buffer)[:4], memoryview(self.buffer)[:1], memoryview(self.buffer)[:1])
+        if not lazy or validate:
+            data = self.file.read(self.length * RPM_TABLE_RECORD_SIZE)
+            if len(data) != self.length * RPM_TABLE_RECORD_SIZE or validate and crc32(data) != checksum:
+                self.close()
+                raise ValueError(f"Data validation failed for {filename}")
+            if not lazy:
+                self.data = data
+                self.close()
+        self.columns = (RpmTableColumn(self, 0), RpmTableColumn(self, 1), RpmTableColumn(self, 2))
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def record(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("RPM table index out of range")
+        if self.data is not None:
+            return struct.unpack_from(RPM_TABLE_RECORD, self.data, index * RPM_TABLE_RECORD_SIZE)
+        self.file.seek(RPM_TABLE_HEADER_SIZE + index * RPM_TABLE_RECORD_SIZE)
+        self.file.readinto(self.buffer)
+        return struct.unpack(RPM_TABLE_RECORD, self.buffer)
+
+    def field(self, index, column):
+        """
+        One field of the record, the bisect over rpms doesn't unpack whole records into tuples.
+        """
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("RPM table index out of range")
+        offset = index * RPM_TABLE_RECORD_SIZE + RPM_TABLE_FIELD_OFFSETS[column]
+        if self.data is not None:
+            if column:
+                return self.data[offset]
+            return struct.unpack_from("<f", self.data, offset)[0]
+        self.file.seek(RPM_TABLE_HEADER_SIZE + offset)
+        self.file.readinto(self.field_buffers[column])
+        if column:
+            return self.buffer[0]
+        return struct.unpack_from("<f", self.buffer)[0]
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+# Generate buffer with RPM at MSTEP & Speed combinations.
+# Freshly generated table is saved and loaded back, callers always get RpmTable.
+def make_rpm_table(regenerate=False, validate=False, lazy=False):
     if not regenerate:
         try:
-            print("Load constants check sum")
-            validate_constants_checksum()
-            print("Load closest_msteps.npy")
-            closest_msteps = load_with_checksum('closest_msteps.npy')
-            print("Load closest_speeds.npy")
-            closest_speeds = load_with_checksum('closest_speeds.npy')
-            print("Load closest_rpms.npy")
-            closest_rpms = load_with_checksum('closest_rpms.npy')
+            print(f"Load {RPM_TABLE_FILE}")
+            table = RpmTable(RPM_TABLE_FILE, lazy=lazy, validate=validate)
             print("tables loaded from disk")
-            return closest_rpms, closest_msteps, closest_speeds
+            return table
         except Exception as e:
             print("Failed to load, calculate from sratch, ", e)
-    files = ["closest_msteps.npy", "closest_msteps.npy.crc",
-             "closest_speeds.npy", "closest_speeds.npy.crc",
-             "closest_rpms.npy", "closest_rpms.npy.crc",
-             "constants.crc"]
-    for file in files:
+
+    print("Start generating rpm table")
+    for file in LEGACY_RPM_TABLE_FILES + [RPM_TABLE_FILE]:
         if file_or_dir_exists(file):
             os.remove(file)
 
-    # Precompute RPM steps using NumPy for efficient calculations
-    # Create a custom RPM steps array with varying resolutions
-    rpm_steps = np.concatenate((
-        np.arange(0, MAX_RPM // 250, RPM_STEP/2, dtype=np.float),
-        np.arange(MAX_RPM // 250, MAX_RPM // 100, RPM_STEP, dtype=np.float),
-        np.arange(MAX_RPM // 100, MAX_RPM // 10, RPM_STEP * 2, dtype=np.float),
-        np.arange(MAX_RPM // 10, MAX_RPM // 4, RPM_STEP * 3, dtype=np.float),
-        np.arange(MAX_RPM // 4, MAX_RPM, RPM_STEP * 4, dtype=np.float),
-    ))
-
-    # Initialize arrays to store the closest combinations
-    closest_rpms = np.zeros(len(rpm_steps), dtype=np.float)
-    closest_msteps = np.zeros(len(rpm_steps), dtype=np.uint8)
-    closest_speeds = np.zeros(len(rpm_steps), dtype=np.uint8)
-    for speed in range(SPEED_MIN, SPEED_NUM + 1):
-        for mstep in range(MIN_MSTEP, MSTEP_MAX + 1):
-            rpm = calc_rpm(mstep, speed)
-
-            if rpm > MAX_RPM:
-                continue
-
-            # Find the nearest step index using NumPy operations for efficiency
-            nearest_step_index = np.argmin(abs(rpm_steps - rpm))
-
-            # Update if this combination is closer to the RPM step than the current closest
-            if closest_rpms[nearest_step_index] == 0 or abs(rpm - rpm_steps[nearest_step_index]) < abs(
-                    closest_rpms[nearest_step_index] - rpm_steps[nearest_step_index]):
-                closest_rpms[nearest_step_index] = rpm
-                closest_msteps[nearest_step_index] = mstep
-                closest_speeds[nearest_step_index] = speed
-
-    # Filter out steps that didn't have any combinations
-    valid_indices = closest_rpms != 0
-    closest_rpms = closest_rpms[valid_indices]
-    closest_msteps = closest_msteps[valid_indices]
-    closest_speeds = closest_speeds[valid_indices]
-
-    save_with_checksum('closest_msteps.npy', closest_msteps)
-    save_with_checksum('closest_speeds.npy', closest_speeds)
-    save_with_checksum('closest_rpms.npy', closest_rpms)
-
-    with open(f"constants.crc", "w") as f:
-        f.write(str(constants_checksum))
+    rpm_steps = make_rpm_steps()
+    table = find_closest_combinations(rpm_steps)
+    save_rpm_table(table)
+    del table
+    return RpmTable(RPM_TABLE_FILE, lazy=lazy)
+
+
+# Small LRU of recent target RPM lookups, scheduled jobs hit the same RPMs all day
+class CombinationCache:
+    def __init__(self, size=16):
+        self.size = size
+        # Least recently used first, a hit is moved to the end by popping and inserting it again
+        self.values = OrderedDict()
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, key):
+        value = self.values.pop(key, None)
+        if value is not None:
+            self.values[key] = value
+        return value
+
+    def put(self, key, value):
+        if self.values.pop(key, None) is None and len(self.values) >= self.size:
+            del self.values[next(iter(self.values))]
+        self.values[key] = value
+
+    def clear(self):
+        self.values = OrderedDict()
+
+
+def find_closest_index(target_rpm, rpms):
+    # Bisect the sorted RPM table, no temporary arrays allocated, RpmTable probes read only the rpm field
+    low = 0
+    high = len(rpms)
+    while low < high:
+        middle = (low + high) // 2
+        if rpms[middle] < target_rpm:
+            low = middle + 1
+        else:
+            high = middle
+    if low == 0:
+        return 0
+    if low == len(rpms):
+        return low - 1
+    # On a tie the lower RPM wins, same as np.argmin
+    if abs(rpms[low - 1] - target_rpm) <= abs(rpms[low] - target_rpm):
+        return low - 1
+    return low
 
-    return closest_rpms, closest_msteps, closest_speeds
 
+def find_combination(target_rpm, filtered_values, cache=None):
+    target_rpm = to_float(target_rpm)
+    if cache is not None:
+        combination = cache.get(target_rpm)
+        if combination is not None:
+            return combination
 
-def find_combination(target_rpm, filtered_values):
     # Find the index of the closest RPM to the target RPM
-    closest_index = np.argmin(abs(filtered_values[0] - target_rpm))
-    return filtered_values[0][closest_index], filtered_values[1][closest_index], filtered_values[2][closest_index]
+    closest_index = find_closest_index(target_rpm, filtered_values[0])
+    if isinstance(filtered_values, RpmTable):
+        combination = filtered_values.record(closest_index)
+    else:
+        # Plain python scalars, host NumPy keeps uint8 and overflows in steps math
+        combination = (float(filtered_values[0][closest_index]), int(filtered_values[1][closest_index]),
+                       int(filtered_values[2][closest_index]))
+    if cache is not None:
+        cache.put(target_rpm, combination)
+    return combination
 
 
 # Motor calibration points (RPM, flow rate in ml/min)
@@ -207,16 +355,44 @@ def linear_interpolation(data):
     return merged
 
 
-def move_with_rpm(mks, rpm, runtime, rpm_table, direction=0):
-    rpm, mstep, speed = find_combination(rpm, rpm_table)
+# MSTEP, Speed and steps to run the motor with rpm for runtime seconds
+def calc_move(mks, rpm, runtime, rpm_table, cache=None):
+    rpm, mstep, speed = find_combination(rpm, rpm_table, cache)
     steps = calc_steps(mks, rpm, mstep, runtime)
+    return mstep, speed, steps
+
+
+# Expected runtime of make_steps in seconds
+def calc_move_time(mks, mstep, speed, steps):
+    if mstep == 0 or speed == 0:
+        return 0
+    step_per_rev = mks.step_per_rev
+    rpm = (speed * 30000) / (mstep * step_per_rev)
+    return steps * 60 / (mstep * step_per_rev * rpm)
 
-    if mks.set_mstep(mstep):
-        return mks.make_steps(steps, speed=speed, direction=direction, stop=False)
+
+# Event loop keeps running while the driver replies
+async def arun_move(mks, mstep, speed, steps, direction=0):
+    if await mks.aset_mstep(mstep):
+        return await mks.amake_steps(steps, speed=speed, direction=direction, stop=False)
     else:
         return False
 
 
+async def amove_with_rpm(mks, rpm, runtime, rpm_table, direction=0, cache=None):
+    mstep, speed, steps = calc_move(mks, rpm, runtime, rpm_table, cache)
+    return await arun_move(mks, mstep, speed, steps, direction)
+
+
+# Blocking wrappers for code that runs outside of the event loop
+def run_move(mks, mstep, speed, steps, direction=0):
+    return run_sync(arun_move(mks, mstep, speed, steps, direction))
+
+
+def move_with_rpm(mks, rpm, runtime, rpm_table, direction=0, cache=None):
+    return run_sync(amove_with_rpm(mks, rpm, runtime, rpm_table, direction, cache))
+
+
 def to_float(arr):
     if isinstance(arr, np.ndarray):
         # If it's a single-item NumPy array, extract the item and return
@@ -2,6 +2,11 @@ import json
 from lib.stepper_doser_math import *
 from lib.servo42c import *
 from lib.asyncscheduler import *
+from lib.dose_plan import *
+from lib.checksum import *
+from lib.config_store import ConfigStore
+from lib.dose_journal import DoseJournal
+from lib.dose_history import DoseHistory, FLAG_SCHEDULED, FLAG_LIMITED, FLAG_SKIPPED
 from config.pin_config import *
 import array
 import struct
@@ -122,153 +127,69 @@ def get_time():
     return f"{_time[3]:02}:{_time[4]:02}:{_time[5]:02}"
 
 
+# All config sections are read once, changes are saved by config_store.saver() task
+config_store = ConfigStore().load()
+
 # Settings for Calibration
-try:
-    with open("config/calibration_points.json", 'r') as read_file:
-        calibration_points = json.load(read_file)
-except Exception as e:
-    print("Can't load calibration config, load default ", e)
-    calibration_points = {}
-    for _ in range(MAX_PUMPS):
-        if f"calibrationDataPump{_ + 1}" not in calibration_points:
-            calibration_points[f"calibrationDataPump{_ + 1}"] = [{"rpm": 100,"flowRate": 100},{"rpm": 500,"flowRate": 400},{"rpm": 1000,"flowRate": 800}]
+calibration_points = config_store.section("calibration_points")
+for _ in range(MAX_PUMPS):
+    if f"calibrationDataPump{_ + 1}" not in calibration_points:
+        calibration_points[f"calibrationDataPump{_ + 1}"] = [{"rpm": 100,"flowRate": 100},{"rpm": 500,"flowRate": 400},{"rpm": 1000,"flowRate": 800}]
 
 
 # Settings for Analog control
-try:
-    with open("config/analog_settings.json", 'r') as read_file:
-        analog_settings = json.load(read_file)
-        for _ in range(MAX_PUMPS):
-            if f"pump{_+1}" not in analog_settings:
-                analog_settings[f"pump{_ + 1}"] = {"enable": False, "pin": 99, "dir": 1,
-                                                   "points": [{"analogInput": 0, "flowRate": 0},
-                                                              {"analogInput": 100, "flowRate": 5}]}
-except Exception as e:
-    print("Can't load analog setting config, load default ", e)
-    analog_settings = {}
-    for _ in range(MAX_PUMPS):
-        analog_settings[f"pump{_+1}"] = {"enable": False, "pin": 99, "dir": 1, "points": [{"analogInput": 0, "flowRate": 0}, {"analogInput": 100, "flowRate": 5}]}
+analog_settings = config_store.section("analog_settings")
+for _ in range(MAX_PUMPS):
+    if f"pump{_+1}" not in analog_settings:
+        analog_settings[f"pump{_ + 1}"] = {"enable": False, "pin": 99, "dir": 1,
+                                           "points": [{"analogInput": 0, "flowRate": 0},
+                                                      {"analogInput": 100, "flowRate": 5}]}
 
 # General device settings
-try:
-    with open("config/settings.json", 'r') as read_file:
-        settings = json.load(read_file)
-except Exception as e:
-    print("Can't load general setting config, load default ", e)
-    settings = {"pump_number": 1, "hostname": "doser", "timezone": 0.0, "timeformat": 0, "ntphost": "time.google.com",
-                "analog_period": 60,
-                "pumps_current": [1000, 1000, 1000, 1000, 1000, 1000, 1000, 1000, 1000],
-                "inversion": [0, 0, 0, 0, 0, 0, 0, 0, 0],
-                "names": ["Pump 1", "Pump 2", "Pump 3", "Pump 4", "Pump 5", "Pump 6", "Pump 7", "Pump 8", "Pump 9"],
-                "color": "dark",
-                "theme": "cerulean"}
-
-if "hostname" not in settings:
-    hostname = "doser"
-else:
-    hostname = settings["hostname"]
-if "timezone" not in settings:
-    timezone = 0.0
-else:
-    timezone = settings["timezone"]
-if "timeformat" not in settings:
-    timeformat = 0
-else:
-    timeformat = settings["timeformat"]
-
-if "ntphost" not in settings:
-    ntphost = "time.google.com"
-else:
-    ntphost = settings["ntphost"]
-
-if "pumps_current" not in settings:
-    pumps_current = [1000, 1000, 1000, 1000, 1000, 1000, 1000, 1000, 1000]
-else:
-    pumps_current = settings["pumps_current"]
-if "analog_period" not in settings:
-    analog_period = 60
-else:
-    analog_period = settings["analog_period"]
-
-if "inversion" not in settings:
-    inversion = [0, 0, 0, 0, 0, 0, 0, 0, 0]
-else:
-    inversion = settings["inversion"]
-if "names" not in settings:
-    pump_names = ["Pump 1", "Pump 2", "Pump 3", "Pump 4", "Pump 5", "Pump 6", "Pump 7", "Pump 8", "Pump 9"]
-else:
-    pump_names = settings["names"]
-if "color" not in settings:
-    color = "dark"
-else:
-    color = settings["color"]
-if "theme" not in settings:
-    theme = "cerulean"
-else:
-    theme = settings["theme"]
-
-if "whatsapp_number" not in settings:
-    whatsapp_number = ""
-else:
-    whatsapp_number = settings["whatsapp_number"]
-
-if "whatsapp_apikey" not in settings:
-    whatsapp_apikey = ""
-else:
-    whatsapp_apikey = settings["whatsapp_apikey"]
-
-if "telegram" not in settings:
-    telegram = ""
-else:
-    telegram = settings["telegram"]
-
-if "empty_container_msg" not in settings:
-    empty_container_msg = 0
-else:
-    empty_container_msg = settings["empty_container_msg"]
-
-if "empty_container_lvl" not in settings:
-    empty_container_lvl = 0
-else:
-    empty_container_lvl = settings["empty_container_lvl"]
-
-if "dose_msg" not in settings:
-    dose_msg = 0
-else:
-    dose_msg = settings["dose_msg"]
-
-
-PUMP_NUM = settings["pump_number"]
+settings = config_store.section("settings")
+
+hostname = config_store.get("settings", "hostname", "doser", str)
+timezone = config_store.get("settings", "timezone", 0.0, float)
+timeformat = config_store.get("settings", "timeformat", 0, int)
+ntphost = config_store.get("settings", "ntphost", "time.google.com", str)
+pumps_current = config_store.get("settings", "pumps_current", [1000, 1000, 1000, 1000, 1000, 1000, 1000, 1000, 1000])
+analog_period = config_store.get("settings", "analog_period", 60, int)
+inversion = config_store.get("settings", "inversion", [0, 0, 0, 0, 0, 0, 0, 0, 0])
+pump_names = config_store.get("settings", "names", ["Pump 1", "Pump 2", "Pump 3", "Pump 4", "Pump 5", "Pump 6",
+                                                    "Pump 7", "Pump 8", "Pump 9"])
+color = config_store.get("settings", "color", "dark", str)
+theme = config_store.get("settings", "theme", "cerulean", str)
+whatsapp_number = config_store.get("settings", "whatsapp_number", "", str)
+whatsapp_apikey = config_store.get("settings", "whatsapp_apikey", "", str)
+telegram = config_store.get("settings", "telegram", "", str)
+empty_container_msg = config_store.get("settings", "empty_container_msg", 0, int)
+empty_container_lvl = config_store.get("settings", "empty_container_lvl", 0, int)
+dose_msg = config_store.get("settings", "dose_msg", 0, int)
+
+
+PUMP_NUM = config_store.get("settings", "pump_number", 1, int)
 
 
 # Storage count configs
-try:
-    with open("config/storage.json") as read_file:
-        storage = json.load(read_file)
-        print("storage: ", storage)
-except Exception as e:
-    print("Can't load storage config, generate new")
-    storage = {}
-    for _ in range(1, MAX_PUMPS+1):
-        storage[f"pump{_}"] = 0
-        storage[f"remaining{_}"] = 0
-    with open('config/storage.json', 'w') as write_file:
-        json.dump(storage, write_file)
+storage = config_store.section("storage")
+print("storage: ", storage)
 for _ in range(1, MAX_PUMPS+1):
     if f"pump{_}" not in storage:
         storage[f"pump{_}"] = 0
     if f"remaining{_}" not in storage:
         storage[f"remaining{_}"] = 0
 
-try:
-    with open("config/schedule.json") as read_file:
-        schedule = json.load(read_file)
-        print("schedule: ", schedule)
-except Exception as e:
-    print("Can't load schedule config, generate new")
-    schedule = {}
-    for _ in range(1, MAX_PUMPS+1):
-        schedule[f"pump{_}"] = []
+# Container levels changed after the last storage snapshot
+dose_journal = DoseJournal(lambda: config_store.commit("storage"))
+if dose_journal.replay(storage) or dose_journal.torn:
+    print(f"Replayed {dose_journal.records} dose journal records: ", storage)
+    dose_journal.compact()
+
+# Past doses of every pump
+dose_history = DoseHistory(MAX_PUMPS).load()
+
+schedule = config_store.section("schedule", {f"pump{_}": [] for _ in range(1, MAX_PUMPS + 1)})
+print("schedule: ", schedule)
 
 
 mks_dict = {}
@@ -276,58 +197,19 @@ for stepper in range(1, PUMP_NUM + 1):
     mks_dict[f"mks{stepper}"] = Servo42c(uart, addr=stepper - 1, speed=1)
     mks_dict[f"mks{stepper}"].set_current(pumps_current[stepper-1])
 
-try:
-    with open("./config/wifi.json", 'r') as wifi_config:
-        wifi_settings = json.load(wifi_config)
-        if "ssid" in wifi_settings:
-            ssid = wifi_settings["ssid"]
-        else:
-            ssid = ""
-        if "password" in wifi_settings:
-            password = wifi_settings["password"]
-        else:
-            password = ""
-except Exception as e:
-    print("Failed to load config/wifi.json ", e)
-    ssid = ""
-    password = ""
+ssid = config_store.get("wifi", "ssid", "", str)
+password = config_store.get("wifi", "password", "", str)
 
-try:
-    with open("./config/mqtt.json", 'r') as mqtt_config:
-        mqtt_settings = json.load(mqtt_config)
-        if "broker" in mqtt_settings:
-            mqtt_broker = mqtt_settings["broker"]
-        else:
-            mqtt_broker = ""
-        if "login" in mqtt_settings:
-            mqtt_login = mqtt_settings["login"]
-        else:
-            mqtt_login = ""
-        if "password" in mqtt_settings:
-            mqtt_password = mqtt_settings["password"]
-        else:
-            mqtt_password = ""
-except Exception as e:
-    print("\nfailed to load config/mqtt.json, ", e)
-    mqtt_broker = ""
-    mqtt_login = ""
-    mqtt_password = ""
+mqtt_broker = config_store.get("mqtt", "broker", "", str)
+mqtt_login = config_store.get("mqtt", "login", "", str)
+mqtt_password = config_store.get("mqtt", "password", "", str)
 
 
+# Limits are stored with string keys, json has no integer keys
 limits_dict = {}
-try:
-    with open("./config/limits.json", 'r') as limits_config:
-        limits_settings = json.load(limits_config)
-        for _ in range(1, MAX_PUMPS + 1):
-            if f"{_}" in limits_settings:
-                limits_dict[_] = limits_settings[f"{_}"]
-            else:
-                limits_dict[_] = "True"
-
-except Exception as e:
-    print("\nfailed to load ./config/limits.json, ", e)
-    for _ in range(1, MAX_PUMPS + 1):
-        limits_dict[_] = "True"
+limits_settings = config_store.section("limits")
+for _ in range(1, MAX_PUMPS + 1):
+    limits_dict[_] = limits_settings.get(f"{_}", "True")
 
 chart_points = {}
 for _ in range(1, MAX_PUMPS + 1):
@@ -361,6 +243,8 @@ for _ in range(1, MAX_PUMPS + 1):
 
 
 rpm_table = make_rpm_table()
+rpm_cache = CombinationCache()
+dose_planner = DosePlanner(mks_dict, chart_points, inversion, rpm_table, rpm_cache)
 command_buffer = CommandBuffer()
 
 
@@ -2,12 +2,18 @@ import sys
 import time
 from machine import Timer
 
-from lib.microdot.microdot import Microdot, redirect, send_file
+from lib.microdot.microdot import Microdot, Request, redirect, send_file
+from lib.microdot.json_stream import with_json_body
 from lib.microdot.sse import with_sse
+from lib.state_bus import StateBus
+from lib.sse_broadcast import Broadcaster
+from lib.asset_cache import AssetCache, ASSET_MAX_AGE, not_modified
+from lib.schedule_manager import ScheduleManager
 import re
 import lib.mcron as mcron
 from load_configs import *
-from lib.exec_code import evaluate_expression
+from lib.stepper_doser_math import to_float
+from lib.exec_code import evaluate_expression, compile_limits
 from lib.callmebot import *
 from machine import Timer
 
@@ -46,6 +52,7 @@ except ImportError:
 
     mcron.remove_all = Mock()
     mcron.insert = Mock()
+    mcron.remove = Mock()
     mqtt_client = Mock()
     RELEASE_TAG = "local_debug"
     os.system("python ../scripts/compress_web.py --path ./")
@@ -102,6 +109,10 @@ for file in css_files:
     print(file)
 
 app = Microdot()
+# Larger bodies are not buffered, JSON routes decode them from the socket in chunks up to the route's limit
+Request.max_body_length = 2 * 1024
+Request.max_content_length = 32 * 1024
+assets = AssetCache()
 doser_topic = f"/ReefRhythm/{unique_id}"
 gc.collect()
 ota_lock = False
@@ -115,6 +126,48 @@ mcron.init_timer()
 mcron_keys = []
 time_synced = False
 
+# State pushed to /dose-sse clients, every mutation of these sections must call state_bus.notify()
+state_bus = StateBus({"AnalogChartPoints": lambda: analog_chart_points,
+                      "Settings": lambda: analog_settings,
+                      "Schedule": lambda: schedule,
+                      "Limits": lambda: limits_dict,
+                      "Storage": lambda: storage})
+
+
+def page_settings():
+    navbar = extension.extension_navbar if addon and hasattr(extension, 'extension_navbar') else None
+    return {"hostname": hostname, "Mac": mac_address, "timezone": timezone, "timeformat": timeformat,
+            "mqttTopic": f"/ReefRhythm/{unique_id}/", "mqttBroker": mqtt_broker, "mqttLogin": mqtt_login,
+            "analogPeriod": analog_period, "pumpsCurrent": pumps_current, "pumpInversion": inversion,
+            "pumpNames": pump_names, "color": color, "theme": theme, "telegram": telegram,
+            "whatsappNumber": whatsapp_number, "whatsappApikey": whatsapp_apikey,
+            "emptyContainerMsg": empty_container_msg, "emptyContainerLvl": empty_container_lvl, "doseMsg": dose_msg,
+            "current_ssid": ssid if 'ssid' in globals() else "", "PumpNumber": PUMP_NUM, "AnalogPins": analog_pins,
+            "Extension": navbar}
+
+
+def ota_state():
+    # Search for "ota_" followed by digits
+    match = re.search(r"ota_(\d+)", str(ota.status.current_ota))
+    return {"otaPartition": match.group(1) if match else None, "OtaStarted": ota_lock, "firmware": RELEASE_TAG,
+            "firmwareLink": firmware_link}
+
+
+# Settings the HTML pages fetch from /api/state, serialised once per version, every mutation must call notify()
+page_state = StateBus({"Settings": page_settings,
+                       "Calibration": lambda: calibration_points,
+                       "Ota": ota_state})
+# Shared SSE streams, one producer task per stream fans events out to all connected pages
+time_broadcaster = Broadcaster()
+dose_broadcaster = Broadcaster(resync=state_bus.snapshot)
+# Live values the limit expressions can read, nothing else of the firmware is reachable from them
+limits_values = {"adc_dict": lambda: adc_dict,
+                 "storage": lambda: storage,
+                 "analog_chart_points": lambda: analog_chart_points,
+                 "get_time": lambda: get_time}
+# Limit expressions are compiled once, doses only evaluate the cached code
+compile_limits(limits_dict, limits_values)
+
 byte_string = wifi.config('mac')
 print(byte_string)
 hex_string = binascii.hexlify(byte_string).decode('utf-8')
@@ -149,17 +202,24 @@ timer.init(period=10 * 1000, mode=Timer.PERIODIC, callback=lambda t: increment_u
 
 
 async def stepper_run(mks, desired_rpm_rate, execution_time, direction, rpm_table, expression=False,
-                      pump_dose=0, pump_id=None, weekdays=None):
+                      pump_dose=0, pump_id=None, weekdays=None, plan=None):
+    # Manual doses run every day
+    history_flags = FLAG_SCHEDULED if weekdays is not None else 0
     if weekdays is None:
         weekdays = [0, 1, 2, 3, 4, 5, 6]
+    if expression:
+        history_flags |= FLAG_LIMITED
 
     def change_remaining():
         print("id:", pump_id, " dose:", pump_dose)
         if pump_dose and pump_id is not None:
+            dose_history.append(pump_id, pump_dose, history_flags)
             _remaining = storage[f"remaining{pump_id}"] - pump_dose
             _remaining = 0 if _remaining < 0 else _remaining
             _storage = storage[f"pump{pump_id}"]
             storage[f"remaining{pump_id}"] = _remaining
+            dose_journal.append(pump_id, pump_dose, _remaining)
+            state_bus.notify("Storage")
             print(storage)
 
             if mqtt_broker:
@@ -169,11 +229,7 @@ async def stepper_run(mks, desired_rpm_rate, execution_time, direction, rpm_tabl
                          "remain": storage[f"remaining{pump_id}"], "storage": storage[f"pump{pump_id}"]}
                 print("data", _data)
                 print({"topic": _topic, "data": _data})
-                mqtt_publish_buffer.append({"topic": _topic, "data": _data})
-
-                while len(mqtt_publish_buffer) > 75:
-                    print("Warning! MQTT Buffer overflow, clean it")
-                    del mqtt_publish_buffer[0]
+                mqtt_publish_buffer.push(_topic, _data)
 
             _localtime = time.localtime()
 
@@ -216,28 +272,42 @@ async def stepper_run(mks, desired_rpm_rate, execution_time, direction, rpm_tabl
         return
 
     print(f"Desired {to_float(desired_rpm_rate)}rpm, mstep")
-    if inversion[pump_id - 1]:
+    # Dose plan has inversion already applied
+    if plan is None and inversion[pump_id - 1]:
         direction = 0 if direction == 1 else 1
 
+    async def move():
+        if plan:
+            _, mstep, speed, steps, _, plan_direction = plan
+            return await arun_move(mks, mstep, speed, steps, plan_direction)
+        return await amove_with_rpm(mks, desired_rpm_rate, execution_time, rpm_table, direction, rpm_cache)
+
     if expression:
         print("Check expression: ", expression)
-        result, logs = evaluate_expression(expression, globals())
+        result, logs = evaluate_expression(expression, limits_values)
         if result:
             print(f"Limits check pass")
-            calc_time = move_with_rpm(mks, desired_rpm_rate, execution_time, rpm_table, direction)
+            calc_time = await move()
             change_remaining()
             return [calc_time]
     else:
-        calc_time = move_with_rpm(mks, desired_rpm_rate, execution_time, rpm_table, direction)
+        calc_time = await move()
         change_remaining()
         return [calc_time]
     print(f"Limits check not pass, skip dosing")
+    if pump_dose and pump_id is not None:
+        dose_history.append(pump_id, pump_dose, history_flags | FLAG_SKIPPED)
     return False
 
 
 async def stepper_stop(mks):
     print(f"Stop {id} stepper")
-    return mks.stop()
+    return await mks.astop()
+
+
+async def stepper_read(mks):
+    encoder = await mks.aread_encoder()
+    return {"encoder": list(encoder) if encoder else None, "pulses": await mks.aread_pulses()}
 
 
 @micropython.native
@@ -287,14 +357,6 @@ async def download_file_async(url, filename, progress=False):
     response.close()
 
 
-def to_float(arr):
-    if isinstance(arr, np.ndarray):
-        # If it's a single-item NumPy array, extract the item and return
-        return arr[0]
-    else:
-        return arr
-
-
 async def analog_control_worker():
     while not adc_sampler_started:
         print("Wait for adc sampler finish firts cycle")
@@ -333,13 +395,14 @@ async def analog_control_worker():
                 print("Desired flow", desired_flow)
                 print("Amount:", amount)
                 if desired_flow >= 0.01:
-                    desired_rpm_rate = to_float(
-                        np.interp(desired_flow, chart_points[f"pump{i + 1}"][1], chart_points[f"pump{i + 1}"][0]))
+                    plan = dose_planner.make(i + 1, desired_flow, analog_period + 5,
+                                             analog_settings[f"pump{i + 1}"]["dir"])
 
-                    await command_buffer.add_command(stepper_run, None, mks_dict[f"mks{i + 1}"], desired_rpm_rate,
+                    await command_buffer.add_command(stepper_run, None, mks_dict[f"mks{i + 1}"], plan[0],
                                                      analog_period + 5,
                                                      analog_settings[f"pump{i + 1}"]["dir"], rpm_table,
-                                                     limits_dict[i + 1], pump_dose=amount, pump_id=(i + 1))
+                                                     limits_dict[i + 1], pump_dose=amount, pump_id=(i + 1),
+                                                     plan=plan)
         for _ in range(len(analog_en)):
             adc_buffer_values[_] = []
         for x in range(0, analog_period):
@@ -396,18 +459,27 @@ async def get_free_mem(request):
     return {"free_mem": ret}
 
 
+@app.route('/queue-stats')
+async def get_queue_stats(request):
+    stats = command_buffer.metrics()
+    stats["jobs"] = job_queue.metrics()
+    stats["mqtt"] = mqtt_publish_buffer.metrics()
+    stats["mqtt_commands"] = mqtt_commands.metrics()
+    return stats
+
+
 @app.route('/favicon/<path:path>')
 async def favicon(request, path):
     if '..' in path:
         # directory traversal is not allowed
         return 'Not found', 404
     print(f"sending static/favicon/{path}")
-    return send_file('static/favicon/' + path)
+    return assets.send_file(request, 'static/favicon/' + path, max_age=ASSET_MAX_AGE)
 
 
 @app.route('/site.webmanifest')
 async def manifest(request):
-    response = send_file('static/favicon/site.webmanifest')
+    response = assets.send_file(request, 'static/favicon/site.webmanifest', max_age=ASSET_MAX_AGE)
     return response
 
 
@@ -419,10 +491,10 @@ async def styles(request, path):
 
     if path in css_files:
         print(f"send css {path} from RAM")
-        return send_file(path, compressed=web_compress,
-                         file_extension=web_file_extension, stream=css_files[path])
-    return send_file('static/styles/' + path, compressed=web_compress,
-                     file_extension=web_file_extension)
+        return assets.send_file(request, 'static/styles/' + path, max_age=ASSET_MAX_AGE, compressed=web_compress,
+                                file_extension=web_file_extension, stream=css_files[path])
+    return assets.send_file(request, 'static/styles/' + path, max_age=ASSET_MAX_AGE, compressed=web_compress,
+                            file_extension=web_file_extension)
 
 
 @app.route('/javascript/<path:path>')
@@ -433,12 +505,12 @@ async def javascript(request, path):
     print(f"Send file static/javascript/{path}")
     if path in js_files:
         print(f"send js {path} from RAM")
-        return send_file(path, compressed=web_compress,
-                         file_extension=web_file_extension, stream=js_files[path])
+        return assets.send_file(request, 'static/javascript/' + path, max_age=ASSET_MAX_AGE,
+                                compressed=web_compress, file_extension=web_file_extension, stream=js_files[path])
     else:
         print(f"send js {path} from DISK")
-        return send_file('static/javascript/' + path, compressed=web_compress,
-                         file_extension=web_file_extension)
+        return assets.send_file(request, 'static/javascript/' + path, max_age=ASSET_MAX_AGE,
+                                compressed=web_compress, file_extension=web_file_extension)
 
 
 @app.route('/static/<path:path>')
@@ -446,23 +518,15 @@ async def static(request, path):
     if '..' in path:
         # directory traversal is not allowed
         return 'Not found', 404
-    return send_file('static/' + path)
-
-
-@app.route('/icon/<path:path>')
-async def static(request, path):
-    if '..' in path:
-        # directory traversal is not allowed
-        return 'Not found', 404
-    return send_file('static/icon/' + path)
+    return assets.send_file(request, 'static/' + path)
 
 
 @app.route('/icon/<path:path>')
-async def static(request, path):
+async def icon(request, path):
     if '..' in path:
         # directory traversal is not allowed
         return 'Not found', 404
-    return send_file('static/icon/' + path)
+    return assets.send_file(request, 'static/icon/' + path, max_age=ASSET_MAX_AGE)
 
 
 @app.route('/stop')
@@ -477,7 +541,7 @@ async def stop(request):
         callback_result_future.set_result({"result": result})
 
     task = asyncio.create_task(
-        command_buffer.add_command(stepper_stop, callback, mks_dict[f"mks{_id}"]))
+        command_buffer.add_command(stepper_stop, callback, mks_dict[f"mks{_id}"], priority=PRIORITY_STOP))
     await task
 
     await callback_result_future.wait()
@@ -487,6 +551,16 @@ async def stop(request):
     return callback_result
 
 
+@app.route('/position')
+async def position(request):
+    _id = request.args.get('id', default=1, type=int)
+    callback_result_future = CustomFuture()
+    # Reads wait behind stops and doses, the driver is never polled in the middle of a dose
+    await command_buffer.add_command(stepper_read, callback_result_future.set_result, mks_dict[f"mks{_id}"],
+                                     priority=PRIORITY_READ)
+    return await callback_result_future.wait()
+
+
 @app.route('/run')
 async def run_with_rpm(request):
     id = request.args.get('id', default=1, type=int)
@@ -527,8 +601,8 @@ async def dose(request):
     desired_flow = amount * (60 / execution_time)
     print(f"Desired flow: {round(desired_flow, 2)}")
     print(f"Direction: {direction}")
-    desired_rpm_rate = np.interp(desired_flow, chart_points[f"pump{id}"][1], chart_points[f"pump{id}"][0])
-    desired_rpm_rate = to_float(desired_rpm_rate)
+    plan = dose_planner.plan(id, amount, execution_time, direction)
+    desired_rpm_rate = plan[0]
 
     callback_result_future = CustomFuture()
 
@@ -538,7 +612,7 @@ async def dose(request):
 
     task = asyncio.create_task(
         command_buffer.add_command(stepper_run, callback, mks_dict[f"mks{id}"], desired_rpm_rate, execution_time,
-                                   direction, rpm_table, pump_dose=amount, pump_id=id))
+                                   direction, rpm_table, pump_dose=amount, pump_id=id, plan=plan))
     # await uart_buffer.process_commands()
     await task
 
@@ -550,6 +624,7 @@ async def dose(request):
 
 
 @app.route('/', methods=['GET', 'POST'])
+@with_json_body(16 * 1024)
 async def index(request):
     if request.method == 'GET':
         # Captive portal
@@ -558,23 +633,11 @@ async def index(request):
 
         if "doser.html" in html_files:
             print("Send doser.html.gz from RAM")
-            response = send_file("doser.html", compressed=web_compress,
-                                 file_extension=web_file_extension, stream=html_files["doser.html"])
+            response = assets.send_file(request, './static/doser.html', compressed=web_compress,
+                                        file_extension=web_file_extension, stream=html_files["doser.html"])
         else:
-            response = send_file('./static/doser.html', compressed=web_compress,
-                                 file_extension=web_file_extension)
-
-        response.set_cookie(f'AnalogPins', json.dumps(analog_pins))
-        response.set_cookie(f'PumpNumber', json.dumps({"pump_num": PUMP_NUM}))
-        response.set_cookie(f'timeformat', timeformat)
-        response.set_cookie("pumpNames", json.dumps({"pumpNames": pump_names}))
-        response.set_cookie("color", color)
-        response.set_cookie("theme", theme)
-        print("color ", color)
-        print("theme ", theme)
-
-        if addon and hasattr(extension, 'extension_navbar'):
-            response.set_cookie("Extension", json.dumps(extension.extension_navbar))
+            response = assets.send_file(request, './static/doser.html', compressed=web_compress,
+                                        file_extension=web_file_extension)
 
         return response
     else:
@@ -599,22 +662,34 @@ async def index(request):
 
                 else:
                     print(f"Pump{_} Not enough Analog Input points")
-        with open("config/analog_settings.json", 'w') as write_file:
-            write_file.write(json.dumps(analog_settings))
+        state_bus.notify("AnalogChartPoints", "Settings")
+        config_store.mark_dirty("analog_settings")
         return response
 
 
+async def time_producer():
+    while True:
+        if time_broadcaster.clients:
+            time_broadcaster.publish(json.dumps({"time": get_time()}))
+        await asyncio.sleep(5)
+
+
+async def dose_producer():
+    subscription = state_bus.subscribe()
+    # Skip the snapshot, every client gets the current one on connect
+    await subscription.next()
+    while True:
+        event = await subscription.next()
+        print("send Analog Control settigs")
+        dose_broadcaster.publish(event)
+
+
 @app.route('/time')
 @with_sse
 async def dose_ssetime(request, sse):
     print("Got connection")
     try:
-        for _ in range(5):
-            event = json.dumps({
-                "time": get_time(),
-            })
-            await sse.send(event)  # unnamed event
-            await asyncio.sleep(5)
+        await time_broadcaster.serve(sse, json.dumps({"time": get_time()}))
     except Exception as e:
         print(f"Error in SSE loop: {e}")
     print("SSE closed")
@@ -624,28 +699,9 @@ async def dose_ssetime(request, sse):
 @with_sse
 async def dose_sse(request, sse):
     print("Got connection")
-    old_settings = None
-    old_schedule = None
-    _old_limits_settings = None
-    _old_storage = None
+    # Full state first, then only the sections changed since the previous event
     try:
-        for _ in range(30):
-            if old_settings != analog_settings or old_schedule != schedule or _old_limits_settings != limits_dict or _old_storage != storage:
-                old_settings = analog_settings.copy()
-                old_schedule = schedule.copy()
-                _old_limits_settings = limits_dict.copy()
-                _old_storage = storage.copy()
-                event = json.dumps({
-                    "AnalogChartPoints": analog_chart_points,
-                    "Settings": analog_settings,
-                    "Schedule": schedule,
-                    "Limits": limits_dict,
-                    "Storage": storage
-                })
-
-                print("send Analog Control settigs")
-                await sse.send(event)  # unnamed event
-            await asyncio.sleep(1)
+        await dose_broadcaster.serve(sse, state_bus.snapshot())
     except Exception as e:
         print(f"Error in SSE loop: {e}")
     print("SSE closed")
@@ -678,33 +734,11 @@ async def ota_upgrade(request):
 
         if "ota-upgrade.html" in html_files:
             print("Send ota-upgrade.html from RAM")
-            response = send_file("ota-upgrade.html", compressed=web_compress,
-                                 file_extension=web_file_extension, stream=html_files["ota-upgrade.html"])
+            response = assets.send_file(request, './static/ota-upgrade.html', compressed=web_compress,
+                                        file_extension=web_file_extension, stream=html_files["ota-upgrade.html"])
         else:
-            response = send_file('./static/ota-upgrade.html', compressed=web_compress,
-                                 file_extension=web_file_extension)
-        response.set_cookie("firmwareLink", firmware_link)
-        # Define a regular expression pattern to find "ota_" followed by digits
-        pattern = r"ota_(\d+)"
-
-        status = str(ota.status.current_ota)
-        print(status)
-        # Search for the pattern in the status string
-        match = re.search(pattern, status)
-
-        # Extract the ota_ number from the search result
-        boot_partition = match.group(1) if match else None
-
-        print(f"boot_partition= <{boot_partition}>")
-        print("theme:", theme)
-        response.set_cookie(f'otaPartition', boot_partition)
-        response.set_cookie(f'OtaStarted', ota_lock)
-        response.set_cookie(f'firmware', RELEASE_TAG)
-        response.set_cookie("color", color)
-        response.set_cookie("theme", theme)
-
-        if addon and hasattr(extension, 'extension_navbar'):
-            response.set_cookie("Extension", json.dumps(extension.extension_navbar))
+            response = assets.send_file(request, './static/ota-upgrade.html', compressed=web_compress,
+                                        file_extension=web_file_extension)
 
     if request.method == 'POST':
         print("process post request")
@@ -720,6 +754,8 @@ async def ota_upgrade(request):
             try:
                 print("Start upgrading from link")
                 ota_lock = True
+                page_state.notify("Ota")
+                schedule_manager.remove_all()
                 mcron.remove_all()
 
                 filename = link.split('/')[-1]
@@ -733,18 +769,22 @@ async def ota_upgrade(request):
 
                 await download_file_async(link, filename, progress=True)
                 print("Download complete")
+                print("Firmware sha256: ", verify_image(filename, firmware_size, firmware_info.get("sha")))
 
-                with open('config/storage.json', 'w') as _write_file:
-                    # Print the new remaining values
-                    print("Store new remaining values: ", storage)
-                    json.dump(storage, _write_file)
+                # Print the new remaining values
+                print("Store new remaining values: ", storage)
+                config_store.mark_dirty("storage")
+                config_store.commit()
+                dose_history.flush()
 
                 ota.update.from_file(filename, reboot=True)
                 ota_lock = False
+                page_state.notify("Ota")
 
             except Exception as e:
                 print("Error: ", e)
                 ota_lock = False
+                page_state.notify("Ota")
 
         if cancel_rollback:
             print("Cancel firmware rollback")
@@ -756,6 +796,7 @@ async def ota_upgrade(request):
 
 
 @app.route('/schedule', methods=['GET', 'POST'])
+@with_json_body(16 * 1024)
 async def schedule_web(request):
     if request.method == 'GET':
         return schedule
@@ -768,33 +809,20 @@ async def schedule_web(request):
 
 
 @app.route('/calibration', methods=['GET', 'POST'])
+@with_json_body(16 * 1024)
 async def calibration(request):
     if request.method == 'GET':
 
         if "calibration.html" in html_files:
             print("Send calibration.html from RAM")
-            response = send_file("calibration.html", compressed=web_compress,
-                                 file_extension=web_file_extension, stream=html_files["calibration.html"])
+            response = assets.send_file(request, './static/calibration.html', compressed=web_compress,
+                                        file_extension=web_file_extension, stream=html_files["calibration.html"])
         else:
-            response = send_file('./static/calibration.html', compressed=web_compress,
-                                 file_extension=web_file_extension)
-
-        for pump in range(1, PUMP_NUM + 1):
-            response.set_cookie(f'calibrationDataPump{pump}',
-                                json.dumps(calibration_points[f"calibrationDataPump{pump}"]))
-            response.set_cookie(f'PumpNumber', json.dumps({"pump_num": PUMP_NUM}))
-
-        if addon and hasattr(extension, 'extension_navbar'):
-            response.set_cookie("Extension", json.dumps(extension.extension_navbar))
-
-        response.set_cookie("pumpNames", json.dumps({"pumpNames": pump_names}))
-        response.set_cookie("color", color)
-        response.set_cookie("theme", theme)
+            response = assets.send_file(request, './static/calibration.html', compressed=web_compress,
+                                        file_extension=web_file_extension)
 
     else:
         response = redirect('/')
-        response.set_cookie("color", color)
-        response.set_cookie("theme", theme)
         data = request.json
         for _ in range(1, PUMP_NUM + 1):
             if f"pump{_}" in data:
@@ -811,14 +839,11 @@ async def calibration(request):
                     print("1000: ", np.interp(1000, new_flow_rate_values, new_rpm_values))
                     chart_points[f"pump{_}"] = (new_rpm_values, new_flow_rate_values)
 
-                    response.set_cookie(f'calibrationDataPump{_}', json.dumps(data[f"pump{_}"]))
                     calibration_points[f'calibrationDataPump{_}'] = data[f"pump{_}"]
                 else:
                     print("Not enough cal points")
-                    response.set_cookie(f'calibrationDataPump{_}',
-                                        json.dumps(calibration_points[f"calibrationDataPump{_}"]))
-        with open("config/calibration_points.json", 'w') as write_file:
-            write_file.write(json.dumps(calibration_points))
+        page_state.notify("Calibration")
+        config_store.mark_dirty("calibration_points")
         update_schedule(schedule)
     return response
 
@@ -831,45 +856,35 @@ def setting_responce(request):
 
     if src in html_files:
         print(f"Send {src} from RAM")
-        response = send_file(src, compressed=web_compress,
-                             file_extension=web_file_extension, stream=html_files[src])
+        response = assets.send_file(request, f'static/{src}', compressed=web_compress,
+                                    file_extension=web_file_extension, stream=html_files[src])
     else:
         print(f"Send {src} from DISK")
         print(html_files)
-        response = send_file(f'static/{src}', compressed=web_compress,
-                             file_extension=web_file_extension)
-    response.set_cookie('hostname', hostname)
-    response.set_cookie('Mac', mac_address)
-    response.set_cookie('timezone', timezone)
-    response.set_cookie('timeformat', timeformat)
-    response.set_cookie("mqttTopic", f"/ReefRhythm/{unique_id}/")
-    response.set_cookie("mqttBroker", mqtt_broker)
-    response.set_cookie("mqttLogin", mqtt_login)
-    response.set_cookie("analogPeriod", analog_period)
-    response.set_cookie("pumpsCurrent", json.dumps({"current": pumps_current}))
-    response.set_cookie("analogPeriod", analog_period)
-    response.set_cookie("pumpInversion", json.dumps({"inversion": inversion}))
-    response.set_cookie("pumpNames", json.dumps({"pumpNames": pump_names}))
-    response.set_cookie("color", color)
-    response.set_cookie("theme", theme)
-    response.set_cookie("telegram", telegram)
-    response.set_cookie("whatsappNumber", whatsapp_number)
-    response.set_cookie("whatsappApikey", whatsapp_apikey)
-    response.set_cookie("emptyContainerMsg", empty_container_msg)
-    response.set_cookie("emptyContainerLvl", empty_container_lvl)
-    response.set_cookie("doseMsg", dose_msg)
-
-    if 'ssid' in globals():
-        response.set_cookie('current_ssid', ssid)
-        if addon and hasattr(extension, 'extension_navbar'):
-            response.set_cookie("Extension", json.dumps(extension.extension_navbar))
-    else:
-        response.set_cookie('current_ssid', "")
-    response.set_cookie(f'PumpNumber', json.dumps({"pump_num": PUMP_NUM}))
-
+        response = assets.send_file(request, f'static/{src}', compressed=web_compress,
+                                    file_extension=web_file_extension)
     return response
 
 
+@app.route('/api/state')
+async def api_state(request):
+    etag = page_state.etag()
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    return page_state.snapshot(), {'Content-Type': 'application/json', 'ETag': etag, 'Cache-Control': 'no-cache'}
+
+
+@app.route('/api/history')
+async def api_history(request):
+    pump_id = request.args.get('pump', default=1, type=int)
+    start = request.args.get('from', default=0, type=int)
+    end = request.args.get('to', default=None, type=int)
+    if not 1 <= pump_id <= MAX_PUMPS:
+        return 'Unknown pump', 404
+    return dose_history.json_chunks(pump_id, start, end), {'Content-Type': 'application/json'}
+
+
 def setting_process_post(request):
     new_ssid = request.json["ssid"]
     new_psw = request.json["psw"]
@@ -901,44 +916,40 @@ def setting_process_post(request):
     new_dose_msg = int(request.json["doseMsg"])
 
     if new_ssid and new_psw:
-        with open("./config/wifi.json", "w") as f:
-            f.write(json.dumps({"ssid": new_ssid, "password": new_psw}))
+        config_store.replace("wifi", {"ssid": new_ssid, "password": new_psw})
 
-    with open("./config/mqtt.json", "w") as f:
-        f.write(json.dumps({"broker": new_mqtt_broker, "login": new_mqtt_login, "password": new_mqtt_password}))
+    config_store.replace("mqtt", {"broker": new_mqtt_broker, "login": new_mqtt_login, "password": new_mqtt_password})
 
     new_pump_num = request.json[f"pumpNum"]
-    with open("./config/settings.json", "w") as f:
-        f.write(json.dumps({"pump_number": new_pump_num,
-                            "hostname": new_hostname,
-                            "timezone": new_timezone,
-                            "timeformat": new_timeformat,
-                            "pumps_current": new_pumps_current,
-                            "analog_period": new_analog_period,
-                            "names": new_names,
-                            "inversion": new_inversion,
-                            "color": new_color,
-                            "theme": new_theme,
-                            "telegram": new_telegram,
-                            "whatsapp_number": new_whatsapp_number,
-                            "whatsapp_apikey": new_whatsapp_apikey,
-                            "empty_container_msg": new_empty_container_msg,
-                            "empty_container_lvl": new_empty_container_lvl,
-                            "dose_msg": new_dose_msg}))
-
-    with open("./config/analog_settings.json", "w") as f:
-        json.dump(analog_settings, f)
-
-    with open('config/storage.json', 'w') as _write_file:
-        # Print the new remaining values
-        print("Store new remaining values: ", storage)
-        json.dump(storage, _write_file)
+    config_store.replace("settings", {"pump_number": new_pump_num,
+                                      "hostname": new_hostname,
+                                      "timezone": new_timezone,
+                                      "timeformat": new_timeformat,
+                                      "pumps_current": new_pumps_current,
+                                      "analog_period": new_analog_period,
+                                      "names": new_names,
+                                      "inversion": new_inversion,
+                                      "color": new_color,
+                                      "theme": new_theme,
+                                      "telegram": new_telegram,
+                                      "whatsapp_number": new_whatsapp_number,
+                                      "whatsapp_apikey": new_whatsapp_apikey,
+                                      "empty_container_msg": new_empty_container_msg,
+                                      "empty_container_lvl": new_empty_container_lvl,
+                                      "dose_msg": new_dose_msg})
+
+    # Print the new remaining values
+    print("Store new remaining values: ", storage)
+    config_store.mark_dirty("analog_settings", "storage")
+    config_store.commit()
+    dose_history.flush()
     print(f"Setting up new wifi {new_ssid}, Reboot...")
     machine.reset()
     return redirect("/settings")
 
 
 @app.route('/settings', methods=['GET', 'POST'])
+@with_json_body(4 * 1024)
 async def settings(request):
     if request.method == 'GET':
         response = setting_responce(request)
@@ -948,94 +959,77 @@ async def settings(request):
 
 
 @app.route('/exec', methods=['POST'])
-async def settings(request):
+@with_json_body(4 * 1024)
+async def exec_test(request):
     code = request.json["code"]
     pump = request.json["pump"]
     print(f"[pump{pump}]Testing code:\n", code)
-    result, logs = evaluate_expression(code, globals())
+    result, logs = evaluate_expression(code, limits_values)
     result = True if result is True else False
     print("Result", result)
     return {"result": result, "logs": logs}
 
 
 @app.route('/exec_save', methods=['POST'])
-async def settings(request):
+@with_json_body(4 * 1024)
+async def exec_save(request):
     code = request.json["code"]
     pump = int(request.json["pump"])
 
     limits_dict[pump] = code
+    compile_limits({pump: code}, limits_values)
+    state_bus.notify("Limits")
     print("Save new limits config, ", limits_dict)
-    with open("./config/limits.json", 'w') as _limits_config:
-        _limits_config.write(json.dumps(limits_dict))
+    config_store.set("limits", f"{pump}", code)
     update_schedule(schedule)
     return {'logs': 'Success'}
 
 
 @app.route('/refill', methods=['POST'])
+@with_json_body(2 * 1024)
 async def refill(request):
     global storage
     _storage = request.json
     for _ in range(MAX_PUMPS):
         storage[f"pump{_ + 1}"] = _storage[f"pump{_ + 1}"]
-        storage[f"remaining{_ + 1}"] = _storage[f"remaining{_ + 1}"]
+        if storage[f"remaining{_ + 1}"] != _storage[f"remaining{_ + 1}"]:
+            storage[f"remaining{_ + 1}"] = _storage[f"remaining{_ + 1}"]
+            dose_journal.append(_ + 1, 0, storage[f"remaining{_ + 1}"])
+    state_bus.notify("Storage")
     print("New storage data: ", storage)
-    with open("config/storage.json", 'w') as write_file:
-        json.dump(storage, write_file)
+    config_store.mark_dirty("storage")
     return {}
 
 
-def update_schedule(data):
-    if mcron_keys:
-        mcron.remove_all()
-
-    def create_task_with_args(id, rpm, duration, direction, amount, weekdays):
-        def task(callback_id, current_time, callback_memory):
-            print(f"[{get_time()}] Callback id:", callback_id)
-            asyncio.run(command_buffer.add_command(stepper_run, None, mks_dict[f"mks" + id], rpm, duration, direction,
-                                                   rpm_table, limits_dict[int(id)], pump_dose=amount, pump_id=int(id),
-                                                   weekdays=weekdays))
-
-        return task
-
-    mcron_job_number = 0
-    for pump in data:
-        id = pump[-1]
-        print(f"Add job for {pump}")
-        print(data[pump])
-        for job in data[pump]:
-            amount = job['amount']
-            duration = job['duration']
-            start_time = job['start_time']
-            end_time = job['end_time']
-            frequency = job['frequency']
-            direction = job['dir']
-            if "weekdays" not in job:
-                weekdays = [0, 1, 2, 3, 4, 5, 6]
-            else:
-                weekdays = job["weekdays"]
-
-            desired_flow = amount * (60 / duration)
-            desired_rpm_rate = np.interp(desired_flow, chart_points[f"pump{id}"][1], chart_points[f"pump{id}"][0])
+# Runs on the main loop, mcron timer callback only puts fired job into job_queue
+async def dispatch_scheduled_job(callback_id, current_time):
+    job = schedule_manager.params.get(callback_id)
+    if job is None:
+        print("Skip removed job ", callback_id)
+        return
+    id, duration, direction, amount, weekdays = job
+    print(f"[{get_time()}] Callback id:", callback_id)
+    plan = dose_planner.plan(int(id), amount, duration, direction)
+    await command_buffer.add_command(stepper_run, None, mks_dict[f"mks" + id], plan[0], duration,
+                                     direction, rpm_table, limits_dict[int(id)], pump_dose=amount,
+                                     pump_id=int(id), weekdays=weekdays, plan=plan)
 
-            dir_string = "Clockwise" if direction else "Counterclockwise"
 
-            print(f"[pump{id}] {amount}ml/{duration}sec {start_time}-{end_time} for {frequency} times {dir_string}")
-            print(f"Desired flow: {round(desired_flow, 2)}")
+job_queue = JobQueue(dispatch_scheduled_job)
+schedule_manager = ScheduleManager(mcron, job_queue.push)
 
-            start_time = int(start_time.split(":")[0]) * 60 * 60 + int(start_time.split(":")[1]) * 60
 
-            if end_time:
-                end_time = int(end_time.split(":")[0]) * 60 * 60 + int(end_time.split(":")[1]) * 60
-                step = (end_time - start_time) // frequency
-            else:
-                end_time = mcron.PERIOD_DAY
-                step = end_time // frequency
+def update_schedule(data):
+    # Only changed jobs are removed and inserted, calibration and limits are looked up when a job fires
+    schedule_manager.update(data)
+    for callback_id, (id, duration, direction, amount, weekdays) in schedule_manager.params.items():
+        # Precompile dose plans, job firing only looks them up. Plan of a recalibrated pump is made again
+        dose_planner.plan(int(id), amount, duration, direction)
 
-            new_job = create_task_with_args(id, desired_rpm_rate, duration, direction, amount, weekdays)
-            mcron.insert(mcron.PERIOD_DAY, range(start_time, end_time, step),
-                         f'mcron_{mcron_job_number}', new_job)
-            mcron_keys.append(f'mcron_{mcron_job_number}')
-            mcron_job_number += 1
+    # Add-on jobs are inserted again
+    for key in mcron_keys:
+        mcron.remove(key)
+    mcron_keys.clear()
 
     if addon:
         mcron_job_number = 0
@@ -1058,10 +1052,10 @@ def update_schedule(data):
             mcron_keys.append(f'mcron_ext_{mcron_job_number}')
             mcron_job_number += 1
 
-    with open("config/schedule.json", 'w') as write_file:
-        write_file.write(json.dumps(data))
     global schedule
     schedule = data.copy()
+    config_store.replace("schedule", schedule)
+    state_bus.notify("Schedule")
 
 
 async def sync_time():
@@ -1174,7 +1168,7 @@ async def mqtt_worker():
             command = decode_body()
             if command and check_dose_parameters(command):
                 print("Dose command ", command)
-                mqtt_dose_buffer.append(command)
+                mqtt_commands.push("dose", command)
             else:
                 print("error in syntax: ", command)
 
@@ -1182,21 +1176,21 @@ async def mqtt_worker():
             command = decode_body()
             if command and check_run_parameters(command):
                 print("Run command", command)
-                mqtt_run_buffer.append(command)
+                mqtt_commands.push("run", command)
             else:
                 print("error in syntax: ", command)
         elif topic.decode() == f"/ReefRhythm/{unique_id}/stop":
             command = decode_body()
             if command and check_stop_parameters(command):
                 print("Stop command", command)
-                mqtt_stop_buffer.append(command)
+                mqtt_commands.push("stop", command, priority=PRIORITY_STOP)
             else:
                 print("error in syntax: ", command)
         elif topic.decode() == f"/ReefRhythm/{unique_id}/refill":
             command = decode_body()
             if command and check_stop_parameters(command):
                 print("Refilling command", command)
-                mqtt_refill_buffer.append(command)
+                mqtt_commands.push("refill", command)
             else:
                 print("error in syntax: ", command)
 
@@ -1210,7 +1204,6 @@ async def mqtt_worker():
 
     last_will_topic = f"/ReefRhythm/{unique_id}/status"
     global doser_topic
-    global mqtt_publish_buffer
     print("MQTT last will topic: ", last_will_topic)
     mqtt_client.set_last_will(last_will_topic, 'Disconnected', retain=True)
 
@@ -1258,6 +1251,10 @@ async def mqtt_worker():
             print("MQTT Error: ", _e)
             result.append(e)
 
+    def publish(topic, data):
+        print("MQTT publish ", topic, data)
+        mqtt_client.publish(topic, json.dumps(data))
+
     while 1:
         while ota_lock:
             print("MQTT OTA lock")
@@ -1285,15 +1282,12 @@ async def mqtt_worker():
             # The below functions should be run as often as possible.
             # There may be a problem with the connection. (MQTTException(7,), 9)
             # In the following way, we clear the queue.
-            if mqtt_publish_buffer:
-                print(f"MQTT publish buffer\n{mqtt_publish_buffer}")
+            if len(mqtt_publish_buffer):
+                print("MQTT publish buffer: ", mqtt_publish_buffer.metrics())
 
             for _ in range(50):
                 # print("mqtt check_msg")
-                for msg in mqtt_publish_buffer:
-                    print("MQTT publish ", msg)
-                    mqtt_client.publish(msg["topic"], json.dumps(msg["data"]))
-                mqtt_publish_buffer = []
+                mqtt_publish_buffer.flush(publish)
                 if (_ + 1) % 20 == 0:
                     msg = {"free_mem": gc.mem_free() // 1024}
                     mqtt_client.publish(f"{doser_topic}/free_mem", json.dumps(msg))
@@ -1309,79 +1303,67 @@ async def mqtt_worker():
         await asyncio.sleep(0.5)
 
 
-mqtt_dose_buffer = []
-mqtt_run_buffer = []
-mqtt_stop_buffer = []
-mqtt_refill_buffer = []
-mqtt_publish_buffer = []
-
-
-async def process_mqtt_cmd():
-    while True:
-        if mqtt_dose_buffer:
-            print("Process mqtt Dose command")
-            command = mqtt_dose_buffer[0]
-            del mqtt_dose_buffer[0]
-            desired_flow = command["amount"] * (60 / command["duration"])
-            print(f"Desired flow: {round(desired_flow, 2)}")
-            print(f"Direction: {command['direction']}")
-            desired_rpm_rate = np.interp(desired_flow, chart_points[f"pump{command['id']}"][1],
-                                         chart_points[f"pump{command['id']}"][0])
-            print("Calculated RPM: ", desired_rpm_rate)
-            await command_buffer.add_command(stepper_run, None, mks_dict[f"mks{command['id']}"], desired_rpm_rate,
-                                             command['duration'], command['direction'], rpm_table,
-                                             limits_dict[int(command['id'])], pump_dose=command["amount"],
-                                             pump_id=int(command['id']))
-
-        if mqtt_run_buffer:
-            print("Process mqtt Run command")
-            command = mqtt_run_buffer[0]
-            del mqtt_run_buffer[0]
-            print(f"Direction: {command['direction']}")
-            desired_rpm_rate = command['rpm']
-            print("Desired RPM: ", desired_rpm_rate)
-            await command_buffer.add_command(stepper_run, None, mks_dict[f"mks{command['id']}"], desired_rpm_rate,
-                                             command['duration'], command['direction'], rpm_table,
-                                             limits_dict[int(command['id'])], pump_dose=None,
-                                             pump_id=int(command['id']))
-
-        if mqtt_stop_buffer:
-            print("Process mqtt Stop command")
-            command = mqtt_stop_buffer[0]
-            del mqtt_stop_buffer[0]
-            print(f"Stop pump{command['id']}")
-            await command_buffer.add_command(stepper_stop, None, mks_dict[f"mks{command['id']}"])
-
-        if mqtt_refill_buffer:
-            print("Process mqtt refill command")
-            command = mqtt_refill_buffer[0]
-            del mqtt_refill_buffer[0]
-            print(f"Refilling pump{command['id']} storage")
-            storage[f"remaining{command['id']}"] = storage[f"pump{command['id']}"]
-            print("Publish to mqtt")
-            _pump_id = command['id']
-            _topic = f"{doser_topic}/pump{_pump_id}"
-            _data = {"id": _pump_id, "name": pump_names[_pump_id - 1], "dose": 0,
-                     "remain": storage[f"remaining{_pump_id}"], "storage": storage[f"pump{_pump_id}"]}
-            print("data", _data)
-            print({"topic": _topic, "data": _data})
-            mqtt_publish_buffer.append({"topic": _topic, "data": _data})
-
-        await asyncio.sleep(1)
+mqtt_publish_buffer = PublishBuffer()
+
+
+async def process_mqtt_cmd(kind, command):
+    if kind == "dose":
+        print("Process mqtt Dose command")
+        desired_flow = command["amount"] * (60 / command["duration"])
+        print(f"Desired flow: {round(desired_flow, 2)}")
+        print(f"Direction: {command['direction']}")
+        plan = dose_planner.plan(int(command['id']), command["amount"], command['duration'],
+                                 command['direction'])
+        print("Calculated RPM: ", plan[0])
+        await command_buffer.add_command(stepper_run, None, mks_dict[f"mks{command['id']}"], plan[0],
+                                         command['duration'], command['direction'], rpm_table,
+                                         limits_dict[int(command['id'])], pump_dose=command["amount"],
+                                         pump_id=int(command['id']), plan=plan)
+
+    elif kind == "run":
+        print("Process mqtt Run command")
+        print(f"Direction: {command['direction']}")
+        desired_rpm_rate = command['rpm']
+        print("Desired RPM: ", desired_rpm_rate)
+        await command_buffer.add_command(stepper_run, None, mks_dict[f"mks{command['id']}"], desired_rpm_rate,
+                                         command['duration'], command['direction'], rpm_table,
+                                         limits_dict[int(command['id'])], pump_dose=None,
+                                         pump_id=int(command['id']))
+
+    elif kind == "stop":
+        print("Process mqtt Stop command")
+        print(f"Stop pump{command['id']}")
+        await command_buffer.add_command(stepper_stop, None, mks_dict[f"mks{command['id']}"],
+                                         priority=PRIORITY_STOP)
+
+    elif kind == "refill":
+        print("Process mqtt refill command")
+        print(f"Refilling pump{command['id']} storage")
+        storage[f"remaining{command['id']}"] = storage[f"pump{command['id']}"]
+        dose_journal.append(command['id'], 0, storage[f"remaining{command['id']}"])
+        state_bus.notify("Storage")
+        print("Publish to mqtt")
+        _pump_id = command['id']
+        _topic = f"{doser_topic}/pump{_pump_id}"
+        _data = {"id": _pump_id, "name": pump_names[_pump_id - 1], "dose": 0,
+                 "remain": storage[f"remaining{_pump_id}"], "storage": storage[f"pump{_pump_id}"]}
+        print("data", _data)
+        print({"topic": _topic, "data": _data})
+        mqtt_publish_buffer.push(_topic, _data)
+
+
+# Commands from the MQTT callback, stops are processed ahead of doses
+mqtt_commands = CommandQueue(process_mqtt_cmd)
 
 
 async def storage_tracker():
-    global storage
-    _old_storage = storage.copy()
     while True:
-        if _old_storage != storage:
-            with open('config/storage.json', 'w') as _write_file:
-                # Print the new remaining values
-                print("Store new remaining values: ", storage)
-                json.dump(storage, _write_file)
-                # Update the old remaining values
-                _old_storage = _old_storage.copy()
         await asyncio.sleep(3600)
+        dose_history.flush()
+        if dose_journal.records:
+            # Fold the dose journal into the storage snapshot
+            print("Store new remaining values: ", storage)
+            dose_journal.compact()
 
 
 telegram_buffer = []
@@ -1504,10 +1486,14 @@ async def main():
         asyncio.create_task(maintain_wifi(ssid, password, hostname)),
         asyncio.create_task(maintain_memory()),
         asyncio.create_task(mqtt_worker()),
-        asyncio.create_task(process_mqtt_cmd()),
+        asyncio.create_task(mqtt_commands.dispatch()),
         asyncio.create_task(storage_tracker()),
+        asyncio.create_task(config_store.saver()),
         asyncio.create_task(telegram_worker()),
-        asyncio.create_task(whatsapp_worker())
+        asyncio.create_task(whatsapp_worker()),
+        asyncio.create_task(time_producer()),
+        asyncio.create_task(dose_producer()),
+        asyncio.create_task(job_queue.dispatch())
     ]
 
     # load async tasks from extension
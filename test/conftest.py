@@ -102,4 +102,5 @@ def rpm_table(pyboard, request):
     pyboard.exec("from load_configs import *")
     pyboard.exec("np.set_printoptions(threshold=sys.maxsize)")
     pyboard.exec(f"mks = Servo42c(uart, {int(request.config.getoption('stepper_addr'))}, mstep=1)")
+    pyboard.exec("mks.init()")
     pyboard.exec("mks.set_current(1000)")
@@ -0,0 +1,70 @@
+import asyncio
+import json
+import os
+
+from src.lib.asset_cache import *
+
+
+class FakeRequest:
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+
+class CountingStream:
+    def __init__(self):
+        self.data = b''
+
+    async def awrite(self, data):
+        self.data += bytes(data)
+
+
+def write_response(response):
+    stream = CountingStream()
+    asyncio.run(response.write(stream))
+    return stream.data
+
+
+def test_local_etag(tmp_path):
+    static = tmp_path / "static"
+    (static / "javascript").mkdir(parents=True)
+    (static / "javascript" / "chart.min.js.gz").write_bytes(b"compressed chart")
+    (static / "doser.html").write_bytes(b"<html>doser</html>")
+    (static / "etags.json").write_text(json.dumps({"javascript/chart.min.js.gz": "0123456789abcdef"}))
+
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        assets = AssetCache()
+        # Build manifest hash, file on disk is not read to get it
+        response = assets.send_file(FakeRequest(), 'static/javascript/chart.min.js', max_age=ASSET_MAX_AGE,
+                                    compressed=True, file_extension='.gz', stream=b"compressed chart")
+        assert response.headers['ETag'] == '"0123456789abcdef"'
+        assert response.headers['Cache-Control'] == f'max-age={ASSET_MAX_AGE}'
+        assert write_response(response).endswith(b"compressed chart")
+
+        response = assets.send_file(FakeRequest({'If-None-Match': '"0123456789abcdef"'}),
+                                    'static/javascript/chart.min.js', max_age=ASSET_MAX_AGE,
+                                    compressed=True, file_extension='.gz')
+        assert response.status_code == 304
+        data = write_response(response)
+        # No body and no representation headers in 304
+        assert data.endswith(b'\r\n\r\n') and b'Content-Length' not in data and b'Content-Type' not in data
+        assert b'ETag: "0123456789abcdef"' in data
+
+        # File missing in the manifest is hashed once, pages are revalidated on every load
+        etag = assets.etag('./static/doser.html')
+        assert assets.etags['doser.html'] == etag.strip('"') and len(etag) == ETAG_LENGTH + 2
+        response = assets.send_file(FakeRequest({'If-None-Match': f'W/{etag}, "other"'}), './static/doser.html')
+        assert response.status_code == 304 and response.headers['Cache-Control'] == 'no-cache'
+        response = assets.send_file(FakeRequest({'If-None-Match': '"stale"'}), './static/doser.html')
+        assert response.status_code == 200
+        assert write_response(response).endswith(b"<html>doser</html>")
+        assert assets.not_modified == 2
+    finally:
+        os.chdir(cwd)
+
+
+def test_local_etag_without_manifest(tmp_path):
+    assets = AssetCache(str(tmp_path / "etags.json"))
+    assert assets.etags == {}
+    assert assets.etag(str(tmp_path / "missing.js")) is None
@@ -0,0 +1,154 @@
+import asyncio
+
+from src.lib.asyncscheduler import *
+
+
+class Pump:
+    def __init__(self, addr):
+        self.addr = addr
+
+
+def test_local_stop_ahead_of_doses():
+    order = []
+
+    async def command(pump, name, delay=0):
+        await asyncio.sleep(delay)
+        order.append((pump.addr, name))
+        return name
+
+    async def run():
+        buffer = CommandBuffer()
+        pump1, pump2, pump3 = Pump(224), Pump(225), Pump(226)
+        # Slow command for pump1 is already on the bus
+        await buffer.add_command(command, None, pump1, "slow", 0.05)
+        await asyncio.sleep(0)
+        for _ in range(3):
+            await buffer.add_command(command, None, pump1, "dose")
+        await buffer.add_command(command, None, pump2, "dose")
+        await buffer.add_command(command, None, pump3, "read", priority=PRIORITY_READ)
+        await buffer.add_command(command, None, pump3, "stop", priority=PRIORITY_STOP)
+        assert buffer.metrics()["depth"] == 6
+        assert buffer.metrics()["pumps"] == {"224": 3, "225": 1, "226": 2}
+        await buffer.task
+        return buffer
+
+    buffer = asyncio.run(run())
+    assert order == [(224, "slow"), (226, "stop"), (224, "dose"), (225, "dose"), (224, "dose"), (224, "dose"),
+                     (226, "read")]
+    metrics = buffer.metrics()
+    assert metrics["depth"] == 0
+    assert metrics["processed"] == 7
+    assert metrics["wait_max_ms"] >= 40
+
+
+def test_local_callback_result():
+    results = []
+
+    async def command(pump):
+        return pump.addr
+
+    async def run():
+        buffer = CommandBuffer()
+        await buffer.add_command(command, results.append, Pump(224))
+        await buffer.task
+        # Processing task restarts after the buffer was drained
+        await buffer.add_command(command, results.append, Pump(225))
+        await buffer.task
+
+    asyncio.run(run())
+    assert results == [224, 225]
+
+
+def test_local_job_queue():
+    dispatched = []
+
+    async def handler(callback_id, current_time):
+        await asyncio.sleep(0.01)
+        dispatched.append((callback_id, current_time))
+
+    async def run():
+        queue = JobQueue(handler, size=4)
+        task = asyncio.create_task(queue.dispatch())
+        # Timer callback fires several jobs in one tick, the ring buffer keeps size - 1 of them
+        for job in range(5):
+            queue.push(f"mcron_{job}", 1000 + job, {})
+        assert len(queue) == 3
+        await asyncio.sleep(0.1)
+        assert dispatched == [("mcron_0", 1000), ("mcron_1", 1001), ("mcron_2", 1002)]
+
+        queue.push("mcron_5", 1005, {})
+        await asyncio.sleep(0.05)
+        assert dispatched[-1] == ("mcron_5", 1005)
+        metrics = queue.metrics()
+        assert metrics["depth"] == 0
+        assert metrics["dispatched"] == 4
+        assert metrics["dropped"] == 2
+        # Last job of the burst waited for the two before it
+        assert metrics["late_max_ms"] >= 20
+        task.cancel()
+
+    asyncio.run(run())
+
+
+def test_local_publish_buffer():
+    buffer = PublishBuffer(size=4)
+    for remain in (90, 80, 70):
+        buffer.push("doser/pump1", {"remain": remain})
+    buffer.push("doser/pump2", {"remain": 50})
+    # Backlogged state of a pump is replaced by the latest one
+    assert len(buffer) == 2 and buffer.coalesced == 2
+    buffer.push("doser/log", "a", coalesce=False)
+    buffer.push("doser/pump1", {"remain": 60})
+    assert len(buffer) == 3 and buffer.coalesced == 3
+    # Full buffer drops the oldest message
+    buffer.push("doser/log", "b", coalesce=False)
+    assert len(buffer) == 3 and buffer.dropped == 1
+
+    published = []
+
+    def publish(topic, message):
+        if message == "b":
+            raise OSError("MQTT connection lost")
+        published.append((topic, message))
+
+    assert buffer.flush(publish, limit=1) == 1
+    # Failed message stays in the buffer, messages sent before it are counted
+    try:
+        buffer.flush(publish)
+    except OSError:
+        pass
+    assert published == [("doser/pump2", {"remain": 50}), ("doser/log", "a")]
+    assert len(buffer) == 1 and buffer.published == 2
+    buffer.pop()
+    buffer.push("doser/pump1", {"remain": 50})
+    assert buffer.flush(publish) == 1 and published[-1] == ("doser/pump1", {"remain": 50})
+    assert buffer.metrics() == {"depth": 0, "published": 3, "dropped": 1, "coalesced": 3}
+
+
+def test_local_command_queue():
+    handled = []
+
+    async def handler(kind, command):
+        await asyncio.sleep(0)
+        handled.append((kind, command["id"]))
+
+    async def run():
+        queue = CommandQueue(handler, size=4)
+        task = asyncio.create_task(queue.dispatch())
+        # Burst of commands from the MQTT callback, the queue keeps size - 1 of each priority
+        for pump in range(1, 5):
+            queue.push("dose", {"id": pump})
+        queue.push("refill", {"id": 5})
+        queue.push("stop", {"id": 1}, priority=PRIORITY_STOP)
+        assert len(queue) == 4
+        await asyncio.sleep(0.01)
+        # Stop goes ahead of the doses, the whole burst is handled in one wakeup
+        assert handled == [("stop", 1), ("dose", 1), ("dose", 2), ("dose", 3)]
+        assert queue.metrics() == {"depth": 0, "processed": 4, "dropped": 2, "wakeups": 1}
+
+        queue.push("run", {"id": 2})
+        await asyncio.sleep(0.01)
+        assert handled[-1] == ("run", 2) and queue.wakeups == 2
+        task.cancel()
+
+    asyncio.run(run())
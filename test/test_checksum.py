@@ -0,0 +1,88 @@
+import json
+import time
+import os
+
+import pytest
+from src.lib.checksum import *
+
+
+def lookup(target_device, command):
+    return target_device.exec("print(" + command + ")").decode("utf-8").strip()
+
+
+# Bitwise CRC-8/ATM of older firmware
+def crc8_8_atm(msg):
+    crc = 0xFF
+    for byte in msg:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x07 if crc & 0x80 else crc << 1
+        crc &= 0xff
+    return crc ^ 0x00
+
+
+def test_local_crc8():
+    assert len(CRC8_TABLE) == 256
+    for data in [b"", b"\x00", b"123456789", bytes(range(256)), os.urandom(1000)]:
+        assert crc8(data) == crc8_8_atm(data)
+    # Incremental crc over chunks is the same as crc of the whole data
+    data = os.urandom(5000)
+    assert crc8(data[3000:], crc8(data[:3000])) == crc8(data)
+    assert crc8(memoryview(data)) == crc8(data)
+
+
+def test_local_file_checksums(tmp_path):
+    import hashlib
+    data = os.urandom(10000)
+    filename = str(tmp_path / "micropython.bin")
+    with open(filename, "wb") as write_file:
+        write_file.write(data)
+
+    sha = hashlib.sha256(data).hexdigest()
+    assert file_sha256(filename) == (len(data), sha)
+    assert verify_image(filename, len(data), sha.upper()) == sha
+    assert verify_image(filename, len(data)) == sha
+    with pytest.raises(ValueError):
+        verify_image(filename, len(data) + 1, sha)
+    with pytest.raises(ValueError):
+        verify_image(filename, len(data), "0" * 64)
+
+
+def test_local_json_config(tmp_path):
+    filename = str(tmp_path / "storage.json")
+    storage = {"pump1": 10, "remaining1": 250.5}
+    with open(filename, "w") as write_file:
+        write_file.write(json.dumps(storage))
+    assert load_json(filename) == storage
+
+    # Torn config
+    with open(filename, "w") as write_file:
+        write_file.write('{"pump1": 11, "remai')
+    with pytest.raises(ValueError):
+        load_json(filename)
+
+
+def test_local_crc8_benchmark():
+    data = os.urandom(256 * 1024)
+    start_time = time.time()
+    table_crc = crc8(data)
+    table_time = time.time() - start_time
+
+    start_time = time.time()
+    bitwise_crc = crc8_8_atm(data)
+    bitwise_time = time.time() - start_time
+
+    assert table_crc == bitwise_crc
+    size = len(data) / 1024 / 1024
+    print(f"\r\nCRC-8 table: {size / table_time:.2f} MB/s, bitwise: {size / bitwise_time:.2f} MB/s")
+    assert table_time < bitwise_time
+
+
+def test_crc8_benchmark(pyboard):
+    esp32 = pyboard
+    esp32.exec("from lib.checksum import *")
+    esp32.exec("import time")
+    esp32.exec("data = bytes(range(256)) * 256")
+    time_ms = int(lookup(esp32, "(lambda t: (crc8(data), time.ticks_diff(time.ticks_ms(), t))[1])(time.ticks_ms())"))
+    size = 256 * 256 / 1024 / 1024
+    print(f"\r\nCRC-8 viper: {size / max(time_ms, 1) * 1000:.2f} MB/s")
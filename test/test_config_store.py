@@ -0,0 +1,73 @@
+import asyncio
+import json
+
+from src.lib.config_store import *
+
+
+def make_store(tmp_path, **kwargs):
+    legacy_files = {"settings": str(tmp_path / "settings.json"), "storage": str(tmp_path / "storage.json")}
+    return ConfigStore(str(tmp_path / "config.json"), legacy_files, **kwargs)
+
+
+def test_local_config_migration(tmp_path):
+    (tmp_path / "settings.json").write_text(json.dumps({"pump_number": "3", "timezone": "bad"}))
+    (tmp_path / "storage.json").write_text("{broken")
+    store = make_store(tmp_path).load()
+    # Broken legacy file falls back to the defaults
+    assert store.section("storage") == {}
+    assert store.dirty == {"settings"}
+    assert store.get("settings", "pump_number", 1, int) == 3
+    assert store.get("settings", "timezone", 0.0, float) == 0.0
+    assert store.get("settings", "hostname", "doser", str) == "doser"
+    assert store.get("wifi", "ssid", "", str) == ""
+
+    store.section("storage")["remaining1"] = 100
+    store.mark_dirty("storage")
+    store.set("limits", "1", "True")
+    # All sections are saved with one write
+    assert store.commit() and store.commits == 1 and store.dirty == set()
+    assert not store.commit()
+    # Migrated file is renamed, the broken one is left for inspection
+    assert not (tmp_path / "settings.json").exists()
+    assert (tmp_path / ("settings.json" + MIGRATED_SUFFIX)).exists()
+    assert (tmp_path / "storage.json").exists() and store.migrated == []
+
+    loaded = make_store(tmp_path).load()
+    assert loaded.dirty == set()
+    assert loaded.sections == {"settings": {"pump_number": "3", "timezone": "bad"}, "storage": {"remaining1": 100},
+                               "limits": {"1": "True"}}
+
+
+def test_local_config_recovery(tmp_path):
+    store = make_store(tmp_path).load()
+    store.replace("storage", {"remaining1": 50})
+    store.commit()
+    filename = tmp_path / "config.json"
+    data = filename.read_bytes()
+
+    # Power lost after the temporary file was written, before the rename
+    filename.unlink()
+    (tmp_path / ("config.json" + TMP_SUFFIX)).write_bytes(data)
+    assert make_store(tmp_path).load().section("storage") == {"remaining1": 50}
+
+    # Torn file fails the checksum
+    filename.write_bytes(data[:-3])
+    (tmp_path / ("config.json" + TMP_SUFFIX)).unlink()
+    assert make_store(tmp_path).read() == {}
+
+
+def test_local_config_saver(tmp_path):
+    store = make_store(tmp_path, delay=0.05).load()
+
+    async def main():
+        task = asyncio.create_task(store.saver())
+        for _ in range(10):
+            store.set("storage", "remaining1", _)
+            await asyncio.sleep(0.001)
+        await asyncio.sleep(0.2)
+        task.cancel()
+
+    asyncio.run(main())
+    # Burst of changes is coalesced in a single write
+    assert store.commits == 1
+    assert make_store(tmp_path).load().section("storage") == {"remaining1": 9}
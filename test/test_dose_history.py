@@ -0,0 +1,65 @@
+import json
+
+from src.lib.dose_history import *
+
+
+def test_local_dose_history(tmp_path):
+    filename = str(tmp_path / "history{}.bin")
+    history = DoseHistory(2, filename, size=8, block_size=4)
+    day = 20000
+    for _ in range(10):
+        flags = FLAG_LIMITED | FLAG_SKIPPED if _ == 9 else FLAG_SCHEDULED
+        history.append(1, 1.5, flags, timestamp=day * DAY + _ * 3600)
+    history.append(2, 10, timestamp=(day - 1) * DAY)
+
+    pump = history.pump(1)
+    # Oldest doses are overwritten
+    assert pump.count == 8 and pump.head == 2
+    assert [_[0] // 3600 % 24 for _ in pump.records()] == list(range(2, 10))
+    # Totals are kept for overwritten records, skipped doses are not counted
+    assert pump.daily_total(day) == 13.5
+    assert history.pump(2).weekly_totals(day) == [0, 0, 0, 0, 0, 10, 0]
+    # Full blocks are written as they fill
+    assert pump.writes == 2 and pump.unsaved == 2
+
+    history.flush()
+    assert pump.writes == 3 and history.pump(2).writes == 1
+    assert (tmp_path / "history1.bin").stat().st_size == 9 * 8 + 8 * WEEK_DAYS + 8
+
+    loaded = DoseHistory(2, filename, size=8, block_size=4).load()
+    assert list(loaded.pump(1).records()) == list(pump.records())
+    # Totals of the overwritten records are saved with the blocks
+    assert loaded.pump(1).head == 2 and loaded.pump(1).daily_total(day) == 13.5
+    assert loaded.pump(2).weekly_totals(day) == [0, 0, 0, 0, 0, 10, 0]
+    assert loaded.pump(2).count == 1
+
+    start, end = day * DAY + 4 * 3600, day * DAY + 7 * 3600
+    chunks = list(loaded.json_chunks(1, start, end, day=day, chunk=3))
+    assert len(chunks) == 4
+    result = json.loads("".join(chunks))
+    assert result["daily"][-1] == 13.5 and result["weekly"] == 13.5
+    assert [_[0] for _ in result["doses"]] == list(range(start, end + 1, 3600))
+    assert result["doses"][0][1:] == [1.5, FLAG_SCHEDULED]
+
+    assert json.loads("".join(loaded.json_chunks(2, end=0, day=day)))["doses"] == []
+    assert DoseHistory(1, str(tmp_path / "missing{}.bin")).load().pump(1).count == 0
+
+    # Saved head is used even if the clock went back, the records stay in the order they were written
+    history = DoseHistory(1, str(tmp_path / "clock{}.bin"), size=8, block_size=4)
+    for timestamp in (day * DAY + 3600, day * DAY + 7200, day * DAY - 60):
+        history.append(1, 1, timestamp=timestamp)
+    history.flush()
+    loaded = DoseHistory(1, str(tmp_path / "clock{}.bin"), size=8, block_size=4).load().pump(1)
+    assert (loaded.head, loaded.count) == (3, 3)
+    assert [_[0] for _ in loaded.records()] == [day * DAY + 3600, day * DAY + 7200, day * DAY - 60]
+
+    # File of older firmware without head and count, the newest record is found by the timestamps
+    with open(tmp_path / "history1.bin", "r+b") as history_file:
+        history_file.truncate(9 * 8 + 8 * WEEK_DAYS)
+    loaded = DoseHistory(1, filename, size=8, block_size=4).load().pump(1)
+    assert loaded.head == 2 and loaded.count == 8 and loaded.daily_total(day) == 13.5
+
+    # File without the totals, they are rebuilt from the records
+    with open(tmp_path / "history1.bin", "r+b") as history_file:
+        history_file.truncate(9 * 8)
+    assert DoseHistory(1, filename, size=8, block_size=4).load().pump(1).daily_total(day) == 10.5
@@ -0,0 +1,74 @@
+from src.lib.dose_journal import *
+
+
+class Snapshot:
+    def __init__(self, storage):
+        self.storage = storage
+        self.saved = dict(storage)
+        self.writes = 0
+
+    def __call__(self):
+        self.saved = dict(self.storage)
+        self.writes += 1
+
+
+def test_local_dose_journal(tmp_path):
+    filename = str(tmp_path / "dose_journal.bin")
+    storage = {"pump1": 1000, "remaining1": 1000, "pump2": 500, "remaining2": 500}
+    snapshot = Snapshot(storage)
+    journal = DoseJournal(snapshot, filename, max_records=5)
+    for remaining in (990, 980.5, 970.25):
+        storage["remaining1"] = remaining
+        journal.append(1, 10, remaining, timestamp=1000)
+    storage["remaining2"] = 500
+    journal.append(2, 0, 500, timestamp=1001)
+    assert snapshot.writes == 0 and journal.records == 4
+    assert (tmp_path / "dose_journal.bin").stat().st_size == 4 * RECORD_SIZE
+
+    # Power lost in the middle of the next record
+    with open(filename, "ab") as write_file:
+        write_file.write(encode_record(1, 1002, 10, 960.25)[:RECORD_SIZE - 3])
+
+    booted = dict(snapshot.saved)
+    rebooted = DoseJournal(Snapshot(booted), filename, max_records=5)
+    assert rebooted.replay(booted) == 4
+    assert booted == {"pump1": 1000, "remaining1": 970.25, "pump2": 500, "remaining2": 500}
+    # Replay over the snapshot that already has the records is a no-op
+    assert rebooted.replay(booted) == 4 and booted["remaining1"] == 970.25
+
+    # Full journal is folded into the snapshot
+    journal.append(1, 10, 960.25)
+    assert snapshot.writes == 1 and journal.records == 0 and journal.compactions == 1
+    assert not (tmp_path / "dose_journal.bin").exists()
+    assert list(journal.read()) == []
+
+
+def test_local_dose_journal_corrupted(tmp_path):
+    filename = tmp_path / "dose_journal.bin"
+    data = encode_record(1, 1000, 5, 95) + encode_record(1, 1001, 5, 90)
+    # Flipped bit in the second record, the rest of the journal is not trusted
+    filename.write_bytes(data[:RECORD_SIZE + 2] + bytes((data[RECORD_SIZE + 2] ^ 1,)) + data[RECORD_SIZE + 3:])
+    storage = {"remaining1": 100}
+    assert DoseJournal(None, str(filename)).replay(storage) == 1
+    assert storage == {"remaining1": 95}
+
+
+def test_local_dose_journal_torn_first_record(tmp_path):
+    filename = tmp_path / "dose_journal.bin"
+    # Power lost while the first record of an empty journal was written
+    filename.write_bytes(encode_record(1, 1000, 5, 95)[:7])
+    storage = {"remaining1": 100}
+    snapshot = Snapshot(storage)
+    journal = DoseJournal(snapshot, str(filename))
+    assert journal.replay(storage) == 0 and journal.torn
+    # Boot compacts the torn journal, so the next appends are aligned
+    journal.compact()
+    storage["remaining1"] = 90
+    journal.append(1, 10, 90)
+    storage["remaining1"] = 80
+    journal.append(1, 10, 80)
+
+    booted = {"remaining1": 100}
+    rebooted = DoseJournal(Snapshot(booted), str(filename))
+    assert rebooted.replay(booted) == 2 and not rebooted.torn
+    assert booted == {"remaining1": 80}
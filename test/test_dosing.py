@@ -241,3 +241,104 @@ def test_mks_angle_stability_fixed_mstep(rpm_table, pyboard):
             print("-" * 20, f"\n\n\n\nERROR: {angle_error}")
             errors.append(angle_error)
     assert len(errors) == 0
+
+
+class FakeUart:
+    def __init__(self, replies=()):
+        self.written = []
+        self.replies = list(replies)
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def read(self, size=None):
+        return self.replies.pop(0) if self.replies else None
+
+
+def test_local_async_servo_commands():
+    import asyncio
+    ok = b"\xe1\x01\xe2"
+    uart = FakeUart()
+    mks = Servo42c(uart, 1)
+    uart.written = []
+
+    uart.replies = [ok, ok, ok]
+    assert asyncio.run(mks.aset_mstep(16))
+    assert mks.mstep == 16
+    assert uart.written == [b"\xe1\xf7\xd8", b"\xe1\x84\x10\x75"]
+
+    uart.written = []
+    uart.replies = [ok]
+    runtime = asyncio.run(mks.amake_steps(3200, speed=10, direction=1, stop=False))
+    assert uart.written == [b"\xe1\xfd\x8a\x00\x00\x0c\x80\xf4"]
+    assert round(runtime, 3) == round(3200 * mks.sec_in_pulse, 3)
+
+    uart.replies = [b"\xe1\x00\x00\x01\x00\x00"]
+    assert asyncio.run(mks.aread_pulses()) == 256
+
+    uart.replies = [None]
+    assert asyncio.run(mks.astop()) is False
+
+    # Blocking API runs the same async commands
+    uart.written = []
+    uart.replies = [ok, ok, ok]
+    assert run_move(mks, 32, 10, 3200, direction=1)
+    assert mks.mstep == 32
+    assert uart.written == [b"\xe1\xf7\xd8", b"\xe1\x84\x20\x85", b"\xe1\xfd\x8a\x00\x00\x0c\x80\xf4"]
+    uart.replies = [b"\xe1\x00\x00\x01\x00\x00"]
+    assert mks.read_pulses() == 256
+
+
+def test_local_shared_uart_lock():
+    import asyncio
+    ok = b"\xe1\x01\xe2"
+    uart = FakeUart()
+    mks1, mks2 = Servo42c(uart, 1, mstep=16), Servo42c(uart, 1)
+    # Constructor doesn't talk to the driver
+    assert uart.written == []
+    assert mks1.stream is mks2.stream
+
+    async def run():
+        uart.replies = [ok, ok, ok]
+        async with mks1.stream.lock:
+            task = asyncio.create_task(mks2.astop())
+            await asyncio.sleep(0)
+            # Command waits until the reply of the running one is read
+            assert uart.written == []
+        assert await task
+        await mks1.ainit()
+        assert mks1.mstep == 16
+        assert uart.written == [b"\xe1\xf7\xd8", b"\xe1\xf7\xd8", b"\xe1\x84\x10\x75"]
+
+    asyncio.run(run())
+
+
+def test_local_frame_encoder():
+    frames = FrameEncoder(0xE1)
+    for cmd in [48, 51, 247]:
+        assert bytes(frames.command(cmd)) == bytes([0xE1, cmd, calc_crc(0xE1, cmd)])
+    assert bytes(frames.command_byte(132, 16)) == bytes([0xE1, 132, 16, calc_crc(0xE1, 132, 16)])
+    for steps in [0, 1, 3200, 2 ** 31 - 1]:
+        pulses = list(steps.to_bytes(4, 'big'))
+        expected = bytes([0xE1, 253, 0x8A] + pulses + [calc_crc(0xE1, 253, 0x8A, *pulses)])
+        assert bytes(frames.make_steps(0x8A, steps)) == expected
+
+
+def test_local_frame_benchmark():
+    frames_number = 20000
+
+    start_time = time.perf_counter()
+    for steps in range(frames_number):
+        pulses_reg = [x for x in steps.to_bytes(4, 'big')]
+        crc = calc_crc(0xE1, 253, 0x8A, *pulses_reg)
+        bytes([0xE1, 253, 0x8A] + pulses_reg + [crc])
+    legacy_time = time.perf_counter() - start_time
+
+    frames = FrameEncoder(0xE1)
+    start_time = time.perf_counter()
+    for steps in range(frames_number):
+        frames.make_steps(0x8A, steps)
+    encoder_time = time.perf_counter() - start_time
+
+    print(f"\nList frames: {int(frames_number / legacy_time)} frames/sec, "
+          f"FrameEncoder: {int(frames_number / encoder_time)} frames/sec")
@@ -0,0 +1,59 @@
+import time
+
+from src.lib.exec_code import *
+
+
+def legacy_evaluate(expression, allowed_vars, blacklist):
+    allowed_vars = {key: val for key, val in allowed_vars.items() if key not in list(blacklist)}
+    return eval(expression, {"__builtins__": None}, allowed_vars)
+
+
+def test_local_evaluate_expression():
+    expression_cache.clear()
+    storage = {"remaining1": 100}
+    state = {"storage": storage}
+    values = {"storage": lambda: state["storage"], "adc_dict": lambda: {5: 700}}
+    expression = "storage['remaining1'] > 50 and adc_dict[5] < 800"
+
+    assert evaluate_expression(expression, values)[0] is True
+    code = expression_cache[expression][0]
+    # Live value is seen by the cached code, also after the global is rebound
+    storage["remaining1"] = 10
+    assert evaluate_expression(expression, values)[0] is False
+    state["storage"] = {"remaining1": 60}
+    assert evaluate_expression(expression, values)[0] is True
+    assert expression_cache[expression][0] is code
+
+    # Names outside of the whitelist, builtins and syntax errors are not evaluated
+    assert evaluate_expression("os", values)[0] is None
+    assert evaluate_expression("len(storage)", values)[0] is None
+    assert evaluate_expression("unknown > 1", values)[0] is None
+    assert evaluate_expression("1 >", values)[0] is None
+
+    compile_limits({1: "True", 2: "storage['remaining1'] > 5"}, values)
+    assert "storage['remaining1'] > 5" in expression_cache
+    assert [name for name, _ in expression_cache["storage['remaining1'] > 5"][2]] == ["storage"]
+    names = expression_names("storage['remaining1'] > 5 and os.x1 or _t")
+    assert sorted(names) == ["_t", "and", "or", "os", "remaining1", "storage", "x1"]
+
+
+def test_local_evaluate_expression_benchmark():
+    allowed_vars = {f"var{index}": index for index in range(200)}
+    blacklist = {f"module{index}" for index in range(150)}
+    allowed_vars.update({key: None for key in blacklist})
+    allowed_vars["storage"] = {"remaining1": 100}
+    values = {"storage": lambda: allowed_vars["storage"], "var10": lambda: allowed_vars["var10"]}
+    expression = "storage['remaining1'] > 50 and var10 < 20"
+
+    runs = 2000
+    start_time = time.time()
+    for _ in range(runs):
+        legacy_evaluate(expression, allowed_vars, blacklist)
+    legacy_time = time.time() - start_time
+
+    start_time = time.time()
+    for _ in range(runs):
+        assert evaluate_expression(expression, values)[0] is True
+    cached_time = time.time() - start_time
+    print(f"\r\nLegacy eval: {legacy_time / runs * 1e6:.1f}us, cached: {cached_time / runs * 1e6:.1f}us")
+    assert cached_time < legacy_time
@@ -1,4 +1,5 @@
 import time
+import os
 
 import pytest
 import sys
@@ -16,7 +17,9 @@ def free_mem(pyb):
     return ret // 1024
 
 
-def test_local_make_rpm_table():
+def test_local_make_rpm_table(tmp_path, monkeypatch):
+    # Generated table is written to the working directory
+    monkeypatch.chdir(tmp_path)
     print("\r\n")
     start_time = time.time()
     table = make_rpm_table(regenerate=True)
@@ -171,4 +174,173 @@ def test_find_closest_rpm(pyboard):
               f"{round(end_time- start_time, 3): <6}")
         assert rpm_error <= 1.3
     print(f"Max error: {round(max_error, 3)}")
-    print(f"Max time:  {round(max_time, 3)}")
\ No newline at end of file
+    print(f"Max time:  {round(max_time, 3)}")
+
+def legacy_closest_combinations(rpm_steps):
+    # Reference double loop with full grid scan for every combination
+    closest_rpms = np.zeros(len(rpm_steps), dtype=np.float)
+    closest_msteps = np.zeros(len(rpm_steps), dtype=np.uint8)
+    closest_speeds = np.zeros(len(rpm_steps), dtype=np.uint8)
+    for speed in range(SPEED_MIN, SPEED_NUM + 1):
+        for mstep in range(MIN_MSTEP, MSTEP_MAX + 1):
+            rpm = calc_real_rpm(mstep, speed)
+            if rpm > MAX_RPM:
+                continue
+            nearest_step_index = np.argmin(abs(rpm_steps - rpm))
+            if closest_rpms[nearest_step_index] == 0 or abs(rpm - rpm_steps[nearest_step_index]) < abs(
+                    closest_rpms[nearest_step_index] - rpm_steps[nearest_step_index]):
+                closest_rpms[nearest_step_index] = rpm
+                closest_msteps[nearest_step_index] = mstep
+                closest_speeds[nearest_step_index] = speed
+    valid_indices = closest_rpms != 0
+    return closest_rpms[valid_indices], closest_msteps[valid_indices], closest_speeds[valid_indices]
+
+
+def test_local_rpm_table_identical(tmp_path, monkeypatch):
+    # Shipped and regenerated tables have the records of the legacy full grid scan
+    src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+    legacy = legacy_closest_combinations(make_rpm_steps())
+    monkeypatch.chdir(tmp_path)
+    make_rpm_table(regenerate=True)
+    for filename in (RPM_TABLE_FILE, os.path.join(src_dir, RPM_TABLE_FILE)):
+        table = RpmTable(filename, validate=True)
+        assert len(table) == len(legacy[0]), filename
+        for index in range(len(table)):
+            assert table.record(index) == (legacy[0][index], legacy[1][index], legacy[2][index]), filename
+        table.close()
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_local_rpm_table_file(tmp_path, monkeypatch, lazy):
+    monkeypatch.chdir(tmp_path)
+    arrays = find_closest_combinations(make_rpm_steps())
+    assert isinstance(make_rpm_table(regenerate=True), RpmTable)
+    table = make_rpm_table(validate=True, lazy=lazy)
+    assert isinstance(table, RpmTable)
+    assert len(table) == len(arrays[0]) == len(table[0])
+    for index in range(len(table)):
+        assert table.record(index) == (arrays[0][index], arrays[1][index], arrays[2][index])
+        assert (table[0][index], table[1][index], table[2][index]) == table.record(index)
+    assert table[0][-1] == arrays[0][-1]
+    # Bisect reads single fields, only the found record is unpacked
+    record = table.record
+    calls = []
+    table.record = lambda index: calls.append(index) or record(index)
+    targets = np.arange(0, MAX_RPM + 1, 0.3)
+    for target_rpm in targets:
+        assert find_combination(target_rpm, table) == find_combination(target_rpm, arrays)
+    assert len(calls) == len(targets)
+    table.record = record
+    table.close()
+
+
+def test_local_rpm_table_corrupted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_rpm_table(regenerate=True)
+    with open(RPM_TABLE_FILE, "r+b") as table_file:
+        table_file.seek(RPM_TABLE_HEADER_SIZE + 10)
+        table_file.write(b"\xff")
+    with pytest.raises(ValueError):
+        RpmTable(validate=True)
+    # Broken table is regenerated
+    table = make_rpm_table(validate=True)
+    assert isinstance(table, RpmTable)
+    RpmTable(validate=True).close()
+    assert find_combination(100, table) == find_combination(100, find_closest_combinations(make_rpm_steps()))
+
+
+def test_local_rpm_table_benchmark():
+    rpm_steps = make_rpm_steps()
+
+    start_time = time.perf_counter()
+    legacy = legacy_closest_combinations(rpm_steps)
+    legacy_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    table = find_closest_combinations(rpm_steps)
+    new_time = time.perf_counter() - start_time
+
+    for old, new in zip(legacy, table):
+        assert old.tobytes() == new.tobytes()
+    print(f"\nLegacy loop: {round(legacy_time, 4)}sec, Vectorized: {round(new_time, 4)}sec, "
+          f"x{round(legacy_time / new_time, 1)}")
+
+
+def test_local_find_combination_bisect():
+    rpm_table = find_closest_combinations(make_rpm_steps())
+    targets = list(np.arange(-1, MAX_RPM + 2, RPM_STEP / 3)) + [float(rpm) for rpm in rpm_table[0]]
+    for target_rpm in targets:
+        closest_index = np.argmin(abs(rpm_table[0] - target_rpm))
+        expected = rpm_table[0][closest_index], rpm_table[1][closest_index], rpm_table[2][closest_index]
+        assert find_combination(target_rpm, rpm_table) == expected
+
+
+def test_local_find_combination_cache():
+    rpm_table = find_closest_combinations(make_rpm_steps())
+    cache = CombinationCache(size=2)
+    first = find_combination(10.3, rpm_table, cache)
+    find_combination(55.5, rpm_table, cache)
+    assert cache.get(10.3) == first
+    # 55.5 is the least recently used now
+    find_combination(100, rpm_table, cache)
+    assert cache.get(55.5) is None
+    assert cache.get(10.3) == first
+    assert find_combination(np.array([10.3]), rpm_table, cache) == first
+
+
+def test_local_calc_move_time():
+    from unittest.mock import Mock
+    for step_per_rev in (200, 400):
+        mks = Servo42c(Mock(), 0, step_per_rev=step_per_rev)
+        for mstep, speed, steps in ((16, 10, 3200), (1, 127, 200), (255, 1, 1000)):
+            mks.mstep = mstep
+            mks.set_speed(speed, 0)
+            # Same runtime as the driver reports for the move
+            assert calc_move_time(mks, mstep, speed, steps) == pytest.approx(steps * mks.sec_in_pulse)
+
+
+def test_local_dose_plan_cache():
+    from unittest.mock import Mock
+    from src.lib.dose_plan import DosePlanner
+
+    rpm_table = find_closest_combinations(make_rpm_steps())
+    mks_dict = {"mks1": Servo42c(Mock(), 0)}
+    chart_points = {"pump1": extrapolate_flow_rate([(100, 100), (500, 400), (1000, 800)])}
+    inversion = [0]
+    planner = DosePlanner(mks_dict, chart_points, inversion, rpm_table)
+
+    plan = planner.plan(1, 10, 60, 1)
+    desired_rpm, mstep, speed, steps, runtime, direction = plan
+    assert (mstep, speed, steps) == calc_move(mks_dict["mks1"], desired_rpm, 60, rpm_table)
+    assert 59 < runtime < 61
+    assert direction == 1
+    assert planner.plan(1, 10, 60, 1) is plan
+
+    # New calibration chart or inversion invalidates the plan
+    chart_points["pump1"] = extrapolate_flow_rate([(100, 50), (500, 200), (1000, 400)])
+    new_plan = planner.plan(1, 10, 60, 1)
+    assert new_plan is not plan
+    assert new_plan[0] > desired_rpm
+    inversion[0] = 1
+    assert planner.plan(1, 10, 60, 1)[5] == 0
+
+
+def test_local_dose_plan_cache_eviction():
+    from unittest.mock import Mock
+    from src.lib.dose_plan import DosePlanner
+
+    rpm_table = find_closest_combinations(make_rpm_steps())
+    mks_dict = {"mks1": Servo42c(Mock(), 0)}
+    chart_points = {"pump1": extrapolate_flow_rate([(100, 100), (500, 400), (1000, 800)])}
+    planner = DosePlanner(mks_dict, chart_points, [0], rpm_table, size=4)
+
+    plans = {amount: planner.plan(1, amount, 60, 1) for amount in range(1, 5)}
+    # Cache is full, a frequently used plan survives new entries
+    for amount in range(5, 9):
+        assert planner.plan(1, 1, 60, 1) is plans[1]
+        planner.plan(1, amount, 60, 1)
+    assert len(planner.plans) == 4
+    assert planner.plan(1, 1, 60, 1) is plans[1]
+    # Only the least recently used plans were evicted
+    assert planner.plan(1, 2, 60, 1) is not plans[2]
+    assert planner.plan(1, 8, 60, 1) is planner.plan(1, 8, 60, 1)
@@ -0,0 +1,151 @@
+import random
+import time
+
+import pytest
+import src.lib.mcron as mcron
+from src.lib.schedule_manager import ScheduleManager
+
+START_TIME = 10 * mcron.PERIOD_DAY
+
+
+@pytest.fixture
+def cron():
+    for table in [mcron.timer_table, mcron.memory_table, mcron.callback_table, mcron.fire_index, mcron.index_steps,
+                  mcron.callback_index]:
+        table.clear()
+    mcron.fire_heap.clear()
+    mcron._index_time = None
+    mcron.utime.time.return_value = START_TIME
+    yield mcron
+    mcron.remove_all()
+
+
+# Full scan of the timer table, reference for the fire index
+def get_actions(current_time):
+    for period_info, period_data in mcron.timer_table.items():
+        period, period_offset = period_info
+        period_pointer = (current_time + period_offset) % period
+        for period_steps, callback_ids in period_data.items():
+            if mcron.STEP_TYPE_SET == period_steps[0] and period_pointer in period_steps[1:] or \
+                    mcron.STEP_TYPE_RANGE == period_steps[0] and period_pointer in range(*period_steps[1:]):
+                yield from callback_ids
+
+
+def scan_actions(current_time):
+    return sorted(get_actions(current_time))
+
+
+def test_local_next_fire_index(cron):
+    fired = []
+
+    def callback(callback_id, current_time, callback_memory):
+        fired.append((current_time, callback_id))
+
+    random.seed(1)
+    for job in range(50):
+        start = random.randrange(0, 3600)
+        cron.insert(cron.PERIOD_HOUR, range(start, cron.PERIOD_HOUR, random.randrange(1, 900)), f"range{job}", callback)
+        cron.insert(cron.PERIOD_MINUTE, {random.randrange(0, 60) for _ in range(3)}, f"set{job}", callback,
+                    period_offset=random.randrange(0, 60))
+    cron.insert(cron.PERIOD_DAY, range(-100, 100, 7), "negative", callback)
+    cron.insert(cron.PERIOD_DAY, range(cron.PERIOD_DAY + 50, 50, -3600), "reverse", callback)
+
+    for current_time in range(START_TIME, START_TIME + 2 * cron.PERIOD_HOUR):
+        assert sorted(cron.pop_actions(current_time)) == scan_actions(current_time)
+
+    # Removed job doesn't fire, stale heap entries are skipped
+    for job in range(50):
+        cron.remove(f"range{job}")
+    current_time = START_TIME + 2 * cron.PERIOD_HOUR
+    for current_time in range(current_time, current_time + cron.PERIOD_HOUR):
+        actions = sorted(cron.pop_actions(current_time))
+        assert actions == scan_actions(current_time)
+        assert not [action for action in actions if action.startswith("range")]
+    assert len(cron.fire_heap) <= 2 * len(cron.fire_index) + 32
+
+    cron.run_actions(current_time + 1)
+    assert fired == [(current_time + 1, callback_id) for callback_id in scan_actions(current_time + 1)]
+
+
+def test_local_clock_jump(cron):
+    cron.insert(cron.PERIOD_MINUTE, {0}, "job", lambda *args: None)
+    assert cron.pop_actions(START_TIME) == ["job"]
+    # Job removed and inserted back in the same second doesn't fire twice
+    cron.remove("job")
+    cron.insert(cron.PERIOD_MINUTE, {0}, "job", lambda *args: None)
+    assert cron.pop_actions(START_TIME + 1) == []
+    # Skipped second is caught up
+    assert cron.pop_actions(START_TIME + 59) == []
+    assert cron.pop_actions(START_TIME + 61) == ["job"]
+    # NTP sync moved the clock, missed steps are not dispatched
+    assert cron.pop_actions(START_TIME + 10 * 60 + 30) == []
+    assert cron.pop_actions(START_TIME + 11 * 60) == ["job"]
+    # Clock moved backwards
+    assert cron.pop_actions(START_TIME) == ["job"]
+
+
+def test_local_index_benchmark(cron):
+    random.seed(2)
+    jobs = 3000
+    for job in range(jobs):
+        start = random.randrange(0, cron.PERIOD_DAY)
+        cron.insert(cron.PERIOD_DAY, range(start, start + 1), f"job{job}", lambda *args: None)
+
+    seconds = 600
+    start_time = time.time()
+    indexed = [cron.pop_actions(current_time) for current_time in range(START_TIME, START_TIME + seconds)]
+    indexed_time = time.time() - start_time
+
+    start_time = time.time()
+    scanned = [list(get_actions(current_time)) for current_time in range(START_TIME, START_TIME + seconds)]
+    scan_time = time.time() - start_time
+
+    assert [sorted(actions) for actions in indexed] == [sorted(actions) for actions in scanned]
+    print(f"\r\n{jobs} jobs, tick: indexed {indexed_time / seconds * 1e6:.1f}us, "
+          f"scan {scan_time / seconds * 1e6:.1f}us, x{scan_time / indexed_time:.1f}")
+    assert indexed_time < scan_time
+
+
+def test_local_remove_reverse_index(cron):
+    for job in range(100):
+        cron.insert(cron.PERIOD_DAY, range(job, cron.PERIOD_DAY, 3600), f"job{job}", lambda *args: None)
+    cron.insert(cron.PERIOD_DAY, range(0, cron.PERIOD_DAY, 3600), "shared", lambda *args: None)
+    cron.remove("job0")
+    # Bucket is kept while another callback uses it
+    assert cron.timer_table[(cron.PERIOD_DAY, 0)][(cron.STEP_TYPE_RANGE, 0, cron.PERIOD_DAY, 3600)] == {"shared"}
+    cron.remove("unknown")
+    cron.remove_all()
+    assert not cron.timer_table and not cron.callback_table and not cron.callback_index and not cron.fire_index
+
+
+def test_local_schedule_manager(cron):
+    def dose(pump, start_time, amount=1, weekdays=None):
+        job = {"amount": amount, "duration": 60, "start_time": start_time, "end_time": "", "frequency": 4, "dir": 1}
+        if weekdays:
+            job["weekdays"] = weekdays
+        return job
+
+    manager = ScheduleManager(cron, lambda *args: None)
+    schedule = {"pump1": [dose("pump1", "10:00"), dose("pump1", "10:00")],
+                "pump2": [dose("pump2", "11:00", weekdays=[0, 1])]}
+    assert manager.update(schedule) == (3, 0)
+    assert len(cron.callback_table) == 3
+    callback_ids = set(cron.callback_table)
+
+    # Same schedule, nothing changes
+    assert manager.update(schedule) == (0, 0)
+    assert set(cron.callback_table) == callback_ids
+
+    # Only the changed job of pump2 is replaced, new job gets a new callback id
+    schedule["pump2"] = [dose("pump2", "11:00", amount=2, weekdays=[0, 1])]
+    assert manager.update(schedule) == (1, 1)
+    new_ids = set(cron.callback_table) - callback_ids
+    assert len(new_ids) == 1 and len(cron.callback_table) == 3
+    assert manager.params[new_ids.pop()] == ("2", 60, 1, 2, [0, 1])
+    assert sorted(cron.pop_actions(START_TIME + 11 * 3600)) == sorted(
+        callback_id for callback_id, params in manager.params.items() if params[0] == "2")
+
+    assert manager.update({"pump1": [dose("pump1", "10:00")]}) == (0, 2)
+    assert len(cron.callback_table) == 1
+    manager.remove_all()
+    assert not cron.callback_table and not manager.params
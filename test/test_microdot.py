@@ -0,0 +1,444 @@
+import asyncio
+import io
+import json
+import random
+import time
+
+from src.lib.microdot.microdot import Microdot, Request, Response, WriteBuffer
+from src.lib.microdot.json_stream import JSONStreamDecoder, with_json_body
+from src.lib.microdot.sse import with_sse
+
+
+class FakeRequest:
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.url_args = None
+
+
+def make_app():
+    app = Microdot()
+
+    def handler(name):
+        def f(request, **kwargs):
+            return name
+        f.__name__ = name
+        return f
+
+    for path in ['/get_rpm_points', '/get_flow_points', '/get_analog_chart_points', '/memfree', '/queue-stats',
+                 '/site.webmanifest', '/stop', '/run', '/dose', '/time', '/dose-sse', '/ota-sse']:
+        app.route(path)(handler(path))
+    for prefix in ['favicon', 'styles', 'javascript', 'static', 'icon']:
+        app.route(f'/{prefix}/<path:path>')(handler(prefix))
+    for path in ['/', '/ota-upgrade', '/schedule', '/calibration', '/settings']:
+        app.route(path, methods=['GET', 'POST'])(handler(path))
+    for path in ['/exec', '/exec_save', '/refill']:
+        app.route(path, methods=['POST'])(handler(path))
+    app.route('/api/<int:pump>/<name>')(handler("api"))
+    app.route('/<re:extension_.*:page>')(handler("extension"))
+    # Shadowed route, first registered wins
+    app.route('/dose')(handler("shadowed"))
+    app.route('/icon/<path:path>', methods=['POST'])(handler("icon_post"))
+    return app
+
+
+def legacy_find_route(app, req):
+    method = req.method.upper()
+    if method == 'HEAD':
+        method = 'GET'
+    f = 404
+    for route_methods, route_pattern, route_handler in app.url_map:
+        req.url_args = route_pattern.match(req.path)
+        if req.url_args is not None:
+            if method in route_methods:
+                f = route_handler
+                break
+            else:
+                f = 405
+    return f
+
+
+REQUESTS = [(method, path) for method in ['GET', 'POST', 'HEAD'] for path in [
+    '/', '/dose', '/dose/', '/run', '/stop', '/memfree', '/exec', '/settings', '/favicon/favicon.ico',
+    '/styles/cerulean/bootstrap.min.css', '/javascript/chart.min.js', '/icon/a.png', '/static/x/y.html',
+    '/api/3/name', '/api/x/name', '/extension_page', '/unknown', '/unknown/path', '', 'dose', '//dose']]
+
+
+def test_local_route_index():
+    app = make_app()
+    for method, path in REQUESTS:
+        req, legacy_req = FakeRequest(method, path), FakeRequest(method, path)
+        f = app.find_route(req)
+        assert f == legacy_find_route(app, legacy_req), (method, path)
+        if callable(f):
+            assert req.url_args == legacy_req.url_args
+
+    assert app.find_route(FakeRequest('GET', '/dose'))(None) == '/dose'
+    assert app.find_route(FakeRequest('POST', '/icon/a.png'))(None) == 'icon_post'
+    assert app.find_route(FakeRequest('POST', '/run')) == 405
+
+    # Route added after the index was built
+    app.route('/late')(lambda request: 'late')
+    assert app.find_route(FakeRequest('GET', '/late'))(None) == 'late'
+
+    assert app.default_options_handler(FakeRequest('OPTIONS', '/settings')) == {'Allow': 'GET, POST, HEAD, OPTIONS'}
+
+
+def test_local_route_benchmark():
+    app = make_app()
+    requests = [FakeRequest(method, path) for method, path in REQUESTS] * 200
+
+    start_time = time.time()
+    for req in requests:
+        legacy_find_route(app, req)
+    legacy_time = time.time() - start_time
+
+    start_time = time.time()
+    for req in requests:
+        app.find_route(req)
+    indexed_time = time.time() - start_time
+
+    print(f"\r\nRouted requests/s: linear {len(requests) / legacy_time:.0f}, indexed {len(requests) / indexed_time:.0f}")
+    assert indexed_time < legacy_time
+
+
+PAGE = ['/doser.html', '/styles/bootstrap.min.css', '/javascript/bootstrap.bundle.min.js',
+        '/javascript/chart.min.js', '/favicon/favicon.ico', '/get_rpm_points', '/get_flow_points']
+
+
+def make_server_app():
+    app = Microdot()
+
+    @app.route('/stream')
+    async def stream(request):
+        async def body():
+            for chunk in [b'first', b'', b'second']:
+                yield chunk
+        return body()
+
+    @app.route('/events')
+    @with_sse
+    async def events(request, sse):
+        await sse.send('hello')
+        await asyncio.sleep(10)
+
+    @app.route('/<path:path>')
+    async def asset(request, path):
+        return path.encode() * 100
+
+    return app
+
+
+async def start(app):
+    task = asyncio.create_task(app.start_server(host='127.0.0.1', port=0))
+    while app.server is None:
+        await asyncio.sleep(0)
+    return task, app.server.sockets[0].getsockname()[1]
+
+
+async def read_response(reader):
+    status = (await reader.readline()).decode()
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode().strip()
+        if not line:
+            break
+        header, value = line.split(':', 1)
+        headers[header.lower()] = value.strip()
+    if headers.get('transfer-encoding') == 'chunked':
+        body = b''
+        while True:
+            size = int(await reader.readline(), 16)
+            chunk = await reader.readexactly(size + 2)
+            if not size:
+                break
+            body += chunk[:-2]
+    else:
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, headers, body
+
+
+async def fetch(port, paths, keep_alive):
+    results = []
+    reader = writer = None
+    for path in paths:
+        if writer is None:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        connection = 'keep-alive' if keep_alive else 'close'
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: doser\r\nConnection: {connection}\r\n\r\n'.encode())
+        results.append(await read_response(reader))
+        if results[-1][1].get('connection') != 'keep-alive':
+            writer.close()
+            writer = None
+    if writer:
+        writer.close()
+    return results
+
+
+def test_local_keep_alive():
+    async def run():
+        app = make_server_app()
+        app.keep_alive_timeout = 0.1
+        app.max_keep_alive_requests = 3
+        task, port = await start(app)
+
+        results = await fetch(port, PAGE, keep_alive=True)
+        assert [body for status, headers, body in results] == [path[1:].encode() * 100 for path in PAGE]
+        # Connection is closed after max_keep_alive_requests
+        assert [headers['connection'] for status, headers, body in results] == ['keep-alive', 'keep-alive', 'close'] * 2 + ['keep-alive']
+        assert all(status.startswith('HTTP/1.1 200') for status, headers, body in results)
+
+        # Streamed body without Content-Length is sent chunked
+        status, headers, body = (await fetch(port, ['/stream'], keep_alive=True))[0]
+        assert headers['transfer-encoding'] == 'chunked' and body == b'firstsecond'
+
+        # HTTP/1.0 client without keep-alive gets the connection closed
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /stream HTTP/1.0\r\n\r\n')
+        assert await reader.read() == b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; charset=UTF-8\r\n\r\nfirstsecond'
+        writer.close()
+
+        # Pipelined requests are answered in order, idle connection is closed after the timeout
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /a HTTP/1.1\r\n\r\nGET /b HTTP/1.1\r\n\r\n')
+        assert (await read_response(reader))[2] == b'a' * 100
+        assert (await read_response(reader))[2] == b'b' * 100
+        assert app.connections == 1
+        assert await asyncio.wait_for(reader.read(), 1) == b''
+        writer.close()
+        await asyncio.sleep(0.01)
+        assert app.connections == 0
+
+        # Connections over the cap are refused
+        app.max_connections = 1
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        await asyncio.sleep(0.01)
+        status, headers, body = (await fetch(port, ['/a'], keep_alive=True))[0]
+        assert status.startswith('HTTP/1.0 503') and headers['retry-after'] == '1'
+        # Keep-alive is not granted while the connection pool is full
+        writer.write(b'GET /a HTTP/1.1\r\n\r\n')
+        assert (await read_response(reader))[1]['connection'] == 'close'
+        writer.close()
+        await asyncio.sleep(0.01)
+
+        # Event streams have their own limit and don't fill the connection pool
+        app.max_streams = 2
+        streams = []
+        for _ in range(3):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /events HTTP/1.1\r\n\r\n')
+            streams.append((reader, writer))
+            await asyncio.sleep(0.01)
+        assert app.streams == 2 and app.connections == 0
+        for reader, writer in streams[:2]:
+            assert await reader.readuntil(b'data: hello\n\n')
+        status, headers, body = await read_response(streams[2][0])
+        assert status.startswith('HTTP/1.1 503') and headers['retry-after'] == '1'
+        assert (await fetch(port, ['/a'], keep_alive=False))[0][2] == b'a' * 100
+        for reader, writer in streams:
+            writer.close()
+
+        app.shutdown()
+        await task
+
+    asyncio.run(run())
+
+
+def test_local_keep_alive_page_load():
+    async def run():
+        app = make_server_app()
+        task, port = await start(app)
+        loads = 50
+
+        start_time = time.time()
+        for _ in range(loads):
+            await fetch(port, PAGE, keep_alive=False)
+        close_time = time.time() - start_time
+
+        start_time = time.time()
+        for _ in range(loads):
+            await fetch(port, PAGE, keep_alive=True)
+        keep_alive_time = time.time() - start_time
+
+        app.shutdown()
+        await task
+        print(f"\r\nPage load ({len(PAGE)} requests): connection per request {close_time / loads * 1e3:.2f}ms, "
+              f"keep-alive {keep_alive_time / loads * 1e3:.2f}ms")
+        assert keep_alive_time < close_time
+
+    asyncio.run(run())
+
+
+class CountingStream:
+    def __init__(self):
+        self.writes = []
+
+    async def awrite(self, data):
+        self.writes.append(bytes(data))
+
+
+async def legacy_write(response, stream):
+    response.complete()
+    await stream.awrite(f'HTTP/1.0 {response.status_code} {response.reason or "OK"}\r\n'.encode())
+    for header, value in response.headers.items():
+        for value in value if isinstance(value, list) else [value]:
+            await stream.awrite(f'{header}: {value}\r\n'.encode())
+    await stream.awrite(b'\r\n')
+    async for body in response.body_iter():
+        await stream.awrite(body)
+
+
+def settings_response(body=b'<html>settings</html>'):
+    response = Response(body, headers={'Content-Type': 'text/html'})
+    for index in range(20):
+        response.set_cookie(f'setting{index}', f'value{index}')
+    return response
+
+
+def test_local_coalesced_write():
+    async def run():
+        writes = {}
+        for name, response in [('settings', settings_response), ('json', lambda: Response({'free': 1000})),
+                               ('file', lambda: Response(io.BytesIO(b'x' * 3000), headers={'Content-Type': 'text/css'})),
+                               ('empty', lambda: Response(b''))]:
+            legacy_stream, stream = CountingStream(), CountingStream()
+            await legacy_write(response(), legacy_stream)
+            await response().write(stream)
+            # Same bytes on the wire
+            assert b''.join(stream.writes) == b''.join(legacy_stream.writes), name
+            writes[name] = (len(legacy_stream.writes), len(stream.writes))
+        # Headers, cookies and the first body chunk go out in one write
+        assert writes == {'settings': (25, 1), 'json': (5, 1), 'file': (6, 3), 'empty': (4, 1)}
+        print(f"\r\nSocket writes per response (before, after): {writes}")
+
+        # Header block larger than the buffer is split, not truncated
+        legacy_stream, stream = CountingStream(), CountingStream()
+        response = settings_response()
+        response.write_buffer_size = 64
+        await response.write(stream)
+        await legacy_write(settings_response(), legacy_stream)
+        assert b''.join(stream.writes) == b''.join(legacy_stream.writes)
+        assert all(len(data) <= 64 for data in stream.writes)
+
+        # Async generator headers are sent before the first chunk is produced
+        stream = CountingStream()
+
+        async def body():
+            assert len(stream.writes) == 1
+            yield b'event'
+
+        await Response(body()).write(stream)
+        assert stream.writes[1] == b'event'
+
+        # Keep-alive responses of a connection reuse its buffer
+        stream = CountingStream()
+        buffer = WriteBuffer(stream, Response.write_buffer_size)
+        memory = buffer.buffer
+        for _ in range(2):
+            await settings_response().write(stream, buffer)
+            await Response({'free': 1000}).write(stream, buffer)
+        legacy_stream = CountingStream()
+        for _ in range(2):
+            await legacy_write(settings_response(), legacy_stream)
+            await legacy_write(Response({'free': 1000}), legacy_stream)
+        assert b''.join(stream.writes) == b''.join(legacy_stream.writes)
+        assert len(stream.writes) == 4 and buffer.buffer is memory
+
+    asyncio.run(run())
+
+
+CALIBRATION = {f"pump{pump}": [{"rpm": rpm, "flowRate": rpm * 0.37 + pump, "name": "\u00b5l \"pump\"\\"}
+                               for rpm in range(1, 1000, 50)] for pump in range(1, 10)}
+CALIBRATION["settings"] = {"enable": True, "pin": None, "offset": -1.5e-3, "names": [], "empty": {}}
+
+
+def test_local_json_stream_decoder():
+    body = json.dumps(CALIBRATION, indent=1).encode()
+    random.seed(3)
+    for _ in range(20):
+        decoder = JSONStreamDecoder()
+        start = 0
+        while start < len(body):
+            size = random.randrange(1, 64)
+            decoder.feed(body[start:start + size])
+            # Only the unparsed tail of a chunk is kept
+            assert len(decoder.buffer) < 200
+            start += size
+        assert decoder.close() == CALIBRATION
+
+    for document in [b'12', b' "text" ', b'[1, 2.5, true, false, null]', b'{"a": {"b": [[], {}]}}']:
+        decoder = JSONStreamDecoder()
+        for byte in range(len(document)):
+            decoder.feed(document[byte:byte + 1])
+        assert decoder.close() == json.loads(document)
+
+    for document in [b'{"a": 1', b'[1]]', b'{"a": 1} 2', b'{1: 2}', b'[1, 2}', b'"open',
+                     # Missing or misplaced separators
+                     b'[1 2]', b'{"a" 1}', b'[,,1]', b'{"a":,}', b'[1,]', b'{"a": 1,}', b'{"a": 1 "b": 2}',
+                     b'{"a"}', b'["a": 1]', b'{,}', b'{"a":: 1}', b',1', b'1:']:
+        decoder = JSONStreamDecoder()
+        try:
+            decoder.feed(document)
+            decoder.close()
+        except ValueError:
+            continue
+        assert False, document
+
+
+class ChunkReader:
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+        self.largest_read = 0
+
+    async def readline(self):
+        return self.stream.readline()
+
+    async def readexactly(self, n):
+        self.largest_read = max(self.largest_read, n)
+        return self.stream.read(n)
+
+    async def read(self, n=-1):
+        self.largest_read = max(self.largest_read, n)
+        return self.stream.read(n)
+
+
+def test_local_json_body_limit():
+    app = Microdot()
+
+    @app.route('/calibration', methods=['POST'])
+    @with_json_body(16 * 1024)
+    async def calibration(request):
+        return {"pumps": len(request.json)}
+
+    @app.route('/exec', methods=['POST'])
+    @with_json_body(64)
+    async def exec_code(request):
+        return request.json
+
+    async def post(path, body):
+        data = f"POST {path} HTTP/1.1\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n"
+        reader = ChunkReader(data.encode() + body)
+        req = await Request.create(app, reader, None, ('127.0.0.1', 1))
+        return await app.dispatch_request(req), reader
+
+    async def run():
+        max_body_length = Request.max_body_length
+        Request.max_body_length = 1024
+        try:
+            body = json.dumps(CALIBRATION).encode()
+            assert len(body) > Request.max_body_length
+            res, reader = await post('/calibration', body)
+            assert res.status_code == 200 and json.loads(res.body) == {"pumps": 10}
+            # Body is decoded from the socket in chunks, not read in one buffer
+            assert reader.largest_read <= 256
+
+            res, reader = await post('/exec', b'{"code": "True", "pump": 1}')
+            assert json.loads(res.body) == {"code": "True", "pump": 1}
+            res, reader = await post('/exec', b'{"code": "' + b'x' * 64 + b'"}')
+            assert res.status_code == 413
+            res, reader = await post('/calibration', body[:-1] + b']')
+            assert res.status_code == 400
+        finally:
+            Request.max_body_length = max_body_length
+
+    asyncio.run(run())
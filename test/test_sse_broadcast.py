@@ -0,0 +1,78 @@
+import asyncio
+import json
+
+from src.lib.microdot.sse import SSE
+from src.lib.sse_broadcast import *
+from src.lib.state_bus import StateBus
+
+
+def test_local_fan_out():
+    async def run():
+        broadcaster = Broadcaster(queue_size=3, keepalive=0.02)
+        clients = [SSE() for _ in range(3)]
+        tasks = [asyncio.create_task(broadcaster.serve(sse, {"time": "00:00:00"})) for sse in clients]
+        await asyncio.sleep(0)
+        assert len(broadcaster) == 3
+        for sse in clients:
+            assert sse.queue == [b'data: {"time": "00:00:00"}\n\n']
+
+        for second in range(1, 5):
+            broadcaster.publish(f'{{"time": "00:00:0{second}"}}')
+        # Slow clients keep only the newest events, all clients share the same encoded event
+        for sse in clients:
+            assert sse.queue == [b'data: {"time": "00:00:02"}\n\n', b'data: {"time": "00:00:03"}\n\n',
+                                 b'data: {"time": "00:00:04"}\n\n']
+            assert sse.queue[-1] is clients[0].queue[-1]
+        assert broadcaster.metrics() == {"clients": 3, "sent": 4, "dropped": 6}
+
+        # Idle connection gets keep-alive comments
+        clients[0].queue.clear()
+        await asyncio.sleep(0.05)
+        assert clients[0].queue == [KEEPALIVE]
+
+        # Disconnected client is removed from the fan-out
+        tasks[0].cancel()
+        await asyncio.sleep(0)
+        assert len(broadcaster) == 2
+        for task in tasks[1:]:
+            task.cancel()
+        await asyncio.sleep(0)
+        assert len(broadcaster) == 0
+
+    asyncio.run(run())
+
+
+def test_local_resync_slow_client():
+    storage = {"remaining1": 100, "remaining2": 100}
+    schedule = {"pump1": []}
+
+    async def run():
+        bus = StateBus({"Schedule": lambda: schedule, "Storage": lambda: dict(storage)})
+        broadcaster = Broadcaster(queue_size=3, keepalive=10, resync=bus.snapshot)
+        sse = SSE()
+        task = asyncio.create_task(broadcaster.serve(sse, bus.snapshot()))
+        await asyncio.sleep(0)
+        subscription = bus.subscribe(debounce=0)
+        await subscription.next()
+
+        # Client doesn't read while the deltas of several sections are published
+        for _ in range(5):
+            storage["remaining1"] -= 1
+            bus.notify("Storage")
+            broadcaster.publish(await subscription.next())
+            if _ == 1:
+                schedule["pump1"].append("10:00")
+                bus.notify("Schedule")
+                broadcaster.publish(await subscription.next())
+        assert broadcaster.dropped > 0
+
+        # Client merges every event it still got, the same way doser.html does
+        state = {}
+        for event in sse.queue:
+            state.update(json.loads(event[len(b"data: "):].decode()))
+        assert state == json.loads(bus.snapshot())
+        assert state["Schedule"] == {"pump1": ["10:00"]} and state["Storage"]["remaining1"] == 95
+        task.cancel()
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+from src.lib.state_bus import *
+
+
+def test_local_snapshot_and_delta():
+    storage = {"pump1": 100, "remaining1": 100}
+    schedule = {"pump1": []}
+    calls = []
+
+    def get_storage():
+        calls.append("Storage")
+        return storage
+
+    async def run():
+        bus = StateBus({"Schedule": lambda: schedule, "Storage": get_storage})
+        client1 = bus.subscribe(debounce=0.01)
+        client2 = bus.subscribe(debounce=0.01)
+        snapshot = await client1.next()
+        assert json.loads(snapshot) == {"Schedule": schedule, "Storage": storage}
+        # Same serialised snapshot is shared by all clients
+        assert await client2.next() is snapshot
+
+        async def dose():
+            await asyncio.sleep(0.01)
+            # Burst of mutations is coalesced into one event
+            for _ in range(5):
+                storage["remaining1"] -= 1
+                bus.notify("Storage")
+
+        asyncio.create_task(dose())
+        delta1, delta2 = await asyncio.gather(client1.next(), client2.next())
+        assert json.loads(delta1) == {"Storage": {"pump1": 100, "remaining1": 95}}
+        assert delta2 is delta1
+        # Storage encoded once for the snapshot and once for the delta
+        assert calls == ["Storage", "Storage"]
+
+        schedule["pump1"] = [{"amount": 1}]
+        bus.notify("Schedule")
+        assert json.loads(await client1.next()) == {"Schedule": {"pump1": [{"amount": 1}]}}
+
+    asyncio.run(run())
+
+
+def test_local_state_etag():
+    settings = {"theme": "darkly"}
+    bus = StateBus({"Settings": lambda: settings})
+    etag = bus.etag()
+    assert bus.etag() is etag and etag.startswith('"') and len(etag) == 10
+    # Version bump without a change keeps the ETag, a real change gives a new one
+    bus.notify("Settings")
+    assert bus.etag() == etag
+    settings["theme"] = "vapor"
+    bus.notify("Settings")
+    assert bus.etag() != etag
+    # ETag doesn't depend on the version, a restarted bus with the same content has the same ETag
+    assert StateBus({"Settings": lambda: settings}).etag() == bus.etag()